@@ -0,0 +1,119 @@
+# answer_cache.py
+import hashlib
+import json
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from config import Config
+from instrumentation import log_event
+
+def normalize_query(query):
+    """小写, 合并空白, 去掉结尾的标点"""
+    return re.sub(r"\s+", " ", query).strip().lower().rstrip("?.!。？！ ")
+
+def history_digest(history):
+    return hashlib.sha256(json.dumps(history or [], ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+class AnswerCache:
+    """缓存完整回复, 按 (权限等级, 规范化问题, 检索到的文档块 ID, 模型, 对话历史摘要) 索引
+
+    每条记录保存它的上下文来自哪些等级; 某个等级的文件变化时, 相关记录全部失效.
+    权限等级是键的一部分, 命中的回复只可能来自该等级可以访问的文档.
+    """
+
+    def __init__(self, max_entries=None, ttl=None, semantic=None, similarity_threshold=None):
+        self.max_entries = max_entries or Config.ANSWER_CACHE_MAX_ENTRIES
+        self.ttl = ttl or Config.ANSWER_CACHE_TTL
+        self.semantic = Config.ANSWER_CACHE_SEMANTIC if semantic is None else semantic
+        self.similarity_threshold = similarity_threshold or Config.ANSWER_CACHE_SIMILARITY
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # 每个等级的版本号, 文件变化时加一; 生成期间版本变了的回复不写入缓存
+        self._generations = {}
+        self._lock = threading.Lock()
+
+    def make_key(self, access_level, query, chunk_ids, model, history):
+        return (access_level, normalize_query(query), tuple(sorted(chunk_ids)), model, history_digest(history))
+
+    def _expired(self, entry):
+        return time.time() - entry["created_at"] > self.ttl
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or self._expired(entry):
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry["response"]
+
+    def get_similar(self, access_level, model, history, embedding):
+        """语义模式: 同一等级、模型和历史下, 问题向量足够接近就直接返回缓存的回复"""
+        if not self.semantic or embedding is None:
+            return None
+        digest = history_digest(history)
+        best_key, best_score = None, self.similarity_threshold
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if self._expired(entry):
+                    del self._entries[key]
+                    continue
+                if key[0] != access_level or key[3] != model or key[4] != digest or entry["embedding"] is None:
+                    continue
+                score = cosine_similarity(embedding, entry["embedding"])
+                if score >= best_score:
+                    best_key, best_score = key, score
+            if best_key is None:
+                return None
+            self._entries.move_to_end(best_key)
+            self.semantic_hits += 1
+            return self._entries[best_key]["response"]
+
+    def generation(self, levels):
+        with self._lock:
+            return tuple(self._generations.get(level, 0) for level in levels)
+
+    def put(self, key, response, levels, generation, embedding=None):
+        with self._lock:
+            if tuple(self._generations.get(level, 0) for level in levels) != generation:
+                return
+            self._entries[key] = {
+                "response": response,
+                "levels": set(levels),
+                "embedding": embedding if self.semantic else None,
+                "created_at": time.time()
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate_level(self, level):
+        """删除上下文可能来自该等级的所有记录"""
+        with self._lock:
+            self._generations[level] = self._generations.get(level, 0) + 1
+            stale = [key for key, entry in self._entries.items() if level in entry["levels"]]
+            for key in stale:
+                del self._entries[key]
+        if stale:
+            log_event("answer_cache_invalidated", access_level=level, entries=len(stale))
+
+    def stats(self):
+        with self._lock:
+            entries = len(self._entries)
+        return {
+            "hits": self.hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "entries": entries
+        }
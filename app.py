@@ -1,16 +1,36 @@
 # app.py
+import itertools
+import json
+import logging
+import re
 import traceback
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session
+import uuid
+from flask import Flask, Request, Response, render_template, request, redirect, url_for, flash, jsonify, session, stream_with_context
 from flask_login import LoginManager, login_user, login_required, current_user, logout_user
-from user_manager import UserManager, User
+from user_manager import UserManager
 from file_manager import FileManager
 from rag_system import RAGSystem
-from utils import clean_temp_uploads
+from ingest_queue import IngestQueue
+from file_watcher import DataWatcher
+from conversation_store import ConversationStore
+from async_runtime import BackendBusyError
+from utils import start_temp_sweeper
+from instrumentation import REGISTRY, log_event
+from werkzeug.exceptions import RequestEntityTooLarge
 from config import Config
 import os
 
+class UploadRequest(Request):
+    """上传的文件在解析请求时直接流式写入临时文件, 同时计算 hash 并检查大小"""
+    
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return file_manager.open_upload_stream(filename)
+
 app = Flask(__name__, static_folder='static', template_folder='templates')
 app.config['SECRET_KEY'] = Config.SECRET_KEY
+app.request_class = UploadRequest
+# 整个请求的大小上限, 单个文件的上限由 UploadStream 检查
+app.config['MAX_CONTENT_LENGTH'] = Config.MAX_FILE_SIZE * Config.MAX_FILES + 1024 * 1024
 
 # 初始化组件
 login_manager = LoginManager()
@@ -20,6 +40,48 @@ login_manager.login_view = 'login'
 user_manager = UserManager()
 file_manager = FileManager()
 rag_system = RAGSystem()
+# 多进程部署中的 worker: 上传只提交索引任务, 由 writer 进程 (indexer.py) 执行, 目录监视和临时文件清理也在那里
+ingest_queue = IngestQueue(rag_system.refresh_level, workers=0 if Config.SERVING_ROLE == "worker" else None)
+
+def start_background_tasks():
+    """启动索引任务的后台 worker、data/ 目录监视和临时文件清理, 由 python app.py 的入口调用 (导入 app 时不启动)"""
+    # 上传后的索引在后台 worker 中进行, 完成后新索引整体替换旧索引
+    ingest_queue.start()
+    # 直接放进 data/<level>/ 的文件也会被发现, 只为变化的文件提交索引任务
+    DataWatcher(rag_system.file_catalog, ingest_queue.enqueue_change).start()
+    # 临时上传目录由后台线程定期清理, 不在请求中进行
+    start_temp_sweeper()
+
+# 对话记录保存在服务端, session cookie 中只有当前对话的 ID
+conversation_store = ConversationStore()
+
+# /metrics 中导出各组件已有的统计
+REGISTRY.add_collector(rag_system.metric_samples)
+REGISTRY.add_collector(lambda: [
+    ("rag_ingest_jobs", "gauge", "Ingestion jobs by status", {"status": status}, count)
+    for status, count in ingest_queue.stats().items() if status != "coalesced"
+] + [("rag_ingest_jobs_coalesced_total", "counter", "Ingestion requests merged into a queued job", {},
+      ingest_queue.coalesced)])
+
+REGISTRY.add_collector(lambda: [
+    ("rag_cache_hits_total", "counter", "Cache hits", {"cache": "conversation"}, conversation_store.hits),
+    ("rag_cache_misses_total", "counter", "Cache misses", {"cache": "conversation"}, conversation_store.misses),
+    ("rag_cache_hits_total", "counter", "Cache hits", {"cache": "user"}, user_manager.hits),
+    ("rag_cache_misses_total", "counter", "Cache misses", {"cache": "user"}, user_manager.misses)
+])
+
+CONVERSATION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+def get_conversation_id():
+    """当前对话的 ID: 表单中指定的, 或 session 中记录的, 没有时新建"""
+    conversation_id = request.form.get('conversation_id') or session.get('conversation_id')
+    if not conversation_id or not CONVERSATION_ID_PATTERN.match(conversation_id):
+        conversation_id = uuid.uuid4().hex[:16]
+    if session.get('conversation_id') != conversation_id:
+        session['conversation_id'] = conversation_id
+    # 旧版本把整个对话历史放在 cookie 中
+    session.pop('chat_history', None)
+    return conversation_id
 
 @login_manager.user_loader
 def load_user(user_id):
@@ -36,17 +98,15 @@ def login():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        print(f"Login attempt: username={username}, password={password}")
-        
         user = user_manager.verify_user(username, password)
         if user:
-            print(f"User authenticated: {username}")
+            log_event("login", user=username, outcome="success")
             login_user(user)
             # 更新知识库
             rag_system.update_knowledge_base(user)
             return redirect(url_for('chat'))
         else:
-            print(f"Authentication failed: {username}")
+            log_event("login", user=username, outcome="failed")
             flash('Invalid username or password', 'danger')
     return render_template('login.html')
 
@@ -59,16 +119,14 @@ def logout():
 @app.route('/chat', methods=['GET', 'POST'])
 @login_required
 def chat():
-    # 清理临时上传目录
-    clean_temp_uploads()
-    
     if request.method == 'POST':
         try:
             query = request.form['query']
-            use_deepseek = 'use_deepseek' in request.form
+            use_deepseek = request.form.get('use_deepseek') == 'on'
             
-            # 获取对话历史
-            history = session.get('chat_history', [])
+            # 获取对话历史 (摘要 + 最近几轮)
+            conversation_id = get_conversation_id()
+            history = conversation_store.history(current_user.id, conversation_id)
             
             # 确保知识库是最新的
             rag_system.update_knowledge_base(current_user)
@@ -77,16 +135,22 @@ def chat():
             response, response_time = rag_system.query(query, current_user, history, use_deepseek)
             
             # 更新对话历史
-            history.append((query, response))
-            session['chat_history'] = history[-10:]  # 保留最近10条
+            conversation_store.append(current_user.id, conversation_id, query, response)
             
             return jsonify({
                 'response': response,
-                'response_time': response_time
+                'response_time': response_time,
+                'conversation_id': conversation_id
             })
+        except BackendBusyError as e:
+            # 后端并发和排队都满了, 让客户端稍后重试
+            return jsonify({
+                'response': f"The server is busy, please try again later ({str(e)})",
+                'response_time': "0.00 seconds"
+            }), 503, {'Retry-After': str(Config.BACKEND_QUEUE_TIMEOUT)}
         except Exception as e:
-            # 打印详细错误信息
-            traceback.print_exc()
+            # 记录详细错误信息
+            log_event("chat_failed", level=logging.ERROR, error=str(e), traceback=traceback.format_exc())
             return jsonify({
                 'response': f"An error occurred: {str(e)}",
                 'response_time': "0.00 seconds"
@@ -96,6 +160,111 @@ def chat():
                            username=current_user.id,
                            access_level=current_user.access_level)
 
+@app.route('/chat/stream', methods=['POST'])
+@login_required
+def chat_stream():
+    """以 server-sent events 的形式流式返回回复"""
+    query = request.form['query']
+    use_deepseek = request.form.get('use_deepseek') == 'on'
+    conversation_id = get_conversation_id()
+    user = current_user._get_current_object()
+    history = conversation_store.history(user.id, conversation_id)
+    
+    events = rag_system.stream_query(query, user, history, use_deepseek)
+    try:
+        # 先取第一个事件, 后端繁忙时可以在发送响应头之前返回 503
+        first_event = next(events)
+    except BackendBusyError as e:
+        return jsonify({'error': f"The server is busy, please try again later ({str(e)})"}), 503, \
+            {'Retry-After': str(Config.BACKEND_QUEUE_TIMEOUT)}
+    
+    def generate():
+        for event in itertools.chain([first_event], events):
+            if event['type'] == 'done':
+                # 回复完成后再记录对话历史
+                conversation_store.append(user.id, conversation_id, query, event['response'])
+                event['conversation_id'] = conversation_id
+            yield f"data: {json.dumps(event)}\n\n"
+    
+    return Response(stream_with_context(generate()),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/stats')
+@login_required
+def stats():
+    """连接池、后端并发和 embedding 缓存的使用情况"""
+    return jsonify({
+        'backends': rag_system.client_stats(),
+        'embedding_cache': rag_system.embeddings.stats(),
+        'answer_cache': rag_system.answer_cache.stats(),
+        'ingest_jobs': ingest_queue.stats(),
+        'conversations': conversation_store.stats(),
+        'users': user_manager.stats()
+    })
+
+@app.route('/conversations')
+@login_required
+def list_conversations():
+    """当前用户的对话, 最近更新的在前"""
+    return jsonify({
+        'conversations': conversation_store.list_conversations(current_user.id),
+        'current': session.get('conversation_id')
+    })
+
+@app.route('/conversations/new', methods=['POST'])
+@login_required
+def new_conversation():
+    session['conversation_id'] = uuid.uuid4().hex[:16]
+    return jsonify({'conversation_id': session['conversation_id']})
+
+@app.route('/conversations/<conversation_id>')
+@login_required
+def conversation_turns(conversation_id):
+    """一个对话的完整记录; 同时把它设为当前对话"""
+    if not CONVERSATION_ID_PATTERN.match(conversation_id):
+        return jsonify({'error': 'Conversation not found'}), 404
+    session['conversation_id'] = conversation_id
+    return jsonify({
+        'conversation_id': conversation_id,
+        'turns': conversation_store.turns(current_user.id, conversation_id)
+    })
+
+@app.route('/conversations/<conversation_id>', methods=['DELETE'])
+@login_required
+def delete_conversation(conversation_id):
+    conversation_store.delete(current_user.id, conversation_id)
+    if session.get('conversation_id') == conversation_id:
+        session.pop('conversation_id')
+    return jsonify({'deleted': conversation_id})
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus 文本格式的指标: 各阶段耗时 histogram, 请求/错误/重建计数, 缓存和后端状态"""
+    return Response(REGISTRY.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/jobs')
+@login_required
+def list_jobs():
+    """当前用户可访问的等级最近的索引任务"""
+    levels = [level for level in Config.ACCESS_LEVELS if current_user.has_access(level)]
+    return jsonify({'jobs': ingest_queue.list_jobs(levels), 'stats': ingest_queue.stats()})
+
+@app.route('/jobs/<job_id>')
+@login_required
+def job_status(job_id):
+    """索引任务状态: queued / running / done / failed"""
+    job = ingest_queue.get(job_id)
+    if job is None or not current_user.has_access(job['level']):
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(job)
+
+@app.errorhandler(RequestEntityTooLarge)
+def upload_too_large(e):
+    """上传的文件超过大小上限, 写入已经中止"""
+    flash(f'File too large, the limit is {Config.MAX_FILE_SIZE // 1024 // 1024} MB per file', 'danger')
+    return redirect(url_for('upload_file'))
+
 @app.route('/upload', methods=['GET', 'POST'])
 @login_required
 def upload_file():
@@ -108,19 +277,15 @@ def upload_file():
             flash('You do not have permission for this access level', 'danger')
             return redirect(url_for('upload_file'))
         
-        saved_files = file_manager.save_uploaded_files(files, current_user)
-        
-        # 移动到永久存储
-        uploaded_files = []
-        for file_path in saved_files:
-            perm_path = file_manager.move_to_permanent(file_path, access_level)
-            if perm_path:
-                uploaded_files.append(os.path.basename(perm_path))
-                flash(f'File uploaded successfully: {os.path.basename(perm_path)}', 'success')
-        
-        # 更新知识库
-        if uploaded_files:
-            rag_system.update_knowledge_base(current_user)
+        # 文件已经在解析请求时写入临时文件, 这里原子地移动到等级目录; 索引任务放入后台队列, 请求立即返回
+        for result in file_manager.save_uploaded_files(files, access_level):
+            if result['status'] == 'saved':
+                job_id = ingest_queue.enqueue(access_level, result['path'], current_user.id)
+                flash(f"File uploaded successfully: {result['filename']} (indexing job {job_id})", 'success')
+            elif result['status'] == 'duplicate':
+                flash(f"{result['filename']} has the same content as {os.path.basename(result['path'])}, skipped", 'info')
+            else:
+                flash(f"File rejected: {result['filename']}", 'danger')
         
         return redirect(url_for('chat'))
     
@@ -138,10 +303,15 @@ if __name__ == '__main__':
     for level in Config.ACCESS_LEVELS:
         os.makedirs(os.path.join(Config.DATA_DIR, level), exist_ok=True)
     
-    # 确保用户文件存在
-    user_manager._create_default_users()
-    
     # 确保 ChromaDB 目录存在
     os.makedirs(Config.CHROMA_DB_DIR, exist_ok=True)
     
-    app.run(host='0.0.0.0', port=5001, debug=True)
\ No newline at end of file
+    debug = True
+    # debug 模式下 Werkzeug 的 reloader 有一个只负责重启的父进程, 后台任务只在处理请求的子进程中启动
+    if not debug or os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_tasks()
+        # 可选: 第一个请求不用等索引同步和延迟的导入
+        if Config.WARM_UP_ON_START:
+            rag_system.warm_up()
+    
+    app.run(host='0.0.0.0', port=5001, debug=debug)
\ No newline at end of file
@@ -0,0 +1,212 @@
+# async_runtime.py
+import asyncio
+import queue
+import threading
+import time
+from contextlib import asynccontextmanager
+from config import Config
+from instrumentation import GENERATION_BATCH_SIZE
+
+class BackendBusyError(Exception):
+    """后端并发已满且排队已满 (或排队超时), 调用方应返回 503"""
+
+class BackendLimiter:
+    """限制某个 LLM 后端同时进行的请求数, 超出的请求排队, 队列满或等待超时则拒绝
+
+    只在 AsyncRuntime 的事件循环中使用, 所以计数不需要加锁
+    """
+
+    def __init__(self, name, max_concurrency, max_queue=None, queue_timeout=None):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queue = Config.BACKEND_MAX_QUEUE if max_queue is None else max_queue
+        self.queue_timeout = queue_timeout or Config.BACKEND_QUEUE_TIMEOUT
+        self.in_flight = 0
+        self.waiting = 0
+        self.rejected = 0
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    @asynccontextmanager
+    async def slot(self, priority=0):
+        # priority 只在 GenerationScheduler 中使用
+        # 按已经接纳的请求数判断, 不看 semaphore.locked(): 同一轮循环中到达的请求还没有开始 acquire
+        if self.in_flight + self.waiting >= self.max_concurrency + self.max_queue:
+            self.rejected += 1
+            raise BackendBusyError(f"{self.name} backend is busy ({self.waiting} requests queued)")
+
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise BackendBusyError(f"{self.name} backend is busy (waited {self.queue_timeout} seconds)")
+        finally:
+            self.waiting -= 1
+
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def stats(self):
+        return {
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "max_concurrency": self.max_concurrency
+        }
+
+class _Waiter:
+    def __init__(self, priority, future):
+        self.priority = priority
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+class GenerationScheduler(BackendLimiter):
+    """本地生成的调度器: 代替 FIFO 信号量, 请求进入优先级队列, 按批放行
+
+    - 空闲时新请求先等 batch_window 秒, 同时到达的请求按优先级排好后一批发给模型 (Ollama 的并行槽位会一起处理)
+    - 之后每释放一个名额立即放行队列中优先级最高的请求, 同时进行的请求不超过 max_concurrency
+    - priority 越小越优先 (权限等级的序号); 每等待 GENERATION_PRIORITY_AGING 秒提升一级, 低优先级的请求不会一直被插队
+
+    只在 AsyncRuntime 的事件循环中使用, 所以计数不需要加锁
+    """
+
+    def __init__(self, name, max_concurrency, max_queue=None, queue_timeout=None, batch_window=None):
+        super().__init__(name, max_concurrency, max_queue, queue_timeout)
+        self.batch_window = Config.GENERATION_BATCH_WINDOW if batch_window is None else batch_window
+        self._queue = []
+        self._dispatch_handle = None
+        self.batches = 0
+        self.dispatched = 0
+        self.max_batch = 0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+
+    def _effective_priority(self, waiter, now):
+        return waiter.priority - (now - waiter.enqueued) / Config.GENERATION_PRIORITY_AGING
+
+    def _schedule_dispatch(self, delay):
+        if self._dispatch_handle is None:
+            self._dispatch_handle = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    def _dispatch(self):
+        self._dispatch_handle = None
+        now = time.perf_counter()
+        self._queue = [waiter for waiter in self._queue if not waiter.future.done()]
+        batch = 0
+        while self._queue and self.in_flight < self.max_concurrency:
+            waiter = min(self._queue, key=lambda waiter: self._effective_priority(waiter, now))
+            self._queue.remove(waiter)
+            wait = now - waiter.enqueued
+            self.max_wait = max(self.max_wait, wait)
+            self.total_wait += wait
+            self.in_flight += 1
+            waiter.future.set_result(None)
+            batch += 1
+        self.waiting = len(self._queue)
+        if batch:
+            self.batches += 1
+            self.dispatched += batch
+            self.max_batch = max(self.max_batch, batch)
+            GENERATION_BATCH_SIZE.observe(batch, backend=self.name)
+
+    def _release(self):
+        self.in_flight -= 1
+        if self._queue:
+            # 名额空出来立即放行下一个, 不再等窗口
+            self._schedule_dispatch(0)
+
+    @asynccontextmanager
+    async def slot(self, priority=0):
+        # 批处理窗口内 in_flight 还是 0: 队列中还没放行的请求里, 空闲名额以外的才算排队
+        if len(self._queue) >= self.max_queue + max(0, self.max_concurrency - self.in_flight):
+            self.rejected += 1
+            raise BackendBusyError(f"{self.name} backend is busy ({len(self._queue)} requests queued)")
+
+        waiter = _Waiter(priority, asyncio.get_running_loop().create_future())
+        self._queue.append(waiter)
+        self.waiting = len(self._queue)
+        self._schedule_dispatch(self.batch_window)
+        try:
+            await asyncio.wait_for(waiter.future, self.queue_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise BackendBusyError(f"{self.name} backend is busy (waited {self.queue_timeout} seconds)")
+        except BaseException:
+            # 调用方被取消: 已经分到的名额要还回去
+            if waiter.future.done() and not waiter.future.cancelled():
+                self._release()
+            raise
+        finally:
+            if waiter in self._queue:
+                self._queue.remove(waiter)
+                self.waiting = len(self._queue)
+
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self):
+        stats = super().stats()
+        stats.update({
+            "batch_window": self.batch_window,
+            "batches": self.batches,
+            "dispatched": self.dispatched,
+            "mean_batch": round(self.dispatched / self.batches, 2) if self.batches else 0,
+            "max_batch": self.max_batch,
+            "mean_wait": round(self.total_wait / self.dispatched, 4) if self.dispatched else 0,
+            "max_wait": round(self.max_wait, 4)
+        })
+        return stats
+
+class AsyncRuntime:
+    """在后台线程中运行一个共享的事件循环, 所有请求的 LLM 调用都在这个循环上并发进行"""
+
+    _STOP = object()
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="async-runtime", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """提交协程, 返回 concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def run(self, coro):
+        """在共享循环上运行协程并等待结果 (从请求线程调用)"""
+        return self.submit(coro).result()
+
+    def iterate(self, agen):
+        """把异步生成器转换成普通生成器, 供 Flask 的流式响应使用"""
+        items = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put((item, None))
+            except BaseException as e:
+                items.put((None, e))
+                raise
+            finally:
+                items.put((self._STOP, None))
+
+        future = self.submit(pump())
+        try:
+            while True:
+                item, error = items.get()
+                if error is not None:
+                    raise error
+                if item is self._STOP:
+                    return
+                yield item
+        finally:
+            # 客户端断开时取消还在进行的生成
+            future.cancel()
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
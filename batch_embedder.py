@@ -0,0 +1,71 @@
+# batch_embedder.py
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import requests
+from requests.adapters import HTTPAdapter
+from langchain_core.embeddings import Embeddings
+from config import Config
+from instrumentation import log_event, timed
+
+class OllamaBatchEmbeddings(Embeddings):
+    """通过 Ollama 的 /api/embed 批量接口计算向量, 控制并发请求数, 失败时退避重试"""
+
+    def __init__(self, model=None, base_url=None, batch_size=None, max_in_flight=None,
+                 max_retries=None, retry_backoff=None, timeout=None):
+        self.model = model or Config.OLLAMA_MODEL
+        self.base_url = (base_url or Config.OLLAMA_BASE_URL).rstrip("/")
+        self.batch_size = batch_size or Config.EMBED_BATCH_SIZE
+        self.max_in_flight = max_in_flight or Config.EMBED_MAX_IN_FLIGHT
+        self.max_retries = Config.EMBED_MAX_RETRIES if max_retries is None else max_retries
+        self.retry_backoff = Config.EMBED_RETRY_BACKOFF if retry_backoff is None else retry_backoff
+        self.timeout = timeout or Config.EMBED_TIMEOUT
+
+        # 连接池大小和并发数一致, 复用 keep-alive 连接
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_in_flight)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _embed_batch(self, texts):
+        url = f"{self.base_url}/api/embed"
+        payload = {"model": self.model, "input": texts}
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.post(url, json=payload, timeout=self.timeout)
+                # 4xx 是请求本身的问题, 重试没有意义
+                if response.status_code < 500:
+                    response.raise_for_status()
+                    embeddings = response.json()["embeddings"]
+                    if len(embeddings) != len(texts):
+                        raise ValueError(f"Expected {len(texts)} embeddings, got {len(embeddings)}")
+                    return embeddings
+                error = requests.HTTPError(f"Ollama embed error {response.status_code}: {response.text}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            if attempt < self.max_retries:
+                delay = self.retry_backoff * (2 ** attempt)
+                log_event("embed_retry", level=logging.WARNING, error=str(error), delay=delay)
+                time.sleep(delay)
+        raise error
+
+    def embed_documents(self, texts):
+        if not texts:
+            return []
+        batches = [texts[i:i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        results = [None] * len(batches)
+        with timed("embedding"), ThreadPoolExecutor(max_workers=min(self.max_in_flight, len(batches))) as executor:
+            futures = {executor.submit(self._embed_batch, batch): i for i, batch in enumerate(batches)}
+            done = 0
+            for future in as_completed(futures):
+                i = futures[future]
+                results[i] = future.result()
+                # 每完成一批记录一次进度, 大批量导入时能看到进展
+                done += len(batches[i])
+                log_event("embed_progress", done=done, total=len(texts))
+        log_event("chunks_embedded", chunks=len(texts), batches=len(batches))
+        return [vector for batch in results for vector in batch]
+
+    def embed_query(self, text):
+        with timed("query_embedding"):
+            return self._embed_batch([text])[0]
@@ -0,0 +1,58 @@
+# benchmarks/embedding_benchmark.py
+"""比较逐条 embedding (原来的 LangChain OllamaEmbeddings) 和批量并发 embedding 的吞吐量
+
+用法: python benchmarks/embedding_benchmark.py --chunks 2000 --batch-size 32 --max-in-flight 4
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from langchain_community.embeddings import OllamaEmbeddings
+from batch_embedder import OllamaBatchEmbeddings
+from stub_ollama import StubOllamaServer
+
+def make_chunks(count):
+    return [f"chunk {i}: " + "lorem ipsum dolor sit amet " * 30 for i in range(count)]
+
+def measure(name, embeddings, chunks, server):
+    server.requests = 0
+    start_time = time.time()
+    vectors = embeddings.embed_documents(chunks)
+    elapsed = time.time() - start_time
+    assert len(vectors) == len(chunks)
+    print(f"{name:<12} {len(chunks)} chunks in {elapsed:7.2f} s  "
+          f"{len(chunks) / elapsed:9.1f} chunks/s  {server.requests} requests")
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--chunks", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--max-in-flight", type=int, default=4)
+    parser.add_argument("--request-latency", type=float, default=0.02,
+                        help="stub server overhead per request (seconds)")
+    parser.add_argument("--item-latency", type=float, default=0.002,
+                        help="stub server cost per chunk (seconds)")
+    parser.add_argument("--parallel", type=int, default=4,
+                        help="requests the stub model processes at the same time")
+    args = parser.parse_args()
+
+    server = StubOllamaServer(request_latency=args.request_latency,
+                              item_latency=args.item_latency,
+                              parallel=args.parallel).start()
+    try:
+        chunks = make_chunks(args.chunks)
+        baseline = measure("sequential", OllamaEmbeddings(model="stub", base_url=server.url), chunks, server)
+        batched = measure("batched", OllamaBatchEmbeddings(
+            model="stub", base_url=server.url,
+            batch_size=args.batch_size, max_in_flight=args.max_in_flight
+        ), chunks, server)
+        print(f"Speedup: {baseline / batched:.1f}x")
+    finally:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+# benchmarks/rag_benchmark.py
+"""端到端 RAG 基准测试: 本地模拟的 Ollama / DeepSeek, 合成语料, 结果写入 JSON
+
+测量: 索引吞吐量, 检索延迟 p50/p99, M 个并发用户下 /chat 的端到端延迟, 内存占用.
+不需要 GPU 或网络, 所有数据放在临时目录中.
+
+用法: python benchmarks/rag_benchmark.py --files 300 --users 8 --requests 5 --output results.json
+      python benchmarks/rag_benchmark.py --compare results.json   # 和上一次的结果比较
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from stub_ollama import StubDeepSeekServer, StubOllamaServer
+
+VOCABULARY = (
+    "revenue margin forecast quarter budget audit policy contract supplier invoice payroll "
+    "compliance security incident backup network server latency storage cluster deployment "
+    "customer churn retention pricing discount warehouse inventory shipment logistics "
+    "research patent prototype roadmap milestone hiring onboarding training benefits"
+).split()
+
+# 默认用户 (user_manager.DEFAULT_USERS), 每个等级一个
+USERS = [("root", "admin123"), ("moshu", "admin123"), ("no_user", "no_password")]
+
+def percentile(values, p):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(latencies):
+    return {
+        "count": len(latencies),
+        "mean": round(statistics.mean(latencies), 4) if latencies else None,
+        "p50": round(percentile(latencies, 50), 4) if latencies else None,
+        "p95": round(percentile(latencies, 95), 4) if latencies else None,
+        "p99": round(percentile(latencies, 99), 4) if latencies else None,
+        "max": round(max(latencies), 4) if latencies else None
+    }
+
+def rss_mb():
+    """当前常驻内存 (MB)"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+def peak_rss_mb():
+    # Linux 上 ru_maxrss 的单位是 KB, macOS 上是字节
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+def random_text(rng, words):
+    return " ".join(rng.choice(VOCABULARY) for _ in range(words))
+
+def generate_corpus(data_dir, levels, files, words_per_file, seed):
+    """在各等级目录下生成 files 个文件: 大部分是文本, 每 10 个中有一个 JSON 记录文件"""
+    rng = random.Random(seed)
+    total_bytes = 0
+    for i in range(files):
+        level = levels[i % len(levels)]
+        level_dir = os.path.join(data_dir, level)
+        os.makedirs(level_dir, exist_ok=True)
+        if i % 10 == 9:
+            path = os.path.join(level_dir, f"records_{i:05d}.json")
+            content = json.dumps({
+                f"entity{i}_{j}": {"owner": rng.choice(VOCABULARY), "budget": rng.randint(1, 10000)}
+                for j in range(20)
+            })
+        else:
+            path = os.path.join(level_dir, f"doc_{i:05d}.txt")
+            paragraphs = [random_text(rng, 80) for _ in range(max(1, words_per_file // 80))]
+            content = "\n\n".join(paragraphs)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(content)
+        total_bytes += len(content.encode("utf-8"))
+    return total_bytes
+
+def make_queries(count, seed):
+    rng = random.Random(seed)
+    return [f"What does the {rng.choice(VOCABULARY)} {rng.choice(VOCABULARY)} report say about "
+            f"{rng.choice(VOCABULARY)}? ({i})" for i in range(count)]
+
+def bench_ingestion(rag_system, levels):
+    from instrumentation import STAGE_SECONDS
+    start = time.perf_counter()
+    chunks = 0
+    for level in levels:
+        rag_system.refresh_level(level)
+        chunks += len(rag_system.keyword_indexes[level])
+    elapsed = time.perf_counter() - start
+    files = sum(len(rag_system.file_catalog.files(level)) for level in levels)
+    return {
+        "seconds": round(elapsed, 3),
+        "files": files,
+        "chunks": chunks,
+        "files_per_sec": round(files / elapsed, 2),
+        "chunks_per_sec": round(chunks / elapsed, 2),
+        "stages": stage_totals(STAGE_SECONDS, ("file_listing", "loading", "splitting", "embedding", "index_write"))
+    }
+
+def stage_totals(histogram, stages):
+    totals = {}
+    with histogram._lock:
+        for key, values in histogram._values.items():
+            stage = dict(key).get("stage")
+            if stage in stages:
+                totals[stage] = {"seconds": round(values[-2], 4), "count": values[-1]}
+    return totals
+
+def bench_retrieval(rag_system, user_manager, queries, mode):
+    latencies = []
+    for i, query in enumerate(queries):
+        user = user_manager.get_user(USERS[i % len(USERS)][0])
+        start = time.perf_counter()
+        rag_system.retrieve(query, user, mode=mode)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies)
+
+def bench_chat(base_url, users, requests_per_user, queries, use_deepseek, stream):
+    """users 个线程, 每个线程登录后依次发送 requests_per_user 个问题"""
+    import requests
+
+    latencies = []
+    first_token = []
+    errors = []
+    lock = threading.Lock()
+    barrier = threading.Barrier(users)
+    peak = {"rss_mb": rss_mb()}
+
+    def simulated_user(index):
+        session = requests.Session()
+        username, password = USERS[index % len(USERS)]
+        session.post(f"{base_url}/login", data={"username": username, "password": password})
+        barrier.wait()
+        for r in range(requests_per_user):
+            query = queries[(index * requests_per_user + r) % len(queries)]
+            data = {"query": query}
+            if use_deepseek:
+                data["use_deepseek"] = "on"
+            start = time.perf_counter()
+            try:
+                if stream:
+                    ttft = None
+                    with session.post(f"{base_url}/chat/stream", data=data, stream=True, timeout=600) as response:
+                        response.raise_for_status()
+                        for line in response.iter_lines():
+                            if ttft is None and line.startswith(b"data:"):
+                                ttft = time.perf_counter() - start
+                else:
+                    response = session.post(f"{base_url}/chat", data=data, timeout=600)
+                    response.raise_for_status()
+                    ttft = None
+                elapsed = time.perf_counter() - start
+                with lock:
+                    latencies.append(elapsed)
+                    if ttft is not None:
+                        first_token.append(ttft)
+            except Exception as e:
+                with lock:
+                    errors.append(str(e))
+            with lock:
+                peak["rss_mb"] = max(peak["rss_mb"] or 0, rss_mb() or 0)
+
+    threads = [threading.Thread(target=simulated_user, args=(i,)) for i in range(users)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    result = {
+        "users": users,
+        "requests": len(latencies) + len(errors),
+        "errors": len(errors),
+        "error_samples": errors[:3],
+        "seconds": round(elapsed, 3),
+        "requests_per_sec": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency": summarize(latencies),
+        "peak_rss_mb": peak["rss_mb"]
+    }
+    if stream:
+        result["time_to_first_token"] = summarize(first_token)
+    return result
+
+def compare(previous_path, results):
+    """打印和上一次结果相比的变化 (延迟越低越好, 吞吐量越高越好)"""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    checks = [
+        ("ingestion.chunks_per_sec", True),
+        ("retrieval.p50", False), ("retrieval.p99", False),
+        ("chat.latency.p50", False), ("chat.latency.p99", False), ("chat.requests_per_sec", True),
+        ("memory.peak_rss_mb", False)
+    ]
+    print(f"\nCompared with {previous_path}:")
+    for path, higher_is_better in checks:
+        old, new = previous, results
+        for key in path.split("."):
+            old = old.get(key) if isinstance(old, dict) else None
+            new = new.get(key) if isinstance(new, dict) else None
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        worse = change < 0 if higher_is_better else change > 0
+        marker = "worse" if worse and abs(change) >= 10 else ""
+        print(f"  {path:<28} {old:>10} -> {new:<10} {change:+6.1f}% {marker}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=150, help="synthetic files across the access levels")
+    parser.add_argument("--words", type=int, default=800, help="words per text file")
+    parser.add_argument("--users", type=int, default=8, help="concurrent simulated chat users")
+    parser.add_argument("--requests", type=int, default=5, help="chat requests per user")
+    parser.add_argument("--retrieval-queries", type=int, default=200)
+    parser.add_argument("--retrieval-mode", default="hybrid", choices=["hybrid", "vector", "keyword"])
+    parser.add_argument("--deepseek", action="store_true", help="send chat requests to the DeepSeek stub")
+    parser.add_argument("--stream", action="store_true", help="use /chat/stream and record time to first token")
+    parser.add_argument("--embed-request-latency", type=float, default=0.02)
+    parser.add_argument("--embed-item-latency", type=float, default=0.002)
+    parser.add_argument("--prompt-latency", type=float, default=0.2, help="stub prompt processing time (seconds)")
+    parser.add_argument("--tokens-per-sec", type=float, default=50.0, help="stub generation speed")
+    parser.add_argument("--completion-tokens", type=int, default=64)
+    parser.add_argument("--parallel", type=int, default=4, help="requests each stub model serves at once")
+    parser.add_argument("--ollama-instances", type=int, default=1, help="stub Ollama servers behind the router")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="previous results JSON to compare with")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    args = parser.parse_args()
+
+    chat_options = {
+        "prompt_latency": args.prompt_latency,
+        "tokens_per_sec": args.tokens_per_sec,
+        "completion_tokens": args.completion_tokens
+    }
+    ollama_servers = [
+        StubOllamaServer(request_latency=args.embed_request_latency, item_latency=args.embed_item_latency,
+                         parallel=args.parallel, **chat_options).start()
+        for _ in range(args.ollama_instances)
+    ]
+    ollama = ollama_servers[0]
+    deepseek = StubDeepSeekServer(**chat_options).start()
+
+    # 所有数据 (data/, 索引, 缓存, 用户表) 都放在临时目录中; 必须在导入应用模块之前设置
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    os.environ["HOME"] = workdir
+    os.chdir(workdir)
+    memory = {"start_rss_mb": rss_mb()}
+
+    from config import Config
+    Config.OLLAMA_BASE_URL = ollama.url
+    Config.OLLAMA_BASE_URLS = [server.url for server in ollama_servers]
+    Config.OLLAMA_MAX_CONCURRENCY = args.parallel
+    Config.DEEPSEEK_API_URL = deepseek.api_url
+    Config.DEEPSEEK_API_KEY = "benchmark"
+    Config.RETRIEVAL_MODE = args.retrieval_mode
+    # 每个请求都是不同的问题, 回复缓存不会命中; 结构化直接回答也关掉, 测的是完整的生成路径
+    Config.STRUCTURED_QUERY_MODE = "inject"
+    Config.WATCH_BACKEND = "poll"
+    Config.WATCH_POLL_INTERVAL = 3600
+
+    corpus_bytes = generate_corpus(Config.DATA_DIR, Config.ACCESS_LEVELS, args.files, args.words, args.seed)
+
+    Config.LOG_LEVEL = "WARNING"
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    import app as app_module
+    from werkzeug.serving import make_server
+    rag_system = app_module.rag_system
+    memory["after_import_rss_mb"] = rss_mb()
+
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": dict(vars(args), corpus_bytes=corpus_bytes)
+    }
+    try:
+        print(f"Indexing {args.files} files ({corpus_bytes / 1024 / 1024:.1f} MB)...")
+        results["ingestion"] = bench_ingestion(rag_system, Config.ACCESS_LEVELS)
+        memory["after_ingestion_rss_mb"] = rss_mb()
+
+        print(f"Running {args.retrieval_queries} retrievals ({args.retrieval_mode})...")
+        results["retrieval"] = bench_retrieval(rag_system, app_module.user_manager,
+                                               make_queries(args.retrieval_queries, args.seed), args.retrieval_mode)
+
+        server = make_server("127.0.0.1", 0, app_module.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f"http://127.0.0.1:{server.server_port}"
+        print(f"Running {args.users} users x {args.requests} chat requests...")
+        results["chat"] = bench_chat(base_url, args.users, args.requests,
+                                     make_queries(args.users * args.requests, args.seed + 1), args.deepseek, args.stream)
+        server.shutdown()
+
+        memory["end_rss_mb"] = rss_mb()
+        memory["peak_rss_mb"] = peak_rss_mb()
+        results["memory"] = memory
+        results["stub_requests"] = {"ollama": [server.requests for server in ollama_servers], "deepseek": deepseek.requests}
+        results["scheduler"] = rag_system.limiters["ollama"].stats()
+        results["router"] = {
+            key: value for key, value in rag_system.router.stats().items() if key != "endpoints"
+        }
+    finally:
+        for server in ollama_servers:
+            server.stop()
+        deepseek.stop()
+        os.chdir(REPO_DIR)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = os.path.abspath(os.path.join(REPO_DIR, args.output)) if not os.path.isabs(args.output) else args.output
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps({key: results[key] for key in ("ingestion", "retrieval", "chat", "memory")}, indent=2))
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(args.compare, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+# benchmarks/startup_benchmark.py
+"""冷启动基准测试: 在新进程中测量导入 app 的时间和第一个请求的延迟, 结果写入 JSON
+
+每次测量都是一个新的 Python 进程 (本地模拟的 Ollama, 临时目录中已经建好索引, 相当于服务重启),
+记录: 导入 config / app 的时间, 可选的预热时间, 第一次登录和第一、二次 /chat 的延迟,
+导入后和第一个请求后已经加载的重量级模块, 内存占用.
+
+--repo 可以指向另一个检出的版本, 用来比较修改前后:
+      git worktree add /tmp/before <commit>
+      python benchmarks/startup_benchmark.py --repo /tmp/before --output before.json
+      python benchmarks/startup_benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, BENCHMARK_DIR)
+
+from stub_ollama import StubOllamaServer
+
+# 导入或首次使用时耗时较多的依赖
+HEAVY_MODULES = [
+    "chromadb",
+    "langchain_community.vectorstores.chroma",
+    "langchain.prompts",
+    "langchain_text_splitters",
+    "langchain_community.document_loaders.pdf",
+    "langchain_community.document_loaders.excel",
+    "tiktoken",
+    "httpx",
+    "requests",
+    "numpy",
+    "pandas"
+]
+
+# 在子进程中执行: 设置 Config 之后导入 app, 用 Flask test client 发请求, 最后一行输出 JSON
+CHILD_SCRIPT = r"""
+import json, resource, sys, time
+start = time.perf_counter()
+sys.path.insert(0, REPO)
+from config import Config
+for key, value in OVERRIDES.items():
+    setattr(Config, key, value)
+config_seconds = time.perf_counter() - start
+import app as app_module
+import_seconds = time.perf_counter() - start
+loaded = lambda: sorted(name for name in HEAVY if name in sys.modules)
+result = {"config_seconds": config_seconds, "import_seconds": import_seconds,
+          "modules": len(sys.modules), "heavy_after_import": loaded()}
+
+if PRIME:
+    # 建好各等级的索引 (writer 角色时同时发布快照), 之后的测量都是在已有索引上启动
+    for level in Config.ACCESS_LEVELS:
+        app_module.rag_system.get_vectorstore(level)
+else:
+    if WARM_UP:
+        if hasattr(app_module.rag_system, "warm_up"):
+            warm_start = time.perf_counter()
+            app_module.rag_system.warm_up()
+            result["warm_up_seconds"] = time.perf_counter() - warm_start
+        else:
+            result["warm_up_seconds"] = None
+    client = app_module.app.test_client()
+    timings = {}
+    request_start = time.perf_counter()
+    response = client.post("/login", data={"username": "root", "password": "admin123"})
+    timings["first_login_seconds"] = time.perf_counter() - request_start
+    for name, query in (("first_chat_seconds", "What does the budget report say?"),
+                        ("second_chat_seconds", "Summarize the security incident notes")):
+        request_start = time.perf_counter()
+        response = client.post("/chat", data={"query": query})
+        timings[name] = time.perf_counter() - request_start
+        assert response.status_code == 200, response.status_code
+    result.update(timings)
+    result["ready_seconds"] = import_seconds + (result.get("warm_up_seconds") or 0)
+    result["first_response_seconds"] = result["ready_seconds"] + timings["first_login_seconds"] + timings["first_chat_seconds"]
+    result["heavy_after_requests"] = loaded()
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+result["peak_rss_mb"] = round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+print("RESULT " + json.dumps(result), flush=True)
+import os
+os._exit(0)
+"""
+
+def write_corpus(data_dir, levels, files):
+    for i in range(files):
+        level = levels[i % len(levels)]
+        os.makedirs(os.path.join(data_dir, level), exist_ok=True)
+        with open(os.path.join(data_dir, level, f"doc_{i:04d}.txt"), "w") as f:
+            f.write(f"Budget report {i}: the security incident review and supplier invoices for quarter {i % 4}.\n" * 20)
+
+def run_child(repo, workdir, overrides, prime=False, warm_up=False):
+    script = "\n".join([
+        f"REPO = {repo!r}",
+        f"OVERRIDES = {overrides!r}",
+        f"HEAVY = {HEAVY_MODULES!r}",
+        f"PRIME = {prime!r}",
+        f"WARM_UP = {warm_up!r}",
+        CHILD_SCRIPT
+    ])
+    env = dict(os.environ, HOME=workdir, PYTHONDONTWRITEBYTECODE="1")
+    start = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", script], cwd=workdir, env=env, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    lines = [line for line in completed.stdout.splitlines() if line.startswith("RESULT ")]
+    if completed.returncode != 0 or not lines:
+        raise RuntimeError(f"benchmark process failed ({completed.returncode}):\n{completed.stderr[-3000:]}")
+    result = json.loads(lines[-1][len("RESULT "):])
+    result["process_seconds"] = wall
+    return result
+
+def python_startup_seconds(runs=3):
+    """空的 Python 进程的启动时间, 作为参照"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def aggregate(runs):
+    """数值取中位数, 模块列表取第一次测量的"""
+    summary = {}
+    for key, value in runs[0].items():
+        values = [run[key] for run in runs if isinstance(run.get(key), (int, float))]
+        if isinstance(value, (int, float)) and values:
+            summary[key] = round(statistics.median(values), 4)
+        else:
+            summary[key] = value
+    return summary
+
+def compare(previous_path, results):
+    """打印和上一次结果相比的变化 (都是越低越好)"""
+    with open(previous_path) as f:
+        previous = json.load(f)
+    print(f"\nCompared with {previous_path}:")
+    for key in ("import_seconds", "warm_up_seconds", "ready_seconds", "first_login_seconds", "first_chat_seconds",
+                "second_chat_seconds", "first_response_seconds", "process_seconds", "peak_rss_mb", "modules"):
+        old = previous["startup"].get(key)
+        new = results["startup"].get(key)
+        if not old or new is None:
+            continue
+        change = (new - old) / old * 100
+        print(f"  {key:<24} {old:>10} -> {new:<10} {change:+6.1f}%")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repo", default=REPO_DIR, help="checkout to measure (default: this repository)")
+    parser.add_argument("--runs", type=int, default=5, help="fresh processes to measure")
+    parser.add_argument("--files", type=int, default=30, help="synthetic files indexed before the measurements")
+    parser.add_argument("--role", default="standalone", choices=["standalone", "worker"],
+                        help="worker: measure a multi-process worker reading the writer's snapshot")
+    parser.add_argument("--warm-up", action="store_true", help="call rag_system.warm_up() before the first request")
+    parser.add_argument("--output", default="startup_results.json")
+    parser.add_argument("--compare", help="previous results JSON to compare with")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary working directory")
+    args = parser.parse_args()
+
+    ollama = StubOllamaServer(prompt_latency=0.01, tokens_per_sec=1000, completion_tokens=8).start()
+    workdir = tempfile.mkdtemp(prefix="rag-startup-")
+    repo = os.path.abspath(args.repo)
+    overrides = {
+        "OLLAMA_BASE_URL": ollama.url,
+        "OLLAMA_BASE_URLS": [ollama.url],
+        "LOG_LEVEL": "WARNING",
+        "WATCH_BACKEND": "poll",
+        "WATCH_POLL_INTERVAL": 3600,
+        "STRUCTURED_QUERY_MODE": "off"
+    }
+    results = {
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "config": dict(vars(args), repo=repo)
+    }
+    try:
+        write_corpus(os.path.join(workdir, "data"), ["high", "med", "low"], args.files)
+        print(f"Indexing {args.files} files in {workdir}...")
+        prime_role = "writer" if args.role == "worker" else "standalone"
+        run_child(repo, workdir, dict(overrides, SERVING_ROLE=prime_role), prime=True)
+
+        runs = []
+        for i in range(args.runs):
+            run = run_child(repo, workdir, dict(overrides, SERVING_ROLE=args.role), warm_up=args.warm_up)
+            print(f"  run {i + 1}: import {run['import_seconds']:.3f}s, first chat {run['first_chat_seconds']:.3f}s")
+            runs.append(run)
+        results["python_startup_seconds"] = round(python_startup_seconds(), 4)
+        results["startup"] = aggregate(runs)
+        results["runs"] = runs
+    finally:
+        ollama.stop()
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    output = os.path.abspath(os.path.join(REPO_DIR, args.output)) if not os.path.isabs(args.output) else args.output
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(results["startup"], indent=2))
+    print(f"Results written to {output}")
+    if args.compare:
+        compare(args.compare, results)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+# benchmarks/stub_ollama.py
+"""本地的 Ollama / DeepSeek 模拟服务器, 用于在没有 GPU / 网络的机器上做基准测试"""
+import hashlib
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+def fake_embedding(text, dim):
+    """根据文本 hash 生成确定性的向量"""
+    seed = hashlib.sha256(text.encode("utf-8")).digest()
+    return [seed[i % len(seed)] / 255.0 for i in range(dim)]
+
+def fake_tokens(messages, count):
+    """确定性的回复 token, 内容取决于最后一条消息"""
+    words = (messages[-1].get("content", "") if messages else "").split() or ["ok"]
+    return [f"{words[i % len(words)]} " for i in range(count)]
+
+class StubChatMixin:
+    """模拟生成: 先处理 prompt (prompt_latency), 再按 tokens_per_sec 逐个输出 completion_tokens 个 token"""
+
+    def _generate(self, messages, emit):
+        server = self.server
+        with server.model_slots:
+            time.sleep(server.prompt_latency)
+            for token in fake_tokens(messages, server.completion_tokens):
+                time.sleep(1.0 / server.tokens_per_sec)
+                emit(token)
+
+    def _start_stream(self, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def _write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def _end_stream(self):
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+class StubOllamaHandler(StubChatMixin, BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _simulate(self, items):
+        """每个请求有固定开销, 每个文本块有额外计算时间; 模型同一时间只处理有限个请求"""
+        server = self.server
+        with server.model_slots:
+            time.sleep(server.request_latency + server.item_latency * items)
+
+    def do_GET(self):
+        # 健康检查
+        if self.path == "/api/version":
+            self._send_json({"version": "stub"})
+        else:
+            self._send_json({"error": f"unknown path {self.path}"}, status=404)
+
+    def do_POST(self):
+        server = self.server
+        payload = self._read_json()
+        server.requests += 1
+        if self.path == "/api/embed":
+            texts = payload.get("input", [])
+            if isinstance(texts, str):
+                texts = [texts]
+            self._simulate(len(texts))
+            self._send_json({
+                "model": payload.get("model"),
+                "embeddings": [fake_embedding(text, server.dim) for text in texts]
+            })
+        elif self.path == "/api/embeddings":
+            # 旧的单条接口, LangChain OllamaEmbeddings 使用这个
+            self._simulate(1)
+            self._send_json({"embedding": fake_embedding(payload.get("prompt", ""), server.dim)})
+        elif self.path == "/api/chat":
+            self._chat(payload)
+        else:
+            self._send_json({"error": f"unknown path {self.path}"}, status=404)
+
+    def _chat(self, payload):
+        """Ollama /api/chat: 流式时每行一个 JSON"""
+        messages = payload.get("messages", [])
+        model = payload.get("model")
+        if not payload.get("stream", True):
+            parts = []
+            self._generate(messages, parts.append)
+            self._send_json({"model": model, "message": {"role": "assistant", "content": "".join(parts)}, "done": True})
+            return
+        self._start_stream("application/x-ndjson")
+        self._generate(messages, lambda token: self._write_chunk(json.dumps({
+            "model": model, "message": {"role": "assistant", "content": token}, "done": False
+        }).encode("utf-8") + b"\n"))
+        self._write_chunk(json.dumps({"model": model, "done": True}).encode("utf-8") + b"\n")
+        self._end_stream()
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, handler, port=0, parallel=4, prompt_latency=0.2, tokens_per_sec=50.0, completion_tokens=64):
+        super().__init__(("127.0.0.1", port), handler)
+        self.model_slots = threading.BoundedSemaphore(parallel)
+        self.prompt_latency = prompt_latency
+        self.tokens_per_sec = tokens_per_sec
+        self.completion_tokens = completion_tokens
+        self.requests = 0
+
+    def handle_error(self, request, client_address):
+        # 客户端取消请求 (超时换端点或对冲请求) 时连接被关闭, 不打印
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class StubOllamaServer(StubServer):
+    """embed: request_latency + item_latency * 文本块数; chat: prompt_latency + completion_tokens / tokens_per_sec"""
+
+    def __init__(self, port=0, request_latency=0.02, item_latency=0.002, parallel=4, dim=64, **chat_options):
+        super().__init__(StubOllamaHandler, port=port, parallel=parallel, **chat_options)
+        self.request_latency = request_latency
+        self.item_latency = item_latency
+        self.dim = dim
+
+class StubDeepSeekHandler(StubChatMixin, BaseHTTPRequestHandler):
+    """DeepSeek (OpenAI 兼容) /chat/completions: 流式时是 server-sent events"""
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        self.server.requests += 1
+        payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        messages = payload.get("messages", [])
+        if not payload.get("stream"):
+            parts = []
+            self._generate(messages, parts.append)
+            body = json.dumps({"choices": [{"message": {"role": "assistant", "content": "".join(parts)}}]}).encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self._start_stream("text/event-stream")
+        self._generate(messages, lambda token: self._write_chunk(
+            b"data: " + json.dumps({"choices": [{"delta": {"content": token}}]}).encode("utf-8") + b"\n\n"
+        ))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self._end_stream()
+
+class StubDeepSeekServer(StubServer):
+    def __init__(self, port=0, parallel=16, **chat_options):
+        super().__init__(StubDeepSeekHandler, port=port, parallel=parallel, **chat_options)
+
+    @property
+    def api_url(self):
+        return f"{self.url}/chat/completions"
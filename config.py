@@ -1,37 +1,154 @@
 # config.py
 import os
-from pathlib import Path
 
 class Config:
     # Ollama 配置
     OLLAMA_MODEL = "llama3"  # 本地运行的模型
     OLLAMA_BASE_URL = "http://localhost:11434"
+    # 所有 Ollama 实例的地址, 生成请求分配给正在处理的请求最少的健康实例
+    OLLAMA_BASE_URLS = [OLLAMA_BASE_URL]
     
     # DeepSeek API 配置
     DEEPSEEK_API_KEY = ""  # 可以留空，不使用DeepSeek
+    DEEPSEEK_API_URL = "https://api.deepseek.com/chat/completions"
+    
+    # LLM HTTP 客户端: 连接/读取超时(秒), 连接池大小, keep-alive 连接数, 未被处理的请求重试次数
+    LLM_CONNECT_TIMEOUT = 10
+    LLM_READ_TIMEOUT = 600
+    LLM_MAX_CONNECTIONS = 20
+    LLM_MAX_KEEPALIVE = 10
+    LLM_MAX_RETRIES = 2
+    
+    # 后端并发: 每个后端同时进行的生成请求数, 排队上限和排队超时(秒), 超出返回 503
+    OLLAMA_MAX_CONCURRENCY = 2
+    DEEPSEEK_MAX_CONCURRENCY = 8
+    BACKEND_MAX_QUEUE = 16
+    BACKEND_QUEUE_TIMEOUT = 60
+    # 本地生成调度: 收集同时到达请求的时间窗口(秒), 是否按权限等级排优先级 (high 最先),
+    # 等待多少秒提升一级优先级
+    GENERATION_BATCH_WINDOW = 0.02
+    GENERATION_PRIORITY_BY_LEVEL = True
+    GENERATION_PRIORITY_AGING = 30
+    
+    # LLM 路由: 等待首个 token 的超时(秒), 超时或出错时换下一个端点, 最多尝试几个端点;
+    # 一个后端的端点都失败时换另一个后端 (Ollama <-> DeepSeek, 需要配置 DeepSeek API key)
+    LLM_FIRST_TOKEN_TIMEOUT = 120
+    LLM_MAX_ATTEMPTS = 3
+    LLM_FAILOVER = True
+    # 对冲请求: 首个 token 的等待时间超过该端点最近延迟的这个百分位时, 在另一个空闲端点上再发一次, 用先返回的; 0 表示关闭
+    LLM_HEDGE_PERCENTILE = 0
+    LLM_HEDGE_MIN_SAMPLES = 20
+    LLM_LATENCY_WINDOW = 200
+    # 健康检查间隔(秒), 0 表示关闭; 连续失败这么多次的端点标记为不健康, 直到健康检查通过
+    LLM_HEALTH_INTERVAL = 15
+    LLM_UNHEALTHY_AFTER = 3
     
     # 文件设置
     ALLOWED_EXTENSIONS = {'txt', 'pdf', 'docx', 'doc', 'json', 'csv', 'xlsx', 'xls', 'md'}
     MAX_FILE_SIZE = 2 * 1024 * 1024  # 2MB
     MAX_FILES = 2
+    # 上传按块写入临时文件的块大小; 临时文件超过这个时间(秒)未修改才会被后台清理, 清理间隔(秒)
+    UPLOAD_CHUNK_SIZE = 64 * 1024
+    UPLOAD_TEMP_MAX_AGE = 3600
+    UPLOAD_SWEEP_INTERVAL = 600
     
     # 路径设置
     DATA_DIR = "data"
     UPLOAD_DIR = "temp_uploads"
     
+    # 部署方式: "standalone" 单进程 (python app.py); 多进程部署 (gunicorn -c gunicorn.conf.py app:app) 中
+    # "writer" 进程负责索引并发布只读快照, "worker" 进程只读快照处理请求, 上传只提交索引任务
+    SERVING_ROLE = "standalone"
+    SERVING_BIND = "0.0.0.0:5001"
+    SERVING_WORKERS = 4
+    SERVING_THREADS = 8
+    # python app.py 启动时先预热 (打开索引, 完成延迟的导入, 连接后端) 再接收请求; 多进程部署的 worker 总是预热
+    WARM_UP_ON_START = False
+    
     # 安全设置
     SECRET_KEY = "supersecretkey"
     
+    # 结构化日志 (每行一个 JSON) 的级别
+    LOG_LEVEL = "INFO"
+    
+    # 用户表 (SQLite, 密码保存加盐 hash; 首次启动时从 users.json 导入), 内存中缓存的用户数
+    USER_DB_PATH = "users.sqlite3"
+    USER_CACHE_SIZE = 10000
+    
     # 权限等级
     ACCESS_LEVELS = ["high", "med", "low"]
     
     # RAG 设置
     CHUNK_SIZE = 1000
     CHUNK_OVERLAP = 200
+    # 并行加载/切分文件的进程数 (1 表示在当前进程中顺序处理)
+    INGEST_WORKERS = min(4, os.cpu_count() or 1)
     
-    # ChromaDB 外部存储路径 (用户主目录下的 .chroma_db)
-    CHROMA_DB_DIR = str(Path.home() / ".chroma_db")
- 
+    # Prompt 预算 (token, 用 tiktoken 计数): 整个 prompt 的上限, 历史对话的上限, 每条历史消息的上限
+    TOKENIZER_ENCODING = "cl100k_base"
+    PROMPT_TOKEN_BUDGET = 3000
+    HISTORY_TOKEN_BUDGET = 800
+    HISTORY_TURN_MAX_TOKENS = 200
+    # 上下文去重的相似度阈值 (3 词 shingle 的 Jaccard), 是否按问题词覆盖率重排
+    CONTEXT_NEAR_DUPLICATE_THRESHOLD = 0.9
+    CONTEXT_RERANK = False
     
-    # 确保 ChromaDB 目录存在
-    os.makedirs(CHROMA_DB_DIR, exist_ok=True)
\ No newline at end of file
+    # ChromaDB 外部存储路径 (用户主目录下的 .chroma_db); 目录由用到它的组件创建, 导入配置时不访问文件系统
+    CHROMA_DB_DIR = os.path.join(os.path.expanduser("~"), ".chroma_db")
+    # 每个权限等级一个 collection: kb_high / kb_med / kb_low
+    CHROMA_COLLECTION_PREFIX = "kb"
+    # Embedding 缓存 (SQLite), 按 (模型名, 文本 hash) 存储, 超过上限按 LRU 淘汰
+    EMBEDDING_CACHE_PATH = os.path.join(CHROMA_DB_DIR, "embedding_cache.sqlite3")
+    EMBEDDING_CACHE_MAX_ENTRIES = 200000
+    # 批量 embedding: 每个请求的文档块数量, 同时进行的请求数, 重试次数和退避时间(秒)
+    EMBED_BATCH_SIZE = 32
+    EMBED_MAX_IN_FLIGHT = 4
+    EMBED_MAX_RETRIES = 3
+    EMBED_RETRY_BACKOFF = 0.5
+    EMBED_TIMEOUT = 300
+    # 回复缓存: 最大条数, 过期时间(秒); 语义模式下问题向量的余弦相似度达到阈值也算命中
+    ANSWER_CACHE_MAX_ENTRIES = 1000
+    ANSWER_CACHE_TTL = 3600
+    ANSWER_CACHE_SEMANTIC = False
+    ANSWER_CACHE_SIMILARITY = 0.95
+    # 后台索引任务: worker 线程数, 任务表 (SQLite), 已完成任务的保留时间(秒)
+    INGEST_QUEUE_WORKERS = 2
+    INGEST_JOBS_DB_PATH = os.path.join(CHROMA_DB_DIR, "ingest_jobs.sqlite3")
+    INGEST_JOB_RETENTION = 7 * 24 * 3600
+    # 其他进程提交的任务通过轮询发现, 轮询间隔(秒)
+    INGEST_POLL_INTERVAL = 1.0
+    # 多进程部署的只读索引快照: 目录, 保留的代数, worker 检查新一代的间隔(秒)
+    SNAPSHOT_DIR = os.path.join(CHROMA_DB_DIR, "snapshots")
+    SNAPSHOT_KEEP = 3
+    SNAPSHOT_POLL_INTERVAL = 1.0
+    # 监视 DATA_DIR 的文件变化: "auto" 有 watchdog 时用系统事件 (inotify), 否则定时扫描; "poll" 总是定时扫描
+    WATCH_BACKEND = "auto"
+    # 最后一次变化后等待多久(秒)再提交索引任务, 定时扫描的间隔(秒)
+    WATCH_DEBOUNCE = 2.0
+    WATCH_POLL_INTERVAL = 5
+    # 对话记录 (SQLite, 按用户和对话 ID), 内存中缓存最近使用的对话数
+    CONVERSATION_DB_PATH = os.path.join(CHROMA_DB_DIR, "conversations.sqlite3")
+    CONVERSATION_CACHE_SIZE = 1000
+    # 原样传给模型的最近轮数, 更早的折叠成摘要 (最多保留的摘要行数, 每行问题/回复的字符数)
+    CONVERSATION_RECENT_TURNS = 6
+    CONVERSATION_SUMMARY_LINES = 10
+    CONVERSATION_SUMMARY_QUERY_CHARS = 100
+    CONVERSATION_SUMMARY_ANSWER_CHARS = 200
+    # 对话保留时间(秒), 每个用户最多保留的对话数, 清理过期对话的间隔(秒)
+    CONVERSATION_RETENTION = 30 * 24 * 3600
+    CONVERSATION_MAX_PER_USER = 50
+    CONVERSATION_PRUNE_INTERVAL = 3600
+    # 结构化数据: 这些扩展名的文件同时写入实体/字段表 (SQLite)
+    STRUCTURED_EXTENSIONS = {'json', 'csv', 'xlsx', 'xls'}
+    STRUCTURED_DB_PATH = os.path.join(CHROMA_DB_DIR, "structured.sqlite3")
+    # "direct": 问题中的实体和字段都能找到时直接回答, 不调用 LLM; "inject": 只把匹配的记录放进 prompt; "off": 不使用
+    STRUCTURED_QUERY_MODE = "direct"
+    # 检索返回的文档块数量
+    RETRIEVAL_K = 3
+    # 检索方式: "hybrid" (BM25 + 向量), "vector", "keyword" (不调用 embedding 模型)
+    RETRIEVAL_MODE = "hybrid"
+    # 每种检索方式先取的候选数量, 再按加权 reciprocal rank fusion 合并
+    RETRIEVAL_CANDIDATES = 10
+    HYBRID_VECTOR_WEIGHT = 1.0
+    HYBRID_KEYWORD_WEIGHT = 1.0
+    HYBRID_RRF_K = 60
@@ -0,0 +1,153 @@
+# context_builder.py
+import hashlib
+import logging
+import re
+import threading
+from config import Config
+from keyword_index import tokenize
+from instrumentation import log_event
+
+class TokenCounter:
+    """基于 tiktoken 的 token 计数; 编码文件无法加载时(例如离线)按 4 个字符一个 token 估算
+
+    编码在第一次计数时才加载 (可能需要下载编码文件), 不拖慢启动
+    """
+
+    def __init__(self, encoding_name=None):
+        self.encoding_name = encoding_name or Config.TOKENIZER_ENCODING
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def encoding(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    try:
+                        import tiktoken
+                        self._encoding = tiktoken.get_encoding(self.encoding_name)
+                    except Exception as e:
+                        log_event("tokenizer_unavailable", level=logging.WARNING, error=str(e))
+                    self._loaded = True
+        return self._encoding
+
+    def count(self, text):
+        if not text:
+            return 0
+        if self.encoding is not None:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return (len(text) + 3) // 4
+
+    def truncate(self, text, max_tokens):
+        if max_tokens <= 0:
+            return ""
+        if self.count(text) <= max_tokens:
+            return text
+        # 给结尾的 " ..." 留出位置
+        if self.encoding is not None:
+            return self.encoding.decode(self.encoding.encode(text, disallowed_special=())[:max(max_tokens - 2, 0)]) + " ..."
+        return text[:max(max_tokens - 1, 0) * 4] + " ..."
+
+def _shingles(text, size=3):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < size:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def dedupe(docs, threshold=None):
+    """去掉完全相同和高度相似 (shingle Jaccard 相似度达到阈值) 的文档块, 保留排名靠前的"""
+    threshold = threshold or Config.CONTEXT_NEAR_DUPLICATE_THRESHOLD
+    kept = []
+    seen_hashes = set()
+    kept_shingles = []
+    for doc in docs:
+        normalized = re.sub(r"\s+", " ", doc.page_content).strip()
+        digest = hashlib.sha1(normalized.encode("utf-8")).hexdigest()
+        if digest in seen_hashes:
+            continue
+        shingles = _shingles(normalized)
+        if any(len(shingles & other) / len(shingles | other) >= threshold for other in kept_shingles):
+            continue
+        seen_hashes.add(digest)
+        kept_shingles.append(shingles)
+        kept.append(doc)
+    return kept
+
+def rerank(query, docs):
+    """按问题词在文档块中的覆盖率重新排序, 覆盖率相同时保持原来的顺序"""
+    terms = set(tokenize(query))
+    if not terms:
+        return docs
+    def coverage(doc):
+        return len(terms & set(tokenize(doc.page_content))) / len(terms)
+    return sorted(docs, key=coverage, reverse=True)
+
+class ContextBuilder:
+    """把检索到的文档块和对话历史装进固定的 token 预算"""
+
+    def __init__(self, template="", budget=None, history_budget=None, turn_max_tokens=None, rerank=None):
+        self.counter = TokenCounter()
+        self.template = template
+        self._template_tokens = None
+        self.budget = budget or Config.PROMPT_TOKEN_BUDGET
+        self.history_budget = history_budget or Config.HISTORY_TOKEN_BUDGET
+        self.turn_max_tokens = turn_max_tokens or Config.HISTORY_TURN_MAX_TOKENS
+        self.rerank = Config.CONTEXT_RERANK if rerank is None else rerank
+
+    @property
+    def template_tokens(self):
+        if self._template_tokens is None:
+            self._template_tokens = self.counter.count(self.template)
+        return self._template_tokens
+
+    def _pack_history(self, history, budget):
+        """从最近的对话开始放入, 过长的回复截断, 放不下的更早的对话丢弃"""
+        packed = []
+        used = 0
+        for user_msg, ai_msg in reversed(history or []):
+            user_msg = self.counter.truncate(user_msg, self.turn_max_tokens)
+            ai_msg = self.counter.truncate(ai_msg, self.turn_max_tokens)
+            tokens = self.counter.count(user_msg) + self.counter.count(ai_msg)
+            if used + tokens > budget:
+                break
+            packed.append((user_msg, ai_msg))
+            used += tokens
+        packed.reverse()
+        return packed, used
+
+    def build(self, query, docs, history):
+        """返回 (上下文字符串, 压缩后的历史, 统计信息)"""
+        docs = dedupe(docs)
+        if self.rerank:
+            docs = rerank(query, docs)
+
+        remaining = self.budget - self.template_tokens - self.counter.count(query)
+        packed_history, history_tokens = self._pack_history(history, min(self.history_budget, max(remaining, 0)))
+        remaining -= history_tokens
+
+        chunks = []
+        context_tokens = 0
+        separator_tokens = self.counter.count("\n\n")
+        for doc in docs:
+            if remaining <= 0:
+                break
+            text = doc.page_content
+            tokens = self.counter.count(text)
+            if tokens + separator_tokens > remaining:
+                # 预算不够放下整个文档块, 截断最后一块
+                text = self.counter.truncate(text, remaining - separator_tokens)
+                tokens = self.counter.count(text)
+            chunks.append(text)
+            context_tokens += tokens + separator_tokens
+            remaining -= tokens + separator_tokens
+
+        stats = {
+            "chunks": len(chunks),
+            "context_tokens": context_tokens,
+            "history_turns": len(packed_history),
+            "history_tokens": history_tokens,
+            "prompt_tokens": self.template_tokens + self.counter.count(query) + history_tokens + context_tokens,
+            "budget": self.budget
+        }
+        return "\n\n".join(chunks), packed_history, stats
@@ -0,0 +1,235 @@
+# conversation_store.py
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from config import Config
+
+SUMMARY_TURN_LABEL = "(Summary of the earlier conversation)"
+
+def summarize_turn(query, response):
+    """一轮对话的摘要行: 问题和回复的第一句, 都截断 (不调用 LLM, 不占用生成名额)"""
+    query = re.sub(r"\s+", " ", query).strip()
+    response = re.sub(r"\s+", " ", response).strip()
+    first_sentence = re.split(r"(?<=[.!?。！？])\s", response, maxsplit=1)[0]
+    query = query[:Config.CONVERSATION_SUMMARY_QUERY_CHARS]
+    answer = first_sentence[:Config.CONVERSATION_SUMMARY_ANSWER_CHARS]
+    return f"- Q: {query} A: {answer}"
+
+class _Conversation:
+    """缓存中的一个对话: 滚动摘要 + 还没有折叠进摘要的最近几轮"""
+
+    def __init__(self, summary, summarized_upto, turns, next_seq):
+        self.summary = summary
+        self.summarized_upto = summarized_upto
+        self.turns = turns   # [(seq, query, response)]
+        self.next_seq = next_seq
+
+class ConversationStore:
+    """服务端的对话记录, 按 (用户, 对话 ID) 保存在 SQLite 中, 前面是内存 LRU (只缓存最近几轮和摘要, 命中时仍核对轮数)
+
+    - 每轮对话只追加一行, 不重写整个历史
+    - 超过 CONVERSATION_RECENT_TURNS 的旧对话折叠成滚动摘要, history() 返回摘要 + 最近几轮
+    - 超过 CONVERSATION_RETENTION 没有更新的对话删除, 每个用户最多保留 CONVERSATION_MAX_PER_USER 个对话
+    """
+
+    def __init__(self, db_path=None, cache_size=None):
+        self.db_path = db_path or Config.CONVERSATION_DB_PATH
+        self.cache_size = cache_size or Config.CONVERSATION_CACHE_SIZE
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                user_id TEXT NOT NULL,
+                conversation_id TEXT NOT NULL,
+                title TEXT NOT NULL,
+                summary TEXT NOT NULL DEFAULT '',
+                summarized_upto INTEGER NOT NULL DEFAULT 0,
+                turns INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (user_id, conversation_id)
+            )
+        """)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS turns (
+                user_id TEXT NOT NULL,
+                conversation_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                query TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (user_id, conversation_id, seq)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_conversations_updated ON conversations (updated_at)")
+        self._conn.commit()
+        with self._lock:
+            self._prune()
+
+    def _load(self, key):
+        """从缓存或数据库取对话, 调用方持有锁"""
+        row = self._conn.execute(
+            "SELECT summary, summarized_upto, turns FROM conversations WHERE user_id = ? AND conversation_id = ?",
+            key
+        ).fetchone()
+        conversation = self._cache.get(key)
+        # 多个 worker 进程共用数据库: 其他进程追加或删除过的对话重新读取
+        if conversation is not None and conversation.next_seq - 1 == (row[2] if row else 0):
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return conversation
+
+        self.misses += 1
+        user_id, conversation_id = key
+        if row is None:
+            conversation = _Conversation("", 0, [], 1)
+        else:
+            summary, summarized_upto, count = row
+            turns = self._conn.execute(
+                "SELECT seq, query, response FROM turns "
+                "WHERE user_id = ? AND conversation_id = ? AND seq > ? ORDER BY seq",
+                (user_id, conversation_id, summarized_upto)
+            ).fetchall()
+            conversation = _Conversation(summary, summarized_upto, turns, count + 1)
+        self._cache[key] = conversation
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return conversation
+
+    def history(self, user_id, conversation_id):
+        """传给模型的历史: [(问题, 回复)], 有摘要时第一项是摘要"""
+        with self._lock:
+            conversation = self._load((user_id, conversation_id))
+            history = [(query, response) for _, query, response in conversation.turns]
+            if conversation.summary:
+                history.insert(0, (SUMMARY_TURN_LABEL, conversation.summary))
+            return history
+
+    def append(self, user_id, conversation_id, query, response):
+        """追加一轮对话; 旧的轮次折叠进摘要"""
+        now = time.time()
+        key = (user_id, conversation_id)
+        with self._lock:
+            # 多个 worker 进程可能同时追加同一个对话: 在写事务中分配序号, 读到的是其他进程已经提交的轮次
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                conversation = self._load(key)
+                seq = self._conn.execute(
+                    "SELECT COALESCE(MAX(seq), 0) + 1 FROM turns WHERE user_id = ? AND conversation_id = ?",
+                    key
+                ).fetchone()[0]
+                conversation.next_seq = seq + 1
+                conversation.turns.append((seq, query, response))
+
+                # 最近的几轮原样保留, 更早的变成摘要行, 摘要只保留最近的 CONVERSATION_SUMMARY_LINES 行
+                folded = False
+                while len(conversation.turns) > Config.CONVERSATION_RECENT_TURNS:
+                    old_seq, old_query, old_response = conversation.turns.pop(0)
+                    lines = conversation.summary.splitlines() if conversation.summary else []
+                    lines.append(summarize_turn(old_query, old_response))
+                    conversation.summary = "\n".join(lines[-Config.CONVERSATION_SUMMARY_LINES:])
+                    conversation.summarized_upto = old_seq
+                    folded = True
+
+                self._conn.execute(
+                    "INSERT INTO turns (user_id, conversation_id, seq, query, response, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                    (user_id, conversation_id, seq, query, response, now)
+                )
+                self._conn.execute(
+                    "INSERT INTO conversations (user_id, conversation_id, title, turns, created_at, updated_at) "
+                    "VALUES (?, ?, ?, 1, ?, ?) "
+                    "ON CONFLICT (user_id, conversation_id) DO UPDATE SET turns = turns + 1, updated_at = excluded.updated_at",
+                    (user_id, conversation_id, query[:80], now, now)
+                )
+                if folded:
+                    self._conn.execute(
+                        "UPDATE conversations SET summary = ?, summarized_upto = ? WHERE user_id = ? AND conversation_id = ?",
+                        (conversation.summary, conversation.summarized_upto, user_id, conversation_id)
+                    )
+                self._enforce_user_limit(user_id)
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                # 缓存中的对话可能已经改了一半
+                self._cache.pop(key, None)
+                raise
+
+            if now - self._last_prune > Config.CONVERSATION_PRUNE_INTERVAL:
+                self._prune()
+        return seq
+
+    def _delete(self, user_id, conversation_id):
+        self._conn.execute("DELETE FROM turns WHERE user_id = ? AND conversation_id = ?", (user_id, conversation_id))
+        self._conn.execute("DELETE FROM conversations WHERE user_id = ? AND conversation_id = ?",
+                           (user_id, conversation_id))
+        self._cache.pop((user_id, conversation_id), None)
+
+    def _enforce_user_limit(self, user_id):
+        """每个用户只保留最近更新的 CONVERSATION_MAX_PER_USER 个对话"""
+        rows = self._conn.execute(
+            "SELECT conversation_id FROM conversations WHERE user_id = ? ORDER BY updated_at DESC LIMIT -1 OFFSET ?",
+            (user_id, Config.CONVERSATION_MAX_PER_USER)
+        ).fetchall()
+        for (conversation_id,) in rows:
+            self._delete(user_id, conversation_id)
+
+    def _prune(self):
+        """删除超过保留期没有更新的对话"""
+        self._last_prune = time.time()
+        rows = self._conn.execute(
+            "SELECT user_id, conversation_id FROM conversations WHERE updated_at < ?",
+            (time.time() - Config.CONVERSATION_RETENTION,)
+        ).fetchall()
+        for user_id, conversation_id in rows:
+            self._delete(user_id, conversation_id)
+        self._conn.commit()
+        return len(rows)
+
+    def delete(self, user_id, conversation_id):
+        with self._lock:
+            self._delete(user_id, conversation_id)
+            self._conn.commit()
+
+    def list_conversations(self, user_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT conversation_id, title, turns, created_at, updated_at FROM conversations "
+                "WHERE user_id = ? ORDER BY updated_at DESC",
+                (user_id,)
+            ).fetchall()
+        return [
+            {"id": conversation_id, "title": title, "turns": turns, "created_at": created_at, "updated_at": updated_at}
+            for conversation_id, title, turns, created_at, updated_at in rows
+        ]
+
+    def turns(self, user_id, conversation_id):
+        """完整的对话记录 (页面显示用)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT query, response, created_at FROM turns WHERE user_id = ? AND conversation_id = ? ORDER BY seq",
+                (user_id, conversation_id)
+            ).fetchall()
+        return [{"query": query, "response": response, "created_at": created_at} for query, response, created_at in rows]
+
+    def stats(self):
+        with self._lock:
+            conversations, turns = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(turns), 0) FROM conversations"
+            ).fetchone()
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._cache),
+                "conversations": conversations,
+                "turns": turns
+            }
@@ -0,0 +1,115 @@
+# document_loader.py
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from config import Config
+from instrumentation import log_event, record_stage
+
+def get_loader(file_path):
+    """根据扩展名选择 LangChain loader; loader 和它依赖的解析库 (pypdf, unstructured, ...) 用到时才导入"""
+    ext = os.path.splitext(file_path)[1].lower()
+    if ext == '.pdf':
+        from langchain_community.document_loaders import PyPDFLoader
+        return PyPDFLoader(file_path)
+    elif ext in ['.docx', '.doc']:
+        from langchain_community.document_loaders import Docx2txtLoader
+        return Docx2txtLoader(file_path)
+    elif ext == '.json':
+        from langchain_community.document_loaders import JSONLoader
+        return JSONLoader(file_path, jq_schema='.', text_content=False)
+    elif ext == '.csv':
+        from langchain_community.document_loaders import CSVLoader
+        return CSVLoader(file_path)
+    elif ext in ['.xlsx', '.xls']:
+        from langchain_community.document_loaders import UnstructuredExcelLoader
+        return UnstructuredExcelLoader(file_path)
+    elif ext == '.md':
+        from langchain_community.document_loaders import UnstructuredMarkdownLoader
+        return UnstructuredMarkdownLoader(file_path)
+    else:  # txt and others
+        from langchain_community.document_loaders import TextLoader
+        return TextLoader(file_path)
+
+def load_file(file_path):
+    """加载单个文件, 失败时记录并返回空列表"""
+    # 确保文件存在
+    if not os.path.exists(file_path):
+        log_event("file_not_found", level=logging.WARNING, file=file_path)
+        return []
+    try:
+        docs = get_loader(file_path).load()
+        log_event("file_loaded", file=file_path, documents=len(docs))
+        return docs
+    except Exception as e:
+        log_event("file_load_failed", level=logging.WARNING, file=file_path, error=str(e))
+        return []
+
+def create_text_splitter(chunk_size=None, chunk_overlap=None):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size or Config.CHUNK_SIZE,
+        chunk_overlap=Config.CHUNK_OVERLAP if chunk_overlap is None else chunk_overlap
+    )
+
+def load_and_split(file_path, chunk_size=None, chunk_overlap=None):
+    """加载并切分单个文件 (在进程池的 worker 中运行), 返回 (文档块, 加载耗时, 切分耗时)"""
+    start = time.perf_counter()
+    docs = load_file(file_path)
+    loaded = time.perf_counter()
+    chunks = create_text_splitter(chunk_size, chunk_overlap).split_documents(docs)
+    return chunks, loaded - start, time.perf_counter() - loaded
+
+def _pool_context():
+    """进程池的启动方式: 有 forkserver 时用 forkserver (预先导入切分用到的模块, 每个子进程不用重新导入), 否则用 spawn"""
+    if "forkserver" not in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("spawn")
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["document_loader", "langchain.text_splitter"])
+    return context
+
+_main_module_lock = threading.Lock()
+
+@contextmanager
+def _without_main_module():
+    """启动子进程期间把 __main__ 换成空模块
+
+    spawn/forkserver 的子进程会重新执行主模块 (python app.py 时就是整个应用: RAGSystem、SQLite、事件循环线程);
+    进程池只用到 document_loader, 不需要主模块
+    """
+    with _main_module_lock:
+        main_module = sys.modules["__main__"]
+        sys.modules["__main__"] = types.ModuleType("__main__")
+        try:
+            yield
+        finally:
+            sys.modules["__main__"] = main_module
+
+def load_and_split_files(file_paths, workers=None):
+    """用进程池并行加载和切分文件, 返回的列表与 file_paths 一一对应"""
+    workers = workers or Config.INGEST_WORKERS
+    workers = min(workers, len(file_paths))
+    if workers <= 1:
+        results = [load_and_split(file_path) for file_path in file_paths]
+    else:
+        # 不用 fork: 服务进程中已经有多个线程 (事件循环、目录监视、索引 worker), fork 时被持有的锁在子进程中永远不会释放.
+        # forkserver 的子进程不继承运行时修改的 Config, 切分参数显式传入
+        split = partial(load_and_split, chunk_size=Config.CHUNK_SIZE, chunk_overlap=Config.CHUNK_OVERLAP)
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_pool_context()) as executor:
+            # 子进程在 submit 时启动
+            with _without_main_module():
+                futures = [executor.submit(split, file_path) for file_path in file_paths]
+            # 按输入顺序取结果, 输出是确定的
+            results = [future.result() for future in futures]
+    
+    # 耗时在 worker 进程中测量, 在这里记录 (各文件的耗时之和, 并行时大于实际经过的时间)
+    for _, load_seconds, split_seconds in results:
+        record_stage("loading", load_seconds)
+        record_stage("splitting", split_seconds)
+    return [chunks for chunks, _, _ in results]
@@ -0,0 +1,128 @@
+# embedding_cache.py
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from langchain_core.embeddings import Embeddings
+from config import Config
+
+class CachedEmbeddings(Embeddings):
+    """包装一个 embeddings 对象, 把向量按 (模型名, 文本 hash) 缓存到 SQLite, LRU 淘汰"""
+
+    def __init__(self, embeddings, model_name, db_path=None, max_entries=None):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.db_path = db_path or Config.EMBEDDING_CACHE_PATH
+        self.max_entries = max_entries or Config.EMBEDDING_CACHE_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (model, text_hash)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_used ON embeddings (last_used)")
+        self._conn.commit()
+
+    @staticmethod
+    def text_hash(text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _lookup(self, hashes):
+        found = {}
+        unique = list(set(hashes))
+        # SQLite 参数数量有限, 分批查询
+        for i in range(0, len(unique), 500):
+            batch = unique[i:i + 500]
+            placeholders = ",".join("?" * len(batch))
+            rows = self._conn.execute(
+                f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND text_hash IN ({placeholders})",
+                [self.model_name, *batch]
+            ).fetchall()
+            for text_hash, blob in rows:
+                vector = array("f")
+                vector.frombytes(blob)
+                found[text_hash] = vector.tolist()
+        if found:
+            now = time.time()
+            self._conn.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND text_hash = ?",
+                [(now, self.model_name, text_hash) for text_hash in found]
+            )
+        return found
+
+    def _store(self, vectors):
+        now = time.time()
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (model, text_hash, vector, last_used) VALUES (?, ?, ?, ?)",
+            [(self.model_name, text_hash, array("f", vector).tobytes(), now)
+             for text_hash, vector in vectors.items()]
+        )
+        self._evict()
+
+    def _evict(self):
+        """超过容量时删除最久未使用的向量"""
+        count = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._conn.execute(
+                "DELETE FROM embeddings WHERE rowid IN "
+                "(SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?)",
+                (overflow,)
+            )
+
+    def embed_documents(self, texts):
+        hashes = [self.text_hash(text) for text in texts]
+        with self._lock:
+            found = self._lookup(hashes)
+            self._conn.commit()
+
+        # 相同文本只计算一次
+        missing = {}
+        for text_hash, text in zip(hashes, texts):
+            if text_hash not in found and text_hash not in missing:
+                missing[text_hash] = text
+        self.hits += len(texts) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            vectors = self.embeddings.embed_documents(list(missing.values()))
+            computed = dict(zip(missing.keys(), vectors))
+            with self._lock:
+                self._store(computed)
+                self._conn.commit()
+            found.update(computed)
+
+        return [found[text_hash] for text_hash in hashes]
+
+    def embed_query(self, text):
+        text_hash = self.text_hash(text)
+        with self._lock:
+            found = self._lookup([text_hash])
+            self._conn.commit()
+        if text_hash in found:
+            self.hits += 1
+            return found[text_hash]
+
+        self.misses += 1
+        vector = self.embeddings.embed_query(text)
+        with self._lock:
+            self._store({text_hash: vector})
+            self._conn.commit()
+        return vector
+
+    def stats(self):
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
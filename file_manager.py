@@ -1,11 +1,79 @@
 # file_manager.py
+import errno
+import hashlib
+import io
 import os
 import shutil
+import tempfile
 from config import Config
-from user_manager import UserManager
+from file_watcher import is_catalog_file
+from instrumentation import log_event
+from index_manifest import IndexManifest
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
-user_manager = UserManager()
+class UploadStream:
+    """上传文件的写入目标: 分块写入临时文件, 同时计算 sha256, 超过大小上限立即中止
+    
+    keep=False 时只计数不写盘 (不允许的文件类型). 没有 commit 的临时文件在 close 时删除.
+    """
+    
+    def __init__(self, upload_dir, max_size, keep=True):
+        self.max_size = max_size
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+        self.path = None
+        if keep:
+            fd, self.path = tempfile.mkstemp(dir=upload_dir, prefix="upload-", suffix=".part")
+            self.file = os.fdopen(fd, "w+b")
+        else:
+            self.file = io.BytesIO()
+    
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.close()
+            raise RequestEntityTooLarge(f"File exceeds the {self.max_size} byte limit")
+        self.sha256.update(data)
+        if self.path is None:
+            return len(data)
+        return self.file.write(data)
+    
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+    
+    def commit(self, target_path):
+        """把临时文件原子地重命名为 target_path"""
+        self.file.close()
+        os.chmod(self.path, 0o644)
+        try:
+            os.replace(self.path, target_path)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # 临时目录和数据目录不在同一个文件系统: 先复制到目标目录中的隐藏文件, 再原子替换
+            staging_path = os.path.join(os.path.dirname(target_path), f".{os.path.basename(target_path)}.part")
+            shutil.copyfile(self.path, staging_path)
+            os.replace(staging_path, target_path)
+            os.unlink(self.path)
+        self.path = None
+        return target_path
+    
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+        if self.path is not None:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+            self.path = None
+    
+    def __getattr__(self, name):
+        # werkzeug 会调用 seek/read 等方法
+        if name == "file":
+            raise AttributeError(name)
+        return getattr(self.file, name)
 
 class FileManager:
     def __init__(self):
@@ -24,51 +92,77 @@ class FileManager:
         return '.' in filename and \
                filename.rsplit('.', 1)[1].lower() in self.allowed_extensions
     
-    def save_uploaded_files(self, files, user):
-        saved_files = []
-        for file in files:
-            if file and file.filename != '' and self.allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                file_path = os.path.join(self.upload_dir, filename)
-                file.save(file_path)
-                saved_files.append(file_path)
-                
-                # 限制上传文件数量
-                if len(saved_files) >= self.max_files:
-                    break
-        return saved_files
+    def open_upload_stream(self, filename):
+        """解析 multipart 请求时, 每个上传的文件直接写入一个 UploadStream"""
+        return UploadStream(self.upload_dir, self.max_size, keep=self.allowed_file(filename or ''))
     
-    def move_to_permanent(self, file_path, access_level):
-        """将文件移动到永久存储"""
-        if not os.path.exists(file_path):
-            return None
+    def _spool(self, file):
+        """不是通过 open_upload_stream 接收的文件 (例如测试客户端), 分块复制到 UploadStream"""
+        stream = self.open_upload_stream(file.filename)
+        try:
+            for block in iter(lambda: file.stream.read(Config.UPLOAD_CHUNK_SIZE), b""):
+                stream.write(block)
+        except Exception:
+            stream.close()
+            raise
+        return stream
+    
+    def save_uploaded_files(self, files, access_level):
+        """把上传的文件原子地放进等级目录
         
-        filename = os.path.basename(file_path)
+        返回 [{"filename", "path", "status"}], status 为 "saved"、"duplicate" (该等级已有相同内容的文件)
+        或 "rejected" (类型不允许, 或超过文件数量)
+        """
+        results = []
+        saved = 0
+        manifest = IndexManifest(access_level)
         target_dir = os.path.join(self.data_dir, access_level)
-        os.makedirs(target_dir, exist_ok=True)  # 确保目录存在
-        target_path = os.path.join(target_dir, filename)
-        
-        shutil.move(file_path, target_path)
-        return target_path
+        os.makedirs(target_dir, exist_ok=True)
+        for file in files:
+            if not file or file.filename == '':
+                continue
+            filename = secure_filename(file.filename)
+            # 限制上传文件数量
+            if not self.allowed_file(filename) or saved >= self.max_files:
+                results.append({"filename": filename, "path": None, "status": "rejected"})
+                continue
+            
+            stream = file.stream if isinstance(file.stream, UploadStream) else self._spool(file)
+            try:
+                existing = manifest.find_hash(stream.hexdigest())
+                if existing and os.path.exists(existing):
+                    results.append({"filename": filename, "path": existing, "status": "duplicate"})
+                    continue
+                target_path = stream.commit(os.path.join(target_dir, filename))
+                results.append({"filename": filename, "path": target_path, "status": "saved"})
+                saved += 1
+            finally:
+                stream.close()
+        return results
+    
+    def get_level_files(self, level):
+        """获取某个权限等级目录下的所有文件路径"""
+        level_files = []
+        level_dir = os.path.join(self.data_dir, level)
+        if os.path.exists(level_dir):
+            # 获取目录下所有文件
+            for root, _, files in os.walk(level_dir):
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    # 跳过 .DS_Store 等不支持的文件
+                    if is_catalog_file(file_path) and os.path.isfile(file_path):
+                        level_files.append(file_path)
+        return level_files
     
     def get_accessible_files(self, user):
         """获取用户可以访问的所有文件路径"""
         accessible_files = []
         user_level = user.get_access_level()
-        print(f"User {user.id} has access level: {user_level}")
         
         # 根据权限添加文件
         for level in Config.ACCESS_LEVELS:
             if user.has_access(level):
-                level_dir = os.path.join(self.data_dir, level)
-                print(f"Checking directory: {level_dir}")
-                if os.path.exists(level_dir):
-                    # 获取目录下所有文件
-                    for root, _, files in os.walk(level_dir):
-                        for file in files:
-                            file_path = os.path.join(root, file)
-                            if os.path.isfile(file_path):
-                                accessible_files.append(file_path)
+                accessible_files.extend(self.get_level_files(level))
         
-        print(f"User {user.id} ({user_level} access) can access {len(accessible_files)} files")
+        log_event("accessible_files", user=user.id, access_level=user_level, files=len(accessible_files))
         return accessible_files
\ No newline at end of file
@@ -0,0 +1,195 @@
+# file_watcher.py
+import logging
+import os
+import threading
+from config import Config
+from instrumentation import log_event, timed
+
+try:
+    # 有 watchdog 时用系统的文件事件 (Linux 上是 inotify), 否则定时扫描
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+def is_catalog_file(file_path):
+    """只收录允许的扩展名, 跳过隐藏文件 (.DS_Store、上传中的临时文件等)"""
+    name = os.path.basename(file_path)
+    return not name.startswith('.') and '.' in name and \
+        name.rsplit('.', 1)[1].lower() in Config.ALLOWED_EXTENSIONS
+
+def level_of(file_path, data_dir=None):
+    """data/<level>/... 路径所属的权限等级, 不在任何等级目录下返回 None"""
+    relative = os.path.relpath(os.path.abspath(file_path), os.path.abspath(data_dir or Config.DATA_DIR))
+    level = relative.split(os.sep, 1)[0]
+    return level if level in Config.ACCESS_LEVELS and relative != level else None
+
+def catalog_path(file_path, data_dir=None):
+    """统一成 data/<level>/... 形式的路径 (和 manifest 中的路径一致)"""
+    data_dir = data_dir or Config.DATA_DIR
+    relative = os.path.relpath(os.path.abspath(file_path), os.path.abspath(data_dir))
+    return os.path.normpath(os.path.join(data_dir, relative))
+
+class FileCatalog:
+    """每个权限等级的文件列表, 保存在内存中; 启动时扫描一次, 之后由 DataWatcher 或索引任务更新"""
+
+    def __init__(self, data_dir=None):
+        self.data_dir = data_dir or Config.DATA_DIR
+        self._files = {level: set() for level in Config.ACCESS_LEVELS}
+        self._lock = threading.Lock()
+        for level in Config.ACCESS_LEVELS:
+            self.scan(level)
+
+    def scan(self, level):
+        """重新扫描某个等级的目录"""
+        files = set()
+        with timed("file_listing"):
+            for root, _, names in os.walk(os.path.join(self.data_dir, level)):
+                for name in names:
+                    file_path = os.path.join(root, name)
+                    if is_catalog_file(file_path) and os.path.isfile(file_path):
+                        files.add(os.path.normpath(file_path))
+        with self._lock:
+            self._files[level] = files
+        return files
+
+    def update(self, level, file_paths):
+        """按文件当前是否存在更新这些路径"""
+        with self._lock:
+            files = self._files.setdefault(level, set())
+            for file_path in file_paths:
+                file_path = os.path.normpath(file_path)
+                if is_catalog_file(file_path) and os.path.isfile(file_path):
+                    files.add(file_path)
+                else:
+                    files.discard(file_path)
+
+    def files(self, level):
+        with self._lock:
+            return sorted(self._files.get(level, ()))
+
+    def __contains__(self, file_path):
+        level = level_of(file_path, self.data_dir)
+        with self._lock:
+            return level is not None and os.path.normpath(file_path) in self._files[level]
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.event_type not in ("created", "modified", "deleted", "moved", "closed"):
+            return
+        if event.is_directory:
+            # 目录整体移入/删除: 对应等级重新扫描 (目录的 modified 事件只是其中的文件变了)
+            if event.event_type in ("created", "deleted", "moved"):
+                self.watcher.rescan(event.src_path)
+            return
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if path:
+                self.watcher.notify(path)
+
+class DataWatcher:
+    """监视 DATA_DIR, 文件变化后更新 FileCatalog, 安静一段时间 (debounce) 后只为变化的文件提交索引任务
+
+    on_change(level, file_path) 由调用方提供, 通常是 IngestQueue.enqueue_change.
+    """
+
+    def __init__(self, catalog, on_change, debounce=None, poll_interval=None, backend=None):
+        self.catalog = catalog
+        self.on_change = on_change
+        self.debounce = debounce or Config.WATCH_DEBOUNCE
+        self.poll_interval = poll_interval or Config.WATCH_POLL_INTERVAL
+        backend = backend or Config.WATCH_BACKEND
+        self.backend = "poll" if backend == "poll" or Observer is None else "events"
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        self._observer = None
+        self._snapshot = {}
+        self._stopped = threading.Event()
+
+    def start(self):
+        os.makedirs(self.catalog.data_dir, exist_ok=True)
+        if self.backend == "events":
+            self._observer = Observer()
+            self._observer.schedule(_EventHandler(self), self.catalog.data_dir, recursive=True)
+            self._observer.daemon = True
+            self._observer.start()
+        else:
+            self._snapshot = self._stat_tree()
+            threading.Thread(target=self._poll, name="data-watcher", daemon=True).start()
+        log_event("data_watcher_started", data_dir=self.catalog.data_dir, backend=self.backend)
+
+    def stop(self):
+        self._stopped.set()
+        if self._observer is not None:
+            self._observer.stop()
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+
+    def notify(self, file_path):
+        """记录一个变化的文件, 重新开始 debounce 计时"""
+        level = level_of(file_path, self.catalog.data_dir)
+        if level is None or not is_catalog_file(file_path):
+            return
+        with self._lock:
+            self._pending[catalog_path(file_path, self.catalog.data_dir)] = level
+            if self._timer is not None:
+                self._timer.cancel()
+            self._timer = threading.Timer(self.debounce, self._flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def rescan(self, dir_path):
+        """目录事件: 重新扫描所在等级, 新增和消失的文件都算作变化"""
+        level = level_of(dir_path, self.catalog.data_dir) or \
+            os.path.basename(os.path.normpath(dir_path))
+        if level not in Config.ACCESS_LEVELS:
+            return
+        before = set(self.catalog.files(level))
+        after = self.catalog.scan(level)
+        for file_path in before ^ after:
+            self.notify(file_path)
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._timer = None
+        for file_path, level in pending.items():
+            self.catalog.update(level, [file_path])
+            try:
+                self.on_change(level, file_path)
+            except Exception as e:
+                log_event("ingest_queue_failed", level=logging.ERROR, file=file_path, error=str(e))
+
+    def _stat_tree(self):
+        snapshot = {}
+        for level in Config.ACCESS_LEVELS:
+            for root, _, names in os.walk(os.path.join(self.catalog.data_dir, level)):
+                for name in names:
+                    file_path = os.path.normpath(os.path.join(root, name))
+                    if not is_catalog_file(file_path):
+                        continue
+                    try:
+                        stat = os.stat(file_path)
+                    except OSError:
+                        continue
+                    snapshot[file_path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def _poll(self):
+        """没有 watchdog 时的后备: 在后台线程中定时比较文件的大小和修改时间"""
+        while not self._stopped.wait(self.poll_interval):
+            try:
+                snapshot = self._stat_tree()
+            except Exception as e:
+                log_event("data_scan_failed", level=logging.WARNING, data_dir=self.catalog.data_dir, error=str(e))
+                continue
+            for file_path in set(snapshot) | set(self._snapshot):
+                if snapshot.get(file_path) != self._snapshot.get(file_path):
+                    self.notify(file_path)
+            self._snapshot = snapshot
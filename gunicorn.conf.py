@@ -0,0 +1,45 @@
+# gunicorn.conf.py
+# 多进程部署: gunicorn -c gunicorn.conf.py app:app
+#
+# master 先启动 writer 进程 (indexer.py, 负责所有索引写入), 等它发布第一代只读快照后再启动 worker;
+# 每个 worker 打开快照并预热之后才开始接收请求.
+import os
+import subprocess
+import sys
+from config import Config
+
+Config.SERVING_ROLE = "worker"
+
+bind = Config.SERVING_BIND
+workers = Config.SERVING_WORKERS
+# 线程 worker: 流式回复期间不占用整个进程
+worker_class = "gthread"
+threads = Config.SERVING_THREADS
+# 流式回复可能持续到 LLM 的读取超时
+timeout = Config.LLM_READ_TIMEOUT
+# 每个 worker 在 fork 之后自己导入 app (事件循环线程和 SQLite 连接不能跨 fork 共享)
+preload_app = False
+
+_writer = None
+
+def on_starting(server):
+    global _writer
+    # writer 是独立的进程 (不是 master 的 multiprocessing 子进程, fork 出的 worker 不会继承它)
+    read_fd, write_fd = os.pipe()
+    _writer = subprocess.Popen([sys.executable, "-m", "indexer", "--ready-fd", str(write_fd)], pass_fds=(write_fd,))
+    os.close(write_fd)
+    # 启动同步完成前 writer 退出时管道被关闭, read 返回空
+    with os.fdopen(read_fd, "rb") as ready:
+        if not ready.read(1):
+            raise RuntimeError(f"index writer exited during startup (exit code {_writer.wait()})")
+    server.log.info("index writer ready (pid %s)", _writer.pid)
+
+def post_worker_init(worker):
+    # app 已经在这个 worker 中导入 (快照已打开); 读入索引、连接后端之后才开始接收请求
+    from app import rag_system
+    rag_system.warm_up()
+
+def on_exit(server):
+    if _writer is not None and _writer.poll() is None:
+        _writer.terminate()
+        _writer.wait(30)
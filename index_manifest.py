@@ -0,0 +1,85 @@
+# index_manifest.py
+import hashlib
+import json
+import logging
+import os
+from config import Config
+from instrumentation import log_event
+
+def file_hash(file_path):
+    """计算文件内容的 sha256"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def chunk_ids(file_path, count, digest):
+    """为文件的每个文档块生成稳定的 ID
+
+    ID 包含文件内容的 hash: 文件修改后新块的 ID 和旧块不同, 新旧两个版本可以同时存在,
+    发布新版本之前检索只会看到旧块.
+    """
+    path_key = hashlib.sha1(os.path.normpath(file_path).encode("utf-8")).hexdigest()[:16]
+    return [f"{path_key}-{digest[:8]}-{i}" for i in range(count)]
+
+class IndexManifest:
+    """记录某个权限等级已索引的文件: path -> size, mtime, sha256, chunk_ids"""
+
+    def __init__(self, level):
+        self.level = level
+        self.path = os.path.join(Config.CHROMA_DB_DIR, f"manifest_{level}.json")
+        self.exists = os.path.exists(self.path)
+        self.entries = self._load()
+
+    def _load(self):
+        if not self.exists:
+            return {}
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            log_event("manifest_load_failed", level=logging.WARNING, path=self.path, error=str(e))
+            return {}
+
+    def get(self, file_path):
+        return self.entries.get(os.path.normpath(file_path))
+
+    def set(self, file_path, size, mtime, sha256, ids):
+        self.entries[os.path.normpath(file_path)] = {
+            "size": size,
+            "mtime": mtime,
+            "sha256": sha256,
+            "chunk_ids": ids
+        }
+
+    def remove(self, file_path):
+        return self.entries.pop(os.path.normpath(file_path), None)
+
+    def find_hash(self, sha256):
+        """内容相同的已索引文件的路径, 没有则返回 None"""
+        for file_path, entry in self.entries.items():
+            if entry["sha256"] == sha256:
+                return file_path
+        return None
+
+    def paths(self):
+        return set(self.entries)
+
+    def is_unchanged(self, file_path, stat):
+        """大小和修改时间都没变, 不需要重新计算 hash"""
+        entry = self.get(file_path)
+        return entry is not None and \
+            entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns
+
+    def clear(self):
+        self.entries = {}
+
+    def save(self):
+        # 先写临时文件再替换, 避免写到一半的 manifest
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+        self.exists = True
@@ -0,0 +1,231 @@
+# index_snapshot.py
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+import time
+import numpy as np
+from langchain_core.documents import Document
+from config import Config
+from instrumentation import log_event
+from keyword_index import tokenize
+
+# 指向当前一代的文件, 原子替换
+CURRENT_FILE = "CURRENT"
+# 每个等级的快照文件: 向量矩阵, 向量的平方范数, 文档块和 FTS5 索引
+SNAPSHOT_SUFFIXES = (".npy", ".norms.npy", ".sqlite3")
+# 从 Chroma 导出时每次读取的文档块数
+EXPORT_BATCH = 5000
+
+def _generation_dir(root, generation):
+    return os.path.join(root, f"gen-{generation:06d}")
+
+def read_current(root=None):
+    """当前发布的一代: {"generation", "levels": {level: {"generation", "chunks"}}}; 还没有发布时返回 None"""
+    path = os.path.join(root or Config.SNAPSHOT_DIR, CURRENT_FILE)
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        log_event("snapshot_pointer_invalid", level=logging.WARNING, path=path, error=str(e))
+        return None
+
+def _fsync_write(path, write):
+    with open(path, "wb") as f:
+        write(f)
+        f.flush()
+        os.fsync(f.fileno())
+
+def _export_level(prefix, collection, ids):
+    """把已发布的文档块从 Chroma 导出成快照文件, SQLite 的 rowid 是向量矩阵的行号 + 1; 返回文档块数"""
+    ids = list(ids)
+    vectors = []
+    rows = []
+    for start in range(0, len(ids), EXPORT_BATCH):
+        data = collection.get(ids=ids[start:start + EXPORT_BATCH], include=["embeddings", "documents", "metadatas"])
+        for doc_id, embedding, text, metadata in zip(data["ids"], data["embeddings"], data["documents"], data["metadatas"]):
+            vectors.append(embedding)
+            rows.append((len(rows) + 1, doc_id, text, json.dumps(metadata or {}, ensure_ascii=False)))
+
+    matrix = np.asarray(vectors, dtype=np.float32) if vectors else np.zeros((0, 0), dtype=np.float32)
+    norms = np.einsum("ij,ij->i", matrix, matrix) if vectors else np.zeros(0, dtype=np.float32)
+    _fsync_write(prefix + ".npy", lambda f: np.save(f, matrix))
+    _fsync_write(prefix + ".norms.npy", lambda f: np.save(f, norms))
+
+    conn = sqlite3.connect(prefix + ".sqlite3")
+    try:
+        conn.execute("CREATE TABLE chunks (rowid INTEGER PRIMARY KEY, chunk_id TEXT NOT NULL, text TEXT NOT NULL, metadata TEXT NOT NULL)")
+        conn.execute("CREATE UNIQUE INDEX idx_chunks_id ON chunks (chunk_id)")
+        conn.execute("CREATE VIRTUAL TABLE chunks_fts USING fts5(text, content='chunks', content_rowid='rowid')")
+        conn.executemany("INSERT INTO chunks (rowid, chunk_id, text, metadata) VALUES (?, ?, ?, ?)", rows)
+        conn.execute("INSERT INTO chunks_fts (chunks_fts) VALUES ('rebuild')")
+        conn.commit()
+    finally:
+        conn.close()
+    return len(rows)
+
+def _link(source, target):
+    """没有变化的等级直接硬链接上一代的文件, 不支持硬链接时复制"""
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+class SnapshotLevel:
+    """一个等级的只读快照: 向量矩阵用 np.load(mmap_mode="r") 打开, 多个 worker 进程共享同一份页缓存;
+    文档块和 BM25 (FTS5) 索引在只读的 SQLite 文件中
+
+    同时提供 retrieve 用到的向量库接口 (similarity_search_by_vector_with_relevance_scores)
+    和 KeywordIndex 接口 (search / in / len). path 为 None 时是空索引 (writer 还没有发布这个等级).
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = None
+        if path is None:
+            self._vectors = np.zeros((0, 0), dtype=np.float32)
+            self._norms = np.zeros(0, dtype=np.float32)
+            return
+        self._vectors = np.load(path + ".npy", mmap_mode="r")
+        self._norms = np.load(path + ".norms.npy", mmap_mode="r")
+        # 快照发布后不再修改, immutable=1 读取时不需要文件锁
+        self._conn = sqlite3.connect(f"file:{path}.sqlite3?mode=ro&immutable=1", uri=True, check_same_thread=False)
+
+    def __len__(self):
+        return self._vectors.shape[0]
+
+    def __contains__(self, doc_id):
+        if self._conn is None:
+            return False
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM chunks WHERE chunk_id = ?", (doc_id,)).fetchone() is not None
+
+    def _documents(self, rowids):
+        if not rowids:
+            return {}
+        placeholders = ",".join("?" * len(rowids))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT rowid, text, metadata FROM chunks WHERE rowid IN ({placeholders})", rowids
+            ).fetchall()
+        return {rowid: Document(page_content=text, metadata=json.loads(metadata)) for rowid, text, metadata in rows}
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k=4):
+        """返回 [(Document, 距离)]; 和 Chroma 默认的距离 (L2 的平方) 相同, 越小越相关"""
+        if not len(self):
+            return []
+        query = np.asarray(embedding, dtype=np.float32)
+        distances = self._norms - 2 * (self._vectors @ query) + float(query @ query)
+        k = min(k, len(distances))
+        top = np.argpartition(distances, k - 1)[:k]
+        top = top[np.argsort(distances[top])]
+        docs = self._documents([int(row) + 1 for row in top])
+        return [(docs[int(row) + 1], float(distances[row])) for row in top]
+
+    def search(self, query, k):
+        """BM25 (FTS5) 检索, 返回 [(Document, 分数)], 分数从高到低"""
+        terms = sorted(set(tokenize(query)))
+        if not terms or not len(self):
+            return []
+        # 每个词单独加引号, 问题中的符号不会被当成 FTS5 语法
+        match = " OR ".join('"' + term.replace('"', '""') + '"' for term in terms)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rowid, -bm25(chunks_fts) FROM chunks_fts WHERE chunks_fts MATCH ? "
+                "ORDER BY bm25(chunks_fts) LIMIT ?", (match, k)
+            ).fetchall()
+        docs = self._documents([rowid for rowid, _ in rows])
+        return [(docs[rowid], score) for rowid, score in rows]
+
+    def warm_up(self):
+        """把向量矩阵和 SQLite 文件读进页缓存 (同一台机器上的 worker 共享), 第一个请求不用等磁盘"""
+        if self._conn is None:
+            return
+        for start in range(0, len(self), EXPORT_BATCH):
+            float(np.sum(self._vectors[start:start + EXPORT_BATCH]))
+        float(np.sum(self._norms))
+        with self._lock:
+            self._conn.execute("SELECT COUNT(*), SUM(LENGTH(text)), SUM(LENGTH(metadata)) FROM chunks").fetchone()
+            self._conn.execute("SELECT COUNT(*) FROM chunks_fts WHERE chunks_fts MATCH 'warm'").fetchone()
+
+class SnapshotWriter:
+    """writer 进程: 索引发布后导出新的一代快照, 再原子地替换 CURRENT
+
+    每一代是 SNAPSHOT_DIR 下的 gen-<n> 目录, 没有变化的等级硬链接上一代的文件;
+    只保留最近 SNAPSHOT_KEEP 代 (已经打开旧文件的 worker 不受删除影响).
+    """
+
+    def __init__(self, root=None, keep=None):
+        self.root = root or Config.SNAPSHOT_DIR
+        self.keep = keep or Config.SNAPSHOT_KEEP
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def has_level(self, level):
+        current = read_current(self.root)
+        return current is not None and level in current["levels"]
+
+    def publish(self, level, collection, ids):
+        """导出一个等级 (ids 是已发布的文档块), 返回新一代的编号"""
+        with self._lock:
+            current = read_current(self.root) or {"generation": 0, "levels": {}}
+            generation = current["generation"] + 1
+            directory = _generation_dir(self.root, generation)
+            # 上次导出到一半退出时留下的目录
+            shutil.rmtree(directory, ignore_errors=True)
+            os.makedirs(directory)
+
+            levels = {}
+            previous = _generation_dir(self.root, current["generation"])
+            for other, info in current["levels"].items():
+                if other == level:
+                    continue
+                for suffix in SNAPSHOT_SUFFIXES:
+                    _link(os.path.join(previous, other) + suffix, os.path.join(directory, other) + suffix)
+                levels[other] = info
+            chunks = _export_level(os.path.join(directory, level), collection, ids)
+            levels[level] = {"generation": generation, "chunks": chunks}
+
+            pointer = os.path.join(self.root, CURRENT_FILE)
+            data = json.dumps({"generation": generation, "levels": levels, "created_at": time.time()}).encode("utf-8")
+            _fsync_write(pointer + ".tmp", lambda f: f.write(data))
+            os.replace(pointer + ".tmp", pointer)
+            self._collect(generation)
+        log_event("index_generation_published", generation=generation, access_level=level, chunks=chunks)
+        return generation
+
+    def _collect(self, generation):
+        """删除 SNAPSHOT_KEEP 代之前的目录"""
+        for name in os.listdir(self.root):
+            match = re.fullmatch(r"gen-(\d+)", name)
+            if match and int(match.group(1)) <= generation - self.keep:
+                shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
+
+class SnapshotReader:
+    """worker 进程: 检查 CURRENT, 只打开新一代中有变化的等级"""
+
+    def __init__(self, root=None):
+        self.root = root or Config.SNAPSHOT_DIR
+        self.generation = 0
+        self.level_generations = {}
+
+    def poll(self):
+        """有新一代时返回 {level: SnapshotLevel} (只包含变化的等级), 否则返回 {}"""
+        current = read_current(self.root)
+        if current is None or current["generation"] == self.generation:
+            return {}
+        directory = _generation_dir(self.root, current["generation"])
+        opened = {
+            level: SnapshotLevel(os.path.join(directory, level))
+            for level, info in current["levels"].items()
+            if self.level_generations.get(level) != info["generation"]
+        }
+        self.generation = current["generation"]
+        self.level_generations = {level: info["generation"] for level, info in current["levels"].items()}
+        return opened
@@ -0,0 +1,46 @@
+# indexer.py
+import argparse
+import os
+import threading
+from config import Config
+
+def run_writer(on_ready=None):
+    """多进程部署中唯一的写入进程: 同步索引, 执行所有进程提交的索引任务, 监视 data 目录;
+    每次索引更新后发布新一代只读快照, worker 进程不用重启就能读到
+
+    on_ready 在启动同步完成 (所有等级都已发布快照) 之后调用
+    """
+    Config.SERVING_ROLE = "writer"
+    from rag_system import RAGSystem
+    from ingest_queue import IngestQueue
+    from file_watcher import DataWatcher
+    from utils import start_temp_sweeper
+    from index_snapshot import read_current
+    from instrumentation import log_event
+
+    for level in Config.ACCESS_LEVELS:
+        os.makedirs(os.path.join(Config.DATA_DIR, level), exist_ok=True)
+    os.makedirs(Config.UPLOAD_DIR, exist_ok=True)
+    rag_system = RAGSystem()
+    # 同步所有等级, 没有快照的等级导出第一代
+    rag_system.warm_up()
+    ingest_queue = IngestQueue(rag_system.refresh_level)
+    ingest_queue.start()
+    DataWatcher(rag_system.file_catalog, ingest_queue.enqueue_change).start()
+    start_temp_sweeper()
+    log_event("writer_ready", generation=(read_current() or {}).get("generation", 0), pid=os.getpid())
+    if on_ready is not None:
+        on_ready()
+    threading.Event().wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index writer for the multi-process deployment")
+    parser.add_argument("--ready-fd", type=int,
+                        help="write one byte to this file descriptor once the startup sync is published")
+    args = parser.parse_args()
+
+    def notify_ready():
+        os.write(args.ready_fd, b"1")
+        os.close(args.ready_fd)
+
+    run_writer(notify_ready if args.ready_fd is not None else None)
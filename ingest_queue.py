@@ -0,0 +1,218 @@
+# ingest_queue.py
+import logging
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+from config import Config
+from instrumentation import log_event
+
+class IngestQueue:
+    """后台索引任务队列, 任务记录在本地 SQLite 表中, 进程重启后未完成的任务会继续执行 (start() 之后才执行任务)
+
+    handler(level, file_paths) 增量同步这些文件, 同一等级排队中的任务合并成一次同步;
+    同一文件已经在排队时不会重复入队.
+    """
+
+    def __init__(self, handler, db_path=None, workers=None):
+        self.handler = handler
+        self.db_path = db_path or Config.INGEST_JOBS_DB_PATH
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self.coalesced = 0
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                level TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                username TEXT,
+                status TEXT NOT NULL,
+                error TEXT,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, level)")
+        # workers=0: 只提交任务, 由另一个进程执行 (多进程部署中的 worker)
+        self.workers = Config.INGEST_QUEUE_WORKERS if workers is None else workers
+        self._threads = []
+
+    def start(self):
+        """启动后台 worker 线程 (由服务的入口调用, 导入模块时不启动); workers=0 时什么也不做"""
+        if not self.workers or self._threads:
+            return
+        self._recover()
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"ingest-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _recover(self):
+        """上次退出时正在运行的任务重新排队, 删除过期的已完成任务"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "UPDATE jobs SET status = 'queued', updated_at = ? WHERE status = 'running'", (now,)
+            )
+            self._conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                (now - Config.INGEST_JOB_RETENTION,)
+            )
+            self._conn.commit()
+
+    def enqueue(self, level, file_path, username=None):
+        """添加索引任务, 返回任务 ID; 同一文件已有排队中的任务时返回那个任务的 ID"""
+        file_path = os.path.normpath(file_path)
+        now = time.time()
+        with self._wakeup:
+            row = self._conn.execute(
+                "SELECT id FROM jobs WHERE level = ? AND file_path = ? AND status = 'queued'",
+                (level, file_path)
+            ).fetchone()
+            if row:
+                self.coalesced += 1
+                self._conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (now, row[0]))
+                self._conn.commit()
+                return row[0]
+
+            job_id = uuid.uuid4().hex
+            self._conn.execute(
+                "INSERT INTO jobs (id, level, file_path, username, status, created_at, updated_at) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                (job_id, level, file_path, username, now, now)
+            )
+            self._conn.commit()
+            self._wakeup.notify()
+        log_event("ingest_job_queued", job_id=job_id, access_level=level, file=file_path)
+        return job_id
+
+    def enqueue_change(self, level, file_path):
+        """目录监视发现的变化: 文件最后一次修改之后提交的任务 (排队中、运行中或已完成) 会读到当前内容,
+        这时不再重复提交 (例如上传时已经提交过), 返回 None; 否则同 enqueue"""
+        try:
+            modified_at = os.stat(file_path).st_mtime
+        except OSError:
+            # 文件已删除: 需要一次同步把它从索引中去掉
+            return self.enqueue(level, file_path)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id FROM jobs WHERE level = ? AND file_path = ? AND status IN ('queued', 'running', 'done') "
+                "AND created_at >= ? LIMIT 1",
+                (level, os.path.normpath(file_path), modified_at)
+            ).fetchone()
+        if row:
+            return None
+        return self.enqueue(level, file_path)
+
+    def _claim(self):
+        """取出最早排队且没有在同步的等级, 把该等级所有排队中的任务标记为 running
+
+        在一个写事务 (BEGIN IMMEDIATE) 中查询和更新, 多个进程共用任务表时同一任务只会被认领一次;
+        有 running 任务的等级 (本进程或其他进程正在同步) 跳过. 返回 (level, 任务 ID 列表, 文件路径列表),
+        没有可执行的任务时 level 为 None
+        """
+        self._conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._conn.execute(
+                "SELECT level FROM jobs WHERE status = 'queued' "
+                "AND level NOT IN (SELECT level FROM jobs WHERE status = 'running') "
+                "ORDER BY created_at LIMIT 1"
+            ).fetchone()
+            if row is None:
+                self._conn.commit()
+                return None, [], []
+
+            level = row[0]
+            rows = self._conn.execute(
+                "SELECT id, file_path FROM jobs WHERE level = ? AND status = 'queued'", (level,)
+            ).fetchall()
+            job_ids = [job_id for job_id, _ in rows]
+            self._conn.executemany(
+                "UPDATE jobs SET status = 'running', updated_at = ? WHERE id = ?",
+                [(time.time(), job_id) for job_id in job_ids]
+            )
+            self._conn.commit()
+        except Exception:
+            self._conn.rollback()
+            raise
+        return level, job_ids, sorted({file_path for _, file_path in rows})
+
+    def _finish(self, job_ids, error=None):
+        with self._wakeup:
+            self._conn.executemany(
+                "UPDATE jobs SET status = ?, error = ?, updated_at = ? WHERE id = ?",
+                [("failed" if error else "done", error, time.time(), job_id) for job_id in job_ids]
+            )
+            self._conn.commit()
+            # 该等级在同步期间可能又有新任务排队
+            self._wakeup.notify_all()
+
+    def _worker(self):
+        while True:
+            with self._wakeup:
+                level, job_ids, file_paths = self._claim()
+                while level is None:
+                    # 其他进程提交的任务不会唤醒这里, 定时检查一次
+                    self._wakeup.wait(Config.INGEST_POLL_INTERVAL)
+                    level, job_ids, file_paths = self._claim()
+
+            log_event("ingest_started", access_level=level, jobs=len(job_ids), files=len(file_paths))
+            try:
+                self.handler(level, file_paths)
+            except Exception as e:
+                log_event("ingest_failed", level=logging.ERROR, access_level=level, error=str(e),
+                          traceback=traceback.format_exc())
+                self._finish(job_ids, str(e))
+            else:
+                self._finish(job_ids)
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, level, file_path, username, status, error, created_at, updated_at "
+                "FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        return self._to_dict(row) if row else None
+
+    def list_jobs(self, levels, limit=20):
+        """最近的任务 (只包含给定等级)"""
+        if not levels:
+            return []
+        placeholders = ",".join("?" * len(levels))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, level, file_path, username, status, error, created_at, updated_at "
+                f"FROM jobs WHERE level IN ({placeholders}) ORDER BY created_at DESC LIMIT ?",
+                [*levels, limit]
+            ).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    @staticmethod
+    def _to_dict(row):
+        job_id, level, file_path, username, status, error, created_at, updated_at = row
+        return {
+            "id": job_id,
+            "level": level,
+            "file": os.path.basename(file_path),
+            "username": username,
+            "status": status,
+            "error": error,
+            "created_at": created_at,
+            "updated_at": updated_at
+        }
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall())
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "coalesced": self.coalesced
+        }
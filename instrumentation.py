@@ -0,0 +1,230 @@
+# instrumentation.py
+import contextvars
+import json
+import logging
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from config import Config
+
+# 延迟 histogram 的桶 (秒), 覆盖从毫秒级的检索到几分钟的本地生成
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+def _label_str(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{str(value)}"' for key, value in labels) + "}"
+
+def _format_value(value):
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+class Counter:
+    """只增不减的计数器, 按标签分别计数"""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for key, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_label_str(key)} {_format_value(value)}")
+        return lines
+
+class Histogram:
+    """按桶统计的分布 (Prometheus histogram: 累计桶计数, 总和, 次数)"""
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}   # 标签 -> [每个桶的计数..., 总和, 次数]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple((name, labels[name]) for name in self.labelnames)
+        with self._lock:
+            values = self._values.setdefault(key, [0] * len(self.buckets) + [0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+            values[-2] += value
+            values[-1] += 1
+
+    def collect(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, values in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, values):
+                    lines.append(f"{self.name}_bucket{_label_str(key + (('le', bound),))} {count}")
+                lines.append(f"{self.name}_bucket{_label_str(key + (('le', '+Inf'),))} {values[-1]}")
+                lines.append(f"{self.name}_sum{_label_str(key)} {values[-2]:.6f}")
+                lines.append(f"{self.name}_count{_label_str(key)} {values[-1]}")
+        return lines
+
+class Registry:
+    """所有指标, 以 Prometheus 文本格式输出
+
+    collector 是返回 [(name, type, help, labels, value)] 的函数, 用于导出各组件已有的统计 (缓存、连接池等)
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        described = set()
+        for collector in self._collectors:
+            try:
+                samples = collector()
+            except Exception as e:
+                log_event("metrics_collector_failed", level=logging.WARNING, error=str(e))
+                continue
+            for name, metric_type, documentation, labels, value in samples:
+                if name not in described:
+                    lines.append(f"# HELP {name} {documentation}")
+                    lines.append(f"# TYPE {name} {metric_type}")
+                    described.add(name)
+                lines.append(f"{name}{_label_str(sorted(labels.items()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "rag_stage_seconds", "Latency of each pipeline stage in seconds", ["stage"]
+))
+REQUESTS = REGISTRY.register(Counter(
+    "rag_requests_total", "Chat requests by backend and outcome", ["backend", "outcome"]
+))
+BACKEND_ERRORS = REGISTRY.register(Counter(
+    "rag_backend_errors_total", "Failed LLM backend calls", ["backend"]
+))
+INDEX_REBUILDS = REGISTRY.register(Counter(
+    "rag_index_rebuilds_total", "Level syncs that changed at least one file", ["level"]
+))
+INDEX_FILES_CHANGED = REGISTRY.register(Counter(
+    "rag_index_files_changed_total", "Files added, changed or removed by level syncs", ["level"]
+))
+LLM_ENDPOINT_SECONDS = REGISTRY.register(Histogram(
+    "rag_llm_endpoint_seconds", "Time to first token and total generation time per LLM endpoint", ["endpoint", "phase"]
+))
+GENERATION_QUEUE_WAIT = REGISTRY.register(Histogram(
+    "rag_generation_queue_wait_seconds", "Time a generation waited for a backend slot", ["backend", "level"]
+))
+GENERATION_BATCH_SIZE = REGISTRY.register(Histogram(
+    "rag_generation_batch_size", "Generations released to the local model together", ["backend"],
+    buckets=(1, 2, 3, 4, 6, 8, 12, 16, 32)
+))
+
+# 结构化日志: 每行一个 JSON 对象
+logger = logging.getLogger("rag")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(Config.LOG_LEVEL)
+    logger.propagate = False
+
+_current_trace = contextvars.ContextVar("rag_trace", default=None)
+
+def log_event(event, level=logging.INFO, **fields):
+    """输出一行结构化日志; 在请求的 trace 中调用时带上 trace_id"""
+    if not logger.isEnabledFor(level):
+        return
+    record = {"ts": round(time.time(), 3), "event": event}
+    trace = _current_trace.get()
+    if trace is not None:
+        record["trace_id"] = trace.id
+    record.update(fields)
+    logger.log(level, json.dumps(record, ensure_ascii=False, default=str))
+
+class Trace:
+    """一次请求 (或一次索引同步) 的各阶段耗时和附加字段, 结束时输出一行 trace 日志"""
+
+    def __init__(self, name, **fields):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.fields = fields
+        self.stages = {}
+        self.start_time = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_stage(self, stage, seconds):
+        # 同一阶段可能执行多次 (例如每个等级一次检索), 累加
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def set(self, **fields):
+        self.fields.update(fields)
+
+    def elapsed(self):
+        return time.perf_counter() - self.start_time
+
+    def finish(self):
+        total = self.elapsed()
+        STAGE_SECONDS.observe(total, stage=f"{self.name}_total")
+        with self._lock:
+            stages = {stage: round(seconds, 4) for stage, seconds in self.stages.items()}
+        log_event("trace", trace_id=self.id, name=self.name, total_seconds=round(total, 4),
+                  stages=stages, **self.fields)
+
+@contextmanager
+def start_trace(name, **fields):
+    """在当前上下文 (线程或 asyncio 任务) 中开始一个 trace, 其中的 timed() 都记录到这个 trace"""
+    trace = Trace(name, **fields)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        try:
+            _current_trace.reset(token)
+        except ValueError:
+            # 异步生成器在另一个上下文中被关闭
+            pass
+        trace.finish()
+
+def current_trace():
+    return _current_trace.get()
+
+def annotate(**fields):
+    """给当前 trace 添加字段 (不在 trace 中时忽略)"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.set(**fields)
+
+def record_stage(stage, seconds):
+    STAGE_SECONDS.observe(seconds, stage=stage)
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add_stage(stage, seconds)
+
+@contextmanager
+def timed(stage):
+    """记录一个阶段的耗时到 histogram 和当前 trace"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
@@ -0,0 +1,107 @@
+# keyword_index.py
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "give", "how", "in", "is",
+    "it", "of", "on", "or", "s", "the", "to", "was", "what", "when", "where", "which", "who", "with"
+}
+
+def tokenize(text):
+    return [token for token in re.findall(r"\w+", text.lower()) if token not in STOPWORDS]
+
+class KeywordIndex:
+    """内存中的 BM25 倒排索引, 每个权限等级一个, 和向量库使用相同的文档块 ID"""
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._docs = {}       # id -> (Document, 词频, 长度)
+        self._postings = defaultdict(set)
+        self._total_length = 0
+        self._lock = threading.RLock()
+
+    @classmethod
+    def from_collection(cls, collection):
+        """从已有的 Chroma collection 重建 (不需要 embedding)"""
+        from langchain_core.documents import Document
+        index = cls()
+        data = collection.get(include=["documents", "metadatas"])
+        docs = [
+            Document(page_content=text, metadata=metadata or {})
+            for text, metadata in zip(data["documents"], data["metadatas"])
+        ]
+        index.add(data["ids"], docs)
+        return index
+
+    def copy(self):
+        """复制一份索引, 在副本上更新, 完成后再整体替换已发布的索引"""
+        index = KeywordIndex(self.k1, self.b)
+        with self._lock:
+            index._docs = dict(self._docs)
+            index._postings = defaultdict(set, {term: set(ids) for term, ids in self._postings.items()})
+            index._total_length = self._total_length
+        return index
+
+    def add(self, ids, docs):
+        with self._lock:
+            for doc_id, doc in zip(ids, docs):
+                self._remove(doc_id)
+                terms = Counter(tokenize(doc.page_content))
+                length = sum(terms.values())
+                self._docs[doc_id] = (doc, terms, length)
+                self._total_length += length
+                for term in terms:
+                    self._postings[term].add(doc_id)
+
+    def remove(self, ids):
+        with self._lock:
+            for doc_id in ids:
+                self._remove(doc_id)
+
+    def _remove(self, doc_id):
+        entry = self._docs.pop(doc_id, None)
+        if entry is None:
+            return
+        _, terms, length = entry
+        self._total_length -= length
+        for term in terms:
+            postings = self._postings[term]
+            postings.discard(doc_id)
+            if not postings:
+                del self._postings[term]
+
+    def search(self, query, k):
+        """返回 [(Document, BM25 分数)], 分数从高到低"""
+        terms = tokenize(query)
+        with self._lock:
+            count = len(self._docs)
+            if not count or not terms:
+                return []
+            avg_length = self._total_length / count
+            scores = defaultdict(float)
+            for term in set(terms):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (count - len(postings) + 0.5) / (len(postings) + 0.5))
+                for doc_id in postings:
+                    _, tf, length = self._docs[doc_id]
+                    freq = tf[term]
+                    scores[doc_id] += idf * freq * (self.k1 + 1) / (
+                        freq + self.k1 * (1 - self.b + self.b * length / avg_length)
+                    )
+            ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(self._docs[doc_id][0], score) for doc_id, score in ranked]
+
+    def ids(self):
+        with self._lock:
+            return list(self._docs)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._docs
+
+    def __len__(self):
+        return len(self._docs)
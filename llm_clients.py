@@ -0,0 +1,165 @@
+# llm_clients.py
+import asyncio
+import json
+import httpx
+from config import Config
+
+# 这些状态码表示服务端没有处理请求, 重试是安全的
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+class PooledClient:
+    """长期复用的 httpx.AsyncClient: 连接池 + keep-alive, 连接/读取超时, 对未被处理的请求重试
+
+    只能在 AsyncRuntime 的事件循环中使用
+    """
+
+    def __init__(self, name, base_url, headers=None):
+        self.name = name
+        self.max_retries = Config.LLM_MAX_RETRIES
+        self.limits = httpx.Limits(
+            max_connections=Config.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=Config.LLM_MAX_KEEPALIVE
+        )
+        self.client = httpx.AsyncClient(
+            base_url=base_url,
+            headers=headers,
+            timeout=httpx.Timeout(
+                Config.LLM_READ_TIMEOUT,
+                connect=Config.LLM_CONNECT_TIMEOUT,
+                pool=Config.LLM_CONNECT_TIMEOUT
+            ),
+            # 连接失败时由 transport 重试
+            transport=httpx.AsyncHTTPTransport(limits=self.limits, retries=self.max_retries)
+        )
+        self.requests = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.retries = 0
+        self.errors = 0
+
+    async def _send(self, request):
+        for attempt in range(self.max_retries + 1):
+            response = await self.client.send(request, stream=True)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                return response
+            await response.aclose()
+            self.retries += 1
+            await asyncio.sleep(0.5 * (2 ** attempt))
+
+    async def get(self, url, timeout=None):
+        """简单的 GET 请求 (健康检查), 不重试"""
+        return await self.client.get(url, timeout=timeout)
+
+    def stream(self, url, payload):
+        return _TrackedStream(self, url, payload)
+
+    def stats(self):
+        return {
+            "requests": self.requests,
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "max_connections": self.limits.max_connections,
+            "max_keepalive_connections": self.limits.max_keepalive_connections,
+            "retries": self.retries,
+            "errors": self.errors
+        }
+
+    async def aclose(self):
+        await self.client.aclose()
+
+class _TrackedStream:
+    """async with 包装: 统计同时占用连接的请求数"""
+
+    def __init__(self, pooled, url, payload):
+        self.pooled = pooled
+        self.request = pooled.client.build_request("POST", url, json=payload)
+        self.response = None
+
+    async def __aenter__(self):
+        pooled = self.pooled
+        pooled.requests += 1
+        pooled.in_flight += 1
+        pooled.peak_in_flight = max(pooled.peak_in_flight, pooled.in_flight)
+        try:
+            self.response = await pooled._send(self.request)
+        except Exception:
+            pooled.in_flight -= 1
+            pooled.errors += 1
+            raise
+        return self.response
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.pooled.in_flight -= 1
+        if exc_type is not None:
+            self.pooled.errors += 1
+        await self.response.aclose()
+
+class OllamaClient:
+    """Ollama /api/chat 客户端"""
+
+    def __init__(self, base_url=None, model=None):
+        self.model = model or Config.OLLAMA_MODEL
+        self.pool = PooledClient("ollama", base_url or Config.OLLAMA_BASE_URL)
+
+    def _payload(self, messages, stream):
+        return {
+            "model": self.model,
+            "messages": messages,
+            "stream": stream,
+            "options": {"temperature": 0.7}
+        }
+
+    async def stream_chat(self, messages):
+        """逐个返回 token (Ollama 返回的是每行一个 JSON)"""
+        async with self.pool.stream("/api/chat", self._payload(messages, True)) as response:
+            if response.status_code != 200:
+                raise httpx.HTTPStatusError(
+                    f"Ollama error {response.status_code}: {(await response.aread()).decode()}",
+                    request=response.request, response=response
+                )
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                content = data.get("message", {}).get("content")
+                if content:
+                    yield content
+                if data.get("done"):
+                    break
+
+class DeepSeekClient:
+    """DeepSeek chat completions 客户端"""
+
+    def __init__(self, api_url=None, api_key=None):
+        self.api_url = api_url or Config.DEEPSEEK_API_URL
+        self.pool = PooledClient("deepseek", "", headers={
+            "Authorization": f"Bearer {api_key or Config.DEEPSEEK_API_KEY}",
+            "Content-Type": "application/json"
+        })
+
+    def _payload(self, messages, stream):
+        return {
+            "model": "deepseek-chat",
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": 2000,
+            "stream": stream
+        }
+
+    async def stream_chat(self, messages):
+        """逐个返回 token (server-sent events); 出错时抛出 httpx.HTTPStatusError"""
+        async with self.pool.stream(self.api_url, self._payload(messages, True)) as response:
+            if response.status_code != 200:
+                raise httpx.HTTPStatusError(
+                    f"DeepSeek API error: {(await response.aread()).decode()}",
+                    request=response.request, response=response
+                )
+            async for line in response.aiter_lines():
+                if not line or not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                delta = json.loads(payload)["choices"][0]["delta"].get("content")
+                if delta:
+                    yield delta
@@ -0,0 +1,279 @@
+# llm_router.py
+import asyncio
+import logging
+import time
+from collections import deque
+from config import Config
+from llm_clients import DeepSeekClient, OllamaClient
+from instrumentation import LLM_ENDPOINT_SECONDS, annotate, log_event
+
+class NoEndpointError(Exception):
+    """没有可用的 LLM 端点"""
+
+class FirstTokenTimeout(Exception):
+    """端点在 LLM_FIRST_TOKEN_TIMEOUT 内没有返回首个 token"""
+
+class Endpoint:
+    """一个 LLM 端点 (Ollama 实例或 DeepSeek): 客户端, 正在处理的请求数, 健康状态, 最近的延迟"""
+
+    def __init__(self, name, backend, client):
+        self.name = name
+        self.backend = backend
+        self.client = client
+        self.outstanding = 0
+        self.healthy = True
+        self.failures = 0   # 连续失败次数
+        self.requests = 0
+        self.errors = 0
+        self.timeouts = 0
+        # 最近的首 token 延迟 (对冲请求的阈值) 和完整生成时间
+        self.first_token_latencies = deque(maxlen=Config.LLM_LATENCY_WINDOW)
+        self.total_latencies = deque(maxlen=Config.LLM_LATENCY_WINDOW)
+
+    def percentile(self, p, latencies=None):
+        values = sorted(self.first_token_latencies if latencies is None else latencies)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+    def record_first_token(self, seconds):
+        self.failures = 0
+        self.first_token_latencies.append(seconds)
+        LLM_ENDPOINT_SECONDS.observe(seconds, endpoint=self.name, phase="first_token")
+
+    def record_total(self, seconds):
+        self.total_latencies.append(seconds)
+        LLM_ENDPOINT_SECONDS.observe(seconds, endpoint=self.name, phase="total")
+
+    def record_failure(self, error):
+        self.errors += 1
+        self.failures += 1
+        if isinstance(error, FirstTokenTimeout):
+            self.timeouts += 1
+        log_event("llm_endpoint_failed", level=logging.WARNING, endpoint=self.name, error=str(error) or type(error).__name__)
+        if self.healthy and self.failures >= Config.LLM_UNHEALTHY_AFTER:
+            self.healthy = False
+            log_event("llm_endpoint_unhealthy", level=logging.WARNING, endpoint=self.name, failures=self.failures)
+
+    def stats(self):
+        return {
+            "backend": self.backend,
+            "healthy": self.healthy,
+            "outstanding": self.outstanding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "timeouts": self.timeouts,
+            "first_token_p50": self.percentile(50),
+            "first_token_p95": self.percentile(95),
+            "total_p50": self.percentile(50, self.total_latencies),
+            "total_p95": self.percentile(95, self.total_latencies),
+            "pool": self.client.pool.stats()
+        }
+
+class _Attempt:
+    """在一个端点上进行的一次流式生成, next 是等待下一个 token 的任务"""
+
+    def __init__(self, endpoint, messages):
+        self.endpoint = endpoint
+        self.start = time.perf_counter()
+        self.deadline = self.start + Config.LLM_FIRST_TOKEN_TIMEOUT
+        self.tokens = endpoint.client.stream_chat(messages[endpoint.backend])
+        self.next = asyncio.ensure_future(self.tokens.__anext__())
+        self.closed = False
+        endpoint.requests += 1
+        endpoint.outstanding += 1
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.endpoint.outstanding -= 1
+        # 先等被取消的任务结束, 再关闭生成器 (释放 HTTP 连接)
+        self.next.cancel()
+        await asyncio.gather(self.next, return_exceptions=True)
+        try:
+            await self.tokens.aclose()
+        except Exception:
+            pass
+
+class LLMRouter:
+    """把生成请求分配到多个 Ollama 实例 (和 DeepSeek)
+
+    - 选择正在处理的请求最少的健康端点
+    - 首个 token 之前超时或出错时换下一个端点, 一个后端都失败时换另一个后端 (LLM_FAILOVER)
+    - 可选的对冲请求: 等待超过该端点最近延迟的 LLM_HEDGE_PERCENTILE 时, 在另一个空闲端点上再发一次
+    - 后台健康检查, 连续失败的端点暂时不再分配
+
+    只在 AsyncRuntime 的事件循环中使用, 所以计数不需要加锁
+    """
+
+    def __init__(self, ollama_urls=None, deepseek_client=None):
+        self.ollama = [
+            Endpoint(url, "ollama", OllamaClient(base_url=url))
+            for url in (ollama_urls or Config.OLLAMA_BASE_URLS)
+        ]
+        self.deepseek = Endpoint("deepseek", "deepseek", deepseek_client or DeepSeekClient())
+        self.failovers = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def _pool(self, backend):
+        if backend == "deepseek":
+            return [self.deepseek] if Config.DEEPSEEK_API_KEY else []
+        return self.ollama
+
+    def _next_endpoint(self, backend, tried):
+        """下一个要尝试的端点: 先是所选后端中最空闲的健康端点, 然后是另一个后端"""
+        if len(tried) >= Config.LLM_MAX_ATTEMPTS:
+            return None
+        backends = [backend]
+        if Config.LLM_FAILOVER:
+            backends.append("ollama" if backend == "deepseek" else "deepseek")
+        for name in backends:
+            candidates = [endpoint for endpoint in self._pool(name) if endpoint not in tried]
+            # 全部不健康时仍然尝试 (健康状态可能已经过时)
+            healthy = [endpoint for endpoint in candidates if endpoint.healthy] or candidates
+            if healthy:
+                return min(healthy, key=lambda endpoint: (endpoint.outstanding, endpoint.percentile(50) or 0))
+        return None
+
+    def _hedge_endpoint(self, backend, tried):
+        """对冲请求只发给同一后端中还有空闲并发的健康端点"""
+        if backend != "ollama":
+            return None
+        candidates = [
+            endpoint for endpoint in self.ollama
+            if endpoint not in tried and endpoint.healthy and endpoint.outstanding < Config.OLLAMA_MAX_CONCURRENCY
+        ]
+        return min(candidates, key=lambda endpoint: endpoint.outstanding) if candidates else None
+
+    def _hedge_delay(self, endpoint):
+        if not Config.LLM_HEDGE_PERCENTILE or len(endpoint.first_token_latencies) < Config.LLM_HEDGE_MIN_SAMPLES:
+            return None
+        return endpoint.percentile(Config.LLM_HEDGE_PERCENTILE)
+
+    async def _open(self, backend, messages):
+        """等到某个端点返回首个 token, 返回 (attempt, token); 其他进行中的请求被取消"""
+        tried = []
+        attempts = []
+        hedge_at = None
+        last_error = None
+        try:
+            while True:
+                if not attempts:
+                    endpoint = self._next_endpoint(backend, tried)
+                    if endpoint is None:
+                        raise last_error or NoEndpointError(f"no {backend} endpoint available")
+                    if tried:
+                        self.failovers += 1
+                        log_event("llm_failover", level=logging.WARNING, endpoint=endpoint.name, attempt=len(tried) + 1)
+                    tried.append(endpoint)
+                    attempts.append(_Attempt(endpoint, messages))
+                    delay = self._hedge_delay(endpoint) if len(tried) == 1 else None
+                    hedge_at = attempts[0].start + delay if delay is not None else None
+
+                # 没有其他端点可换时不设首 token 超时, 只受 HTTP 读取超时限制
+                can_failover = self._next_endpoint(backend, tried) is not None
+                now = time.perf_counter()
+                wakeups = [attempt.deadline for attempt in attempts] if can_failover else []
+                if hedge_at is not None:
+                    wakeups.append(hedge_at)
+                timeout = max(0.0, min(wakeups) - now) if wakeups else None
+                await asyncio.wait([attempt.next for attempt in attempts], timeout=timeout,
+                                   return_when=asyncio.FIRST_COMPLETED)
+
+                for attempt in list(attempts):
+                    if attempt.next.done():
+                        try:
+                            token = attempt.next.result()
+                        except StopAsyncIteration:
+                            token = ""
+                        except Exception as e:
+                            last_error = e
+                            attempt.endpoint.record_failure(e)
+                            attempts.remove(attempt)
+                            await attempt.close()
+                            continue
+                        attempt.endpoint.record_first_token(time.perf_counter() - attempt.start)
+                        if attempt is not attempts[0]:
+                            self.hedge_wins += 1
+                        attempts.remove(attempt)
+                        annotate(llm_endpoint=attempt.endpoint.name, llm_attempts=len(tried))
+                        return attempt, token
+
+                now = time.perf_counter()
+                if can_failover:
+                    for attempt in list(attempts):
+                        if now >= attempt.deadline:
+                            last_error = FirstTokenTimeout(
+                                f"{attempt.endpoint.name} sent no token in {Config.LLM_FIRST_TOKEN_TIMEOUT} seconds"
+                            )
+                            attempt.endpoint.record_failure(last_error)
+                            attempts.remove(attempt)
+                            await attempt.close()
+                if hedge_at is not None and now >= hedge_at and attempts:
+                    hedge_at = None
+                    endpoint = self._hedge_endpoint(backend, tried)
+                    if endpoint is not None:
+                        self.hedges += 1
+                        tried.append(endpoint)
+                        attempts.append(_Attempt(endpoint, messages))
+                        annotate(llm_hedged=True)
+        finally:
+            for attempt in attempts:
+                await attempt.close()
+
+    async def stream_chat(self, backend, messages):
+        """逐个返回 token; messages 是 {"ollama": [...], "deepseek": [...]}, 换后端时使用对应的格式
+
+        首个 token 之后出错不再重试 (已经返回的内容无法撤回), 直接抛出
+        """
+        attempt, token = await self._open(backend, messages)
+        endpoint = attempt.endpoint
+        try:
+            if token:
+                yield token
+            async for token in attempt.tokens:
+                yield token
+            endpoint.record_total(time.perf_counter() - attempt.start)
+        except Exception as e:
+            endpoint.record_failure(e)
+            raise
+        finally:
+            await attempt.close()
+
+    async def chat(self, backend, messages):
+        """完整回复; 内部使用流式请求, 这样首 token 超时和对冲同样适用"""
+        return "".join([token async for token in self.stream_chat(backend, messages)])
+
+    async def check_health(self):
+        """检查所有 Ollama 端点, 恢复或标记健康状态"""
+        for endpoint in self.ollama:
+            try:
+                response = await endpoint.client.pool.get("/api/version", timeout=Config.LLM_CONNECT_TIMEOUT)
+                healthy = response.status_code == 200
+            except Exception:
+                healthy = False
+            if healthy != endpoint.healthy:
+                log_event("llm_endpoint_healthy" if healthy else "llm_endpoint_unhealthy",
+                          level=logging.INFO if healthy else logging.WARNING, endpoint=endpoint.name)
+            endpoint.healthy = healthy
+            if healthy:
+                endpoint.failures = 0
+
+    async def run_health_checks(self):
+        """后台任务: 每 LLM_HEALTH_INTERVAL 秒检查一次"""
+        while Config.LLM_HEALTH_INTERVAL:
+            await self.check_health()
+            await asyncio.sleep(Config.LLM_HEALTH_INTERVAL)
+
+    def endpoints(self):
+        return self.ollama + [self.deepseek]
+
+    def stats(self):
+        return {
+            "failovers": self.failovers,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "endpoints": {endpoint.name: endpoint.stats() for endpoint in self.endpoints()}
+        }
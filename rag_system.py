@@ -1,185 +1,530 @@
 # rag_system.py
+import logging
 import os
 import time
-import traceback
-from langchain_community.document_loaders import (
-    TextLoader, PyPDFLoader, Docx2txtLoader, 
-    JSONLoader, CSVLoader, UnstructuredMarkdownLoader,
-    UnstructuredExcelLoader
-)
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain_community.chat_models import ChatOllama
-from langchain.prompts import ChatPromptTemplate
 from config import Config
-from file_manager import FileManager
-import requests
+from async_runtime import AsyncRuntime, BackendBusyError, BackendLimiter, GenerationScheduler
+from answer_cache import AnswerCache
+from keyword_index import KeywordIndex
+from context_builder import ContextBuilder
+from structured_store import StructuredStore, format_answer, format_records, parse_structured_file, unanswered_terms
+from instrumentation import BACKEND_ERRORS, GENERATION_QUEUE_WAIT, INDEX_FILES_CHANGED, INDEX_REBUILDS, \
+    REQUESTS, annotate, log_event, record_stage, start_trace, timed
+from file_watcher import FileCatalog
+from document_loader import create_text_splitter, load_and_split_files, load_file
+from index_manifest import IndexManifest, chunk_ids, file_hash
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+import threading
 import json
 
-file_manager = FileManager()
+# Chroma, LangChain 的 prompt/切分器和 LLM 客户端 (httpx) 导入很慢, 第一次使用时才导入;
+# 多进程部署的 worker 完全不需要 Chroma. warm_up() 可以在接收请求之前提前完成这些导入.
+
+# 后端返回的这些错误信息不写入回复缓存
+ERROR_RESPONSES = (
+    "An error occurred",
+    "DeepSeek API error",
+    "Ollama error",
+    "DeepSeek API key not configured",
+    "API request failed"
+)
+
+def chunk_id(doc):
+    """文档块的稳定 ID; 没有记录 ID 的旧向量用内容 hash 代替"""
+    return doc.metadata.get("chunk_id") or hashlib.sha1(doc.page_content.encode("utf-8")).hexdigest()
+
+def fuse_results(rankings, k):
+    """加权 reciprocal rank fusion: 每个排名列表贡献 weight / (HYBRID_RRF_K + 名次)"""
+    scores = {}
+    docs = {}
+    for ranked_docs, weight in rankings:
+        for rank, doc in enumerate(ranked_docs, start=1):
+            doc_id = chunk_id(doc)
+            docs.setdefault(doc_id, doc)
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (Config.HYBRID_RRF_K + rank)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[doc_id] for doc_id in ranked]
+
+def format_context(docs):
+    return "\n\n".join([doc.page_content for doc in docs])
+
+OLLAMA_TEMPLATE = """
+            <s>[INST] <<SYS>>
+            You are an AI assistant that answers questions based on the provided context.
+            If the context is insufficient, answer based on your knowledge.
+            Respond in English.
+            <</SYS>>
+            
+            Context:
+            {context}
+            
+            Conversation History:
+            {history}
+            
+            Question: {question} [/INST]
+            """
 
 class RAGSystem:
     def __init__(self):
-        self.embeddings = OllamaEmbeddings(model=Config.OLLAMA_MODEL)
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=Config.CHUNK_SIZE,
-            chunk_overlap=Config.CHUNK_OVERLAP
-        )
-        self.vectorstore = None
-        self.last_user = None
-        self.last_access_level = None
+        # 保护延迟创建的组件 (embeddings, LLM 路由, prompt 模板, 切分器)
+        self._lazy_lock = threading.Lock()
+        # 磁盘缓存包装 Ollama embeddings, 相同文本块不会重复计算; 第一次使用时创建
+        self._embeddings = None
+        # 每个等级的文件列表, 启动时扫描一次, 之后由 DataWatcher 和索引任务更新, 请求中不再遍历目录
+        self.file_catalog = FileCatalog()
+        # 每个权限等级一个持久化的 Chroma collection
+        # 读多写少: 这个字典发布后不再修改, 更新时整体替换 (copy-on-write), 读者无需加锁
+        self.vectorstores = {}
+        # 每个等级的 BM25 关键词索引, 和向量库在同一次同步中更新
+        self.keyword_indexes = {}
+        self._publish_lock = threading.Lock()
+        self._chroma_client = None
+        # 同一等级的索引更新串行执行
+        self._level_locks = {level: threading.Lock() for level in Config.ACCESS_LEVELS}
+        # 所有生成请求共享一个事件循环, 每个后端有自己的并发上限; 本地模型的请求按优先级分批放行
+        self.runtime = AsyncRuntime()
+        self.limiters = {
+            "ollama": GenerationScheduler("ollama", Config.OLLAMA_MAX_CONCURRENCY * len(Config.OLLAMA_BASE_URLS)),
+            "deepseek": BackendLimiter("deepseek", Config.DEEPSEEK_MAX_CONCURRENCY)
+        }
+        # 长期复用的后端客户端 (连接池 + keep-alive), 由路由分配到各个端点; 第一次生成时创建.
+        # prompt 模板只解析一次
+        self._router = None
+        self._ollama_prompt = None
+        self._text_splitter = None
+        self.context_builder = ContextBuilder(OLLAMA_TEMPLATE)
+        # JSON/CSV/Excel 的实体/字段表, 查询类问题可以不经过 LLM
+        self.structured_store = StructuredStore()
+        # 完整回复的缓存, 按权限等级隔离
+        self.answer_cache = AnswerCache()
+        # 多进程部署: writer 每次发布索引后导出只读快照; worker 只打开快照 (不打开 Chroma, 不写索引),
+        # 后台线程发现新一代后整体替换
+        self.snapshot_writer = None
+        self.snapshot_reader = None
+        if Config.SERVING_ROLE == "writer":
+            from index_snapshot import SnapshotWriter
+            self.snapshot_writer = SnapshotWriter()
+        elif Config.SERVING_ROLE == "worker":
+            from index_snapshot import SnapshotLevel, SnapshotReader
+            self.snapshot_reader = SnapshotReader()
+            empty = SnapshotLevel()
+            for level in Config.ACCESS_LEVELS:
+                self._publish(level, empty, empty)
+            self.reload_snapshot()
+            threading.Thread(target=self._watch_snapshots, name="snapshot-watcher", daemon=True).start()
+    
+    @property
+    def embeddings(self):
+        # 延迟创建; 已经创建后读取不加锁
+        if self._embeddings is None:
+            with self._lazy_lock:
+                if self._embeddings is None:
+                    from batch_embedder import OllamaBatchEmbeddings
+                    from embedding_cache import CachedEmbeddings
+                    self._embeddings = CachedEmbeddings(
+                        OllamaBatchEmbeddings(model=Config.OLLAMA_MODEL),
+                        model_name=Config.OLLAMA_MODEL
+                    )
+        return self._embeddings
+    
+    @embeddings.setter
+    def embeddings(self, embeddings):
+        self._embeddings = embeddings
+    
+    @property
+    def router(self):
+        if self._router is None:
+            with self._lazy_lock:
+                if self._router is None:
+                    from llm_router import LLMRouter
+                    self._router = LLMRouter()
+                    if Config.LLM_HEALTH_INTERVAL:
+                        self.runtime.submit(self._router.run_health_checks())
+        return self._router
+    
+    @property
+    def ollama_prompt(self):
+        if self._ollama_prompt is None:
+            with self._lazy_lock:
+                if self._ollama_prompt is None:
+                    from langchain.prompts import ChatPromptTemplate
+                    self._ollama_prompt = ChatPromptTemplate.from_template(OLLAMA_TEMPLATE)
+        return self._ollama_prompt
+    
+    @property
+    def text_splitter(self):
+        if self._text_splitter is None:
+            with self._lazy_lock:
+                if self._text_splitter is None:
+                    self._text_splitter = create_text_splitter()
+        return self._text_splitter
     
     def load_documents(self, file_paths):
         documents = []
-        print(f"Loading {len(file_paths)} documents...")
         for file_path in file_paths:
-            # 确保文件存在
-            if not os.path.exists(file_path):
-                print(f"File not found: {file_path}")
-                continue
-                
-            ext = os.path.splitext(file_path)[1].lower()
-            try:
-                print(f"Loading document: {file_path}")
-                if ext == '.pdf':
-                    loader = PyPDFLoader(file_path)
-                elif ext in ['.docx', '.doc']:
-                    loader = Docx2txtLoader(file_path)
-                elif ext == '.json':
-                    loader = JSONLoader(file_path, jq_schema='.', text_content=False)
-                elif ext == '.csv':
-                    loader = CSVLoader(file_path)
-                elif ext in ['.xlsx', '.xls']:
-                    loader = UnstructuredExcelLoader(file_path)
-                elif ext == '.md':
-                    loader = UnstructuredMarkdownLoader(file_path)
-                else:  # txt and others
-                    loader = TextLoader(file_path)
-                
-                docs = loader.load()
-                print(f"Loaded {len(docs)} chunks from {file_path}")
-                documents.extend(docs)
-            except Exception as e:
-                print(f"Error loading {file_path}: {str(e)}")
-                continue
+            documents.extend(load_file(file_path))
         
-        print(f"Total loaded chunks: {len(documents)}")
+        log_event("documents_loaded", files=len(file_paths), chunks=len(documents))
         return documents
     
-    def create_vectorstore(self, documents):
-        if not documents:
-            print("No documents to create vector store")
-            return None
+    def _collection_name(self, level):
+        return f"{Config.CHROMA_COLLECTION_PREFIX}_{level}"
+    
+    def _open_vectorstore(self, level):
+        """打开(或创建)某个权限等级的持久化 collection"""
+        from langchain_community.vectorstores import Chroma
+        return Chroma(
+            client=self._get_chroma_client(),
+            collection_name=self._collection_name(level),
+            embedding_function=self.embeddings
+        )
+    
+    def _get_chroma_client(self):
+        """所有等级共用一个 Chroma 客户端; 并发创建客户端不是线程安全的, 需要加锁"""
+        with self._publish_lock:
+            if self._chroma_client is None:
+                import chromadb
+                os.makedirs(Config.CHROMA_DB_DIR, exist_ok=True)
+                self._chroma_client = chromadb.PersistentClient(path=Config.CHROMA_DB_DIR)
+            return self._chroma_client
+    
+    def index_files(self, level, vectorstore, keywords, manifest, changed_files):
+        """重新切分并索引变化的文件, 返回不再使用的旧文档块 ID
+        
+        所有文件的文档块一起交给 embeddings, 由批量接口分批并发计算.
+        新块写入 collection, 但只加入 keywords (尚未发布的副本); 旧块由 _apply 在发布后删除.
+        出错时 manifest 不变, 下次同步会重试这些文件.
+        """
+        split_docs = []
+        ids = []
+        stale_ids = []
+        entries = []
+        # 加载和切分是 CPU 密集的, 在进程池中并行完成
+        split_results = load_and_split_files([file_path for file_path, _, _ in changed_files])
+        for (file_path, stat, digest), file_docs in zip(changed_files, split_results):
+            log_event("file_split", file=file_path, chunks=len(file_docs))
+            file_ids = chunk_ids(file_path, len(file_docs), digest)
+            for doc, doc_id in zip(file_docs, file_ids):
+                doc.metadata["chunk_id"] = doc_id
+            
+            entry = manifest.get(file_path)
+            if entry:
+                stale_ids.extend(set(entry["chunk_ids"]) - set(file_ids))
+            split_docs.extend(file_docs)
+            ids.extend(file_ids)
+            entries.append((file_path, stat, digest, file_ids))
+        
+        if split_docs:
+            # 相同 ID 的块会被覆盖 (upsert); embedding 的耗时由 embeddings 自己记录
+            with timed("index_write"):
+                vectorstore.add_documents(split_docs, ids=ids)
+                keywords.add(ids, split_docs)
+        if stale_ids:
+            keywords.remove(stale_ids)
+        # 加载失败的文件也记录下来 (没有文档块), 内容不变就不再重试
+        for file_path, stat, digest, file_ids in entries:
+            manifest.set(file_path, stat.st_size, stat.st_mtime_ns, digest, file_ids)
+        return stale_ids
+    
+    def index_structured(self, level, file_path):
+        """结构化文件同时写入本地表"""
+        if not self.structured_store.is_structured(file_path):
+            return
+        try:
+            self.structured_store.replace_file(level, file_path, parse_structured_file(file_path))
+        except Exception as e:
+            log_event("structured_parse_failed", level=logging.WARNING, file=file_path, error=str(e))
+    
+    def sync_level(self, level, vectorstore=None, keywords=None, file_paths=None):
+        """根据 manifest 增量计算某个等级的新索引: 只处理新增、修改、删除的文件
+        
+        file_paths 为 None 时检查文件目录中该等级的所有文件, 否则只检查这些文件.
+        已发布的 keywords 不会被修改, 变化写入它的副本. 返回 (vectorstore, keywords, pending),
+        由 _apply 发布新索引, 之后再删除旧文档块、更新结构化表和 manifest.
+        """
+        vectorstore = vectorstore or self._open_vectorstore(level)
+        manifest = IndexManifest(level)
+        stale_ids = []
+        
+        # 旧版本的 collection 没有 manifest, 无法对应文件, 清空后重建
+        if not manifest.exists and vectorstore._collection.count() > 0:
+            log_event("collection_reset", level=logging.WARNING, access_level=level, reason="no manifest")
+            vectorstore.delete_collection()
+            vectorstore = self._open_vectorstore(level)
+            keywords = None
         
-        # 分割文档
-        split_docs = self.text_splitter.split_documents(documents)
-        print(f"Documents split into {len(split_docs)} chunks")
+        if keywords is None:
+            # 关键词索引只在内存中, 进程启动后从 collection 的文本重建
+            keywords = KeywordIndex.from_collection(vectorstore._collection)
+            # 上次写入新块后没来得及更新 manifest (例如进程退出) 留下的块
+            known = {doc_id for path in manifest.paths() for doc_id in manifest.get(path)["chunk_ids"]}
+            stale_ids = [doc_id for doc_id in vectorstore._collection.get(include=[])["ids"] if doc_id not in known]
+            keywords.remove(stale_ids)
+        
+        if file_paths is None:
+            level_files = self.file_catalog.files(level)
+            removed_files = manifest.paths() - set(level_files)
+        else:
+            self.file_catalog.update(level, file_paths)
+            file_paths = {os.path.normpath(file_path) for file_path in file_paths}
+            level_files = [file_path for file_path in file_paths if file_path in self.file_catalog]
+            removed_files = (file_paths - set(level_files)) & manifest.paths()
+        changed_files = []
+        with timed("file_listing"):
+            for file_path in level_files:
+                try:
+                    stat = os.stat(file_path)
+                    if manifest.is_unchanged(file_path, stat):
+                        # 结构化表是后加的, 已索引的文件补写一次
+                        if self.structured_store.is_structured(file_path) and not self.structured_store.has_file(file_path):
+                            self.index_structured(level, file_path)
+                        continue
+                    digest = file_hash(file_path)
+                    entry = manifest.get(file_path)
+                    if entry and entry["sha256"] == digest:
+                        # 只是 mtime 变了, 内容相同
+                        manifest.set(file_path, stat.st_size, stat.st_mtime_ns, digest, entry["chunk_ids"])
+                        continue
+                    changed_files.append((file_path, stat, digest))
+                except Exception as e:
+                    log_event("file_check_failed", level=logging.WARNING, file=file_path, error=str(e))
+        
+        if (changed_files or removed_files) and keywords is self.keyword_indexes.get(level):
+            keywords = keywords.copy()
+        
+        indexed_files = []
+        if changed_files:
+            try:
+                stale_ids.extend(self.index_files(level, vectorstore, keywords, manifest, changed_files))
+                indexed_files = [file_path for file_path, _, _ in changed_files]
+            except Exception as e:
+                log_event("index_failed", level=logging.ERROR, access_level=level, error=str(e))
         
-        # 确保 ChromaDB 目录存在
-        os.makedirs(Config.CHROMA_DB_DIR, exist_ok=True)
+        # 已经不存在的文件
+        for file_path in removed_files:
+            entry = manifest.remove(file_path)
+            if entry["chunk_ids"]:
+                stale_ids.extend(entry["chunk_ids"])
+                keywords.remove(entry["chunk_ids"])
         
+        pending = {
+            "manifest": manifest,
+            "stale_ids": stale_ids,
+            "indexed_files": indexed_files,
+            "removed_files": removed_files,
+            "total_files": len(self.file_catalog.files(level))
+        }
+        return vectorstore, keywords, pending
+    
+    def _apply(self, level, vectorstore, keywords, pending):
+        """发布 sync_level 的结果: 新索引对检索整体可见, 然后清理旧数据"""
+        self._publish(level, vectorstore, keywords)
+        for file_path in pending["indexed_files"]:
+            self.index_structured(level, file_path)
+        for file_path in pending["removed_files"]:
+            self.structured_store.remove_file(file_path)
+        # 发布之后旧块已经不会被检索到, 再从 collection 中删除
+        if pending["stale_ids"]:
+            vectorstore.delete(ids=pending["stale_ids"])
+        pending["manifest"].save()
+        
+        changed = len(pending["indexed_files"]) + len(pending["removed_files"])
+        if self.snapshot_writer is not None and (changed or not self.snapshot_writer.has_level(level)):
+            with timed("snapshot_export"):
+                self.snapshot_writer.publish(level, vectorstore._collection, keywords.ids())
+        if changed:
+            self.answer_cache.invalidate_level(level)
+            INDEX_REBUILDS.inc(level=level)
+            INDEX_FILES_CHANGED.inc(changed, level=level)
+        annotate(files_changed=changed, files_total=pending["total_files"])
+    
+    def _publish(self, level, vectorstore, keywords):
+        """复制后替换 vectorstores / keyword_indexes 字典, 正在检索的请求继续使用旧的快照"""
+        with self._publish_lock:
+            keyword_indexes = dict(self.keyword_indexes)
+            keyword_indexes[level] = keywords
+            self.keyword_indexes = keyword_indexes
+            vectorstores = dict(self.vectorstores)
+            vectorstores[level] = vectorstore
+            self.vectorstores = vectorstores
+    
+    def reload_snapshot(self):
+        """worker 进程: 打开新一代快照中变化的等级并整体替换, 正在检索的请求继续使用旧的快照"""
         try:
-            # 创建向量存储 - 使用外部存储路径
-            vectorstore = Chroma.from_documents(
-                documents=split_docs, 
-                embedding=self.embeddings,
-                persist_directory=Config.CHROMA_DB_DIR
-            )
-            print(f"Vector store created successfully at {Config.CHROMA_DB_DIR}")
+            opened = self.snapshot_reader.poll()
+        except Exception as e:
+            # 例如刚读到的一代已经被 writer 清理, 下次检查时重试
+            log_event("snapshot_load_failed", level=logging.WARNING, error=str(e))
+            return
+        for level, snapshot in opened.items():
+            self._publish(level, snapshot, snapshot)
+            self.answer_cache.invalidate_level(level)
+        if opened:
+            log_event("index_generation_loaded", generation=self.snapshot_reader.generation,
+                      levels=sorted(opened), chunks={level: len(snapshot) for level, snapshot in opened.items()})
+    
+    def _watch_snapshots(self):
+        while True:
+            time.sleep(Config.SNAPSHOT_POLL_INTERVAL)
+            self.reload_snapshot()
+    
+    def get_vectorstore(self, level):
+        """获取某个等级的向量库, 首次打开时做一次增量同步 (worker 进程中是已经打开的快照)"""
+        vectorstore = self.vectorstores.get(level)
+        if vectorstore is not None:
             return vectorstore
+        
+        with self._level_locks[level]:
+            # 等锁期间其他线程可能已经建好了
+            vectorstore = self.vectorstores.get(level)
+            if vectorstore is None:
+                with start_trace("index_sync", access_level=level, reason="open"):
+                    vectorstore, keywords, pending = self.sync_level(level)
+                    self._apply(level, vectorstore, keywords, pending)
+        return vectorstore
+    
+    def refresh_level(self, level, file_paths=None):
+        """增量刷新某个等级的索引 (例如上传新文件后); 完成前检索继续使用旧索引
+        
+        file_paths 为 None 时重新扫描该等级的目录, 否则只处理这些文件
+        """
+        if self.snapshot_reader is not None:
+            raise RuntimeError("the index is read-only in worker processes; ingestion runs in the writer")
+        with self._level_locks[level], start_trace("index_sync", access_level=level, reason="refresh"):
+            if file_paths is None or level not in self.vectorstores:
+                # 本进程还没同步过这个等级时需要完整同步一次
+                with timed("file_listing"):
+                    self.file_catalog.scan(level)
+                file_paths = None
+            vectorstore, keywords, pending = self.sync_level(
+                level, self.vectorstores.get(level), self.keyword_indexes.get(level), file_paths
+            )
+            self._apply(level, vectorstore, keywords, pending)
+        return vectorstore
+    
+    def warm_up(self):
+        """接收请求之前预热: 打开 (或同步) 各等级的索引并读进内存, 完成延迟的导入 (prompt 模板, tokenizer,
+        LLM 客户端), 建立后端连接, 让 Ollama 加载 embedding 模型"""
+        start = time.perf_counter()
+        for level in Config.ACCESS_LEVELS:
+            vectorstore = self.get_vectorstore(level)
+            # 快照: 把向量矩阵和 SQLite 文件读进页缓存
+            if hasattr(vectorstore, "warm_up"):
+                vectorstore.warm_up()
+        self._llm_messages("warm up", "", [])
+        self.context_builder.counter.count("warm up")
+        try:
+            self.embeddings.embed_query("warm up")
         except Exception as e:
-            print(f"Error creating vector store: {str(e)}")
-            return None
+            log_event("warm_up_failed", level=logging.WARNING, component="embeddings", error=str(e))
+        try:
+            self.runtime.run(self.router.check_health())
+        except Exception as e:
+            log_event("warm_up_failed", level=logging.WARNING, component="router", error=str(e))
+        log_event("warm_up", role=Config.SERVING_ROLE, seconds=round(time.perf_counter() - start, 3),
+                  chunks={level: len(keywords) for level, keywords in self.keyword_indexes.items()})
     
     def update_knowledge_base(self, user):
-        """Update knowledge base (vector store)"""
-        # 检查用户和权限是否变化
-        if user.id == self.last_user and user.get_access_level() == self.last_access_level:
-            print("User and access level unchanged, skipping update")
-            return
+        """Make sure the indexes for every level the user can access exist"""
+        for level in Config.ACCESS_LEVELS:
+            if user.has_access(level):
+                self.get_vectorstore(level)
+    
+    def retrieve(self, query, user, query_embedding=None, mode=None):
+        """检索用户有权限的各等级, 返回合并后的前 k 个文档块
         
-        print(f"Updating knowledge base for {user.id} ({user.get_access_level()} access)")
-        accessible_files = file_manager.get_accessible_files(user)
-        print(f"Accessible files: {len(accessible_files)}")
+        mode: "vector" 只用向量, "keyword" 只用 BM25 (不调用 embedding 模型), "hybrid" 两者按排名融合
+        """
+        mode = mode or Config.RETRIEVAL_MODE
+        # 只检索用户有权限的等级; 索引已经建好时不会等待正在进行的更新
+        levels = [level for level in Config.ACCESS_LEVELS if user.has_access(level)]
+        vectorstores = [self.get_vectorstore(level) for level in levels]
+        keyword_indexes = [self.keyword_indexes[level] for level in levels]
+        if not vectorstores:
+            log_event("retrieval_skipped", level=logging.WARNING, reason="no vector store")
+            return []
         
-        if not accessible_files:
-            print("No accessible files")
-            self.vectorstore = None
-            return
+        k = Config.RETRIEVAL_K
+        candidates = max(k, Config.RETRIEVAL_CANDIDATES)
         
-        documents = self.load_documents(accessible_files)
-        self.vectorstore = self.create_vectorstore(documents)
+        vector_docs = []
+        if mode in ("vector", "hybrid"):
+            # 查询只做一次 embedding, 各等级共用
+            if query_embedding is None:
+                query_embedding = self.embeddings.embed_query(query)
+            scored = []
+            with timed("vector_search"):
+                for vectorstore, keywords in zip(vectorstores, keyword_indexes):
+                    results = vectorstore.similarity_search_by_vector_with_relevance_scores(query_embedding, k=candidates)
+                    # collection 中可能有正在索引、尚未发布的块; 只保留已发布索引中的块
+                    scored.extend((doc, score) for doc, score in results if chunk_id(doc) in keywords)
+            # 距离越小越相关
+            scored.sort(key=lambda item: item[1])
+            vector_docs = [doc for doc, _ in scored[:candidates]]
         
-        # 更新最后状态
-        self.last_user = user.id
-        self.last_access_level = user.get_access_level()
+        keyword_docs = []
+        if mode in ("keyword", "hybrid"):
+            scored = []
+            with timed("keyword_search"):
+                for keywords in keyword_indexes:
+                    scored.extend(keywords.search(query, candidates))
+            # BM25 分数越大越相关
+            scored.sort(key=lambda item: item[1], reverse=True)
+            keyword_docs = [doc for doc, _ in scored[:candidates]]
+        
+        if mode == "vector":
+            return vector_docs[:k]
+        if mode == "keyword":
+            return keyword_docs[:k]
+        return fuse_results(
+            [(vector_docs, Config.HYBRID_VECTOR_WEIGHT), (keyword_docs, Config.HYBRID_KEYWORD_WEIGHT)], k
+        )
     
     def get_relevant_context(self, query, user):
         """Retrieve context relevant to the query"""
-        # 确保知识库是最新的
-        self.update_knowledge_base(user)
-        
-        if not self.vectorstore:
-            print("Vector store not available, cannot retrieve context")
-            return ""
-        
-        # 从向量库中检索相关内容
-        print(f"Query: {query}")
         try:
-            results = self.vectorstore.similarity_search(query, k=3)
-            context = "\n\n".join([doc.page_content for doc in results])
-            print(f"Retrieved context: {context[:200]}...")
-            return context
+            return format_context(self.retrieve(query, user))
         except Exception as e:
-            print(f"Error retrieving context: {str(e)}")
+            log_event("retrieval_failed", level=logging.ERROR, error=str(e))
             return ""
     
-    def query_ollama(self, query, context, history):
+    def _ollama_messages(self, query, context, history):
+        history_str = "\n".join([f"User: {h[0]}\nAI: {h[1]}" for h in history]) if history else "No history"
+        messages = self.ollama_prompt.format_messages(
+            context=context,
+            history=history_str,
+            question=query
+        )
+        return [{"role": "user", "content": message.content} for message in messages]
+    
+    def _llm_messages(self, query, context, history):
+        # 两种格式都准备好, 路由换后端时使用对应的格式
+        return {
+            "ollama": self._ollama_messages(query, context, history),
+            "deepseek": self._deepseek_messages(query, context, history)
+        }
+    
+    async def aquery_ollama(self, query, context, history):
         try:
-            llm = ChatOllama(model=Config.OLLAMA_MODEL, temperature=0.7)
-            
-            template = """
-            <s>[INST] <<SYS>>
-            You are an AI assistant that answers questions based on the provided context.
-            If the context is insufficient, answer based on your knowledge.
-            Respond in English.
-            <</SYS>>
-            
-            Context:
-            {context}
-            
-            Conversation History:
-            {history}
-            
-            Question: {question} [/INST]
-            """
-            
-            prompt = ChatPromptTemplate.from_template(template)
-            chain = prompt | llm
-            
-            history_str = "\n".join([f"User: {h[0]}\nAI: {h[1]}" for h in history]) if history else "No history"
-            
-            response = chain.invoke({
-                "context": context,
-                "history": history_str,
-                "question": query
-            })
-            
-            return response.content
+            return await self.router.chat("ollama", self._llm_messages(query, context, history))
         except Exception as e:
-            print(f"Error querying Ollama: {str(e)}")
+            BACKEND_ERRORS.inc(backend="ollama")
+            log_event("backend_error", level=logging.ERROR, backend="ollama", error=str(e))
             return "An error occurred while querying the local model"
     
-    def query_deepseek(self, query, context, history):
-        if not Config.DEEPSEEK_API_KEY:
-            return "DeepSeek API key not configured"
-        
-        headers = {
-            "Authorization": f"Bearer {Config.DEEPSEEK_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
+    async def astream_ollama(self, query, context, history):
+        """逐个返回本地模型生成的 token"""
+        try:
+            async for token in self.router.stream_chat("ollama", self._llm_messages(query, context, history)):
+                yield token
+        except Exception as e:
+            BACKEND_ERRORS.inc(backend="ollama")
+            log_event("backend_error", level=logging.ERROR, backend="ollama", error=str(e))
+            yield "An error occurred while querying the local model"
+    
+    def _deepseek_messages(self, query, context, history):
         messages = [
             {
                 "role": "system",
@@ -201,51 +546,325 @@ class RAGSystem:
         
         # 添加当前问题
         messages.append({"role": "user", "content": query})
+        return messages
+    
+    async def aquery_deepseek(self, query, context, history):
+        if not Config.DEEPSEEK_API_KEY:
+            return "DeepSeek API key not configured"
         
-        data = {
-            "model": "deepseek-chat",
-            "messages": messages,
-            "temperature": 0.7,
-            "max_tokens": 2000
+        import httpx
+        try:
+            return await self.router.chat("deepseek", self._llm_messages(query, context, history))
+        except httpx.HTTPStatusError as e:
+            BACKEND_ERRORS.inc(backend="deepseek")
+            log_event("backend_error", level=logging.ERROR, backend="deepseek", status_code=e.response.status_code)
+            return str(e)
+        except Exception as e:
+            BACKEND_ERRORS.inc(backend="deepseek")
+            log_event("backend_error", level=logging.ERROR, backend="deepseek", error=str(e))
+            return f"API request failed: {str(e)}"
+    
+    async def astream_deepseek(self, query, context, history):
+        """逐个返回 DeepSeek 生成的 token (server-sent events)"""
+        if not Config.DEEPSEEK_API_KEY:
+            yield "DeepSeek API key not configured"
+            return
+        
+        import httpx
+        try:
+            async for token in self.router.stream_chat("deepseek", self._llm_messages(query, context, history)):
+                yield token
+        except httpx.HTTPStatusError as e:
+            BACKEND_ERRORS.inc(backend="deepseek")
+            log_event("backend_error", level=logging.ERROR, backend="deepseek", status_code=e.response.status_code)
+            yield str(e)
+        except Exception as e:
+            BACKEND_ERRORS.inc(backend="deepseek")
+            log_event("backend_error", level=logging.ERROR, backend="deepseek", error=str(e))
+            yield f"API request failed: {str(e)}"
+    
+    def client_stats(self):
+        """后端并发的使用情况, 以及每个端点的连接池、健康状态和延迟 (router 还没有创建时没有 "router")"""
+        stats = {
+            "ollama": {"limiter": self.limiters["ollama"].stats()},
+            "deepseek": {"limiter": self.limiters["deepseek"].stats()}
         }
+        # 读取统计不创建 router (和它的 HTTP 客户端、健康检查)
+        if self._router is not None:
+            stats["router"] = self._router.stats()
+        return stats
+    
+    def metric_samples(self):
+        """导出到 /metrics 的组件统计: 缓存命中、后端连接池和排队、索引大小"""
+        samples = []
+        # 还没有创建的组件不在这里创建
+        embedding_stats = self._embeddings.stats() if hasattr(self._embeddings, "stats") else {}
+        answer_stats = self.answer_cache.stats()
+        for cache, stats in (("embedding", embedding_stats), ("answer", answer_stats)):
+            if not stats:
+                continue
+            samples.append(("rag_cache_hits_total", "counter", "Cache hits", {"cache": cache}, stats["hits"]))
+            samples.append(("rag_cache_misses_total", "counter", "Cache misses", {"cache": cache}, stats["misses"]))
+            samples.append(("rag_cache_entries", "gauge", "Entries in the cache", {"cache": cache}, stats["entries"]))
+        samples.append(("rag_cache_hits_total", "counter", "Cache hits", {"cache": "answer_semantic"},
+                        answer_stats["semantic_hits"]))
+        
+        client_stats = self.client_stats()
+        router_stats = client_stats.pop("router", None)
+        for backend, stats in client_stats.items():
+            labels = {"backend": backend}
+            samples.append(("rag_backend_in_flight", "gauge", "Generations running on the backend", labels,
+                            stats["limiter"]["in_flight"]))
+            samples.append(("rag_backend_waiting", "gauge", "Generations queued for the backend", labels,
+                            stats["limiter"]["waiting"]))
+            samples.append(("rag_backend_rejected_total", "counter", "Generations rejected as busy", labels,
+                            stats["limiter"]["rejected"]))
+        
+        if router_stats is not None:
+            for name, stats in router_stats["endpoints"].items():
+                labels = {"endpoint": name}
+                samples.append(("rag_llm_endpoint_healthy", "gauge", "1 if the LLM endpoint passes health checks", labels,
+                                int(stats["healthy"])))
+                samples.append(("rag_llm_endpoint_outstanding", "gauge", "Generations running on the LLM endpoint", labels,
+                                stats["outstanding"]))
+                samples.append(("rag_llm_endpoint_errors_total", "counter", "Failed or timed out generations", labels,
+                                stats["errors"]))
+                # 连接池的使用情况, 用来在负载下调整连接池大小
+                pool = stats["pool"]
+                samples.append(("rag_llm_endpoint_retries_total", "counter", "Retried HTTP requests to the LLM endpoint",
+                                labels, pool["retries"]))
+                samples.append(("rag_llm_endpoint_http_errors_total", "counter",
+                                "HTTP requests to the LLM endpoint that failed", labels, pool["errors"]))
+                samples.append(("rag_llm_endpoint_pool_in_flight", "gauge", "HTTP requests in progress on the pool",
+                                labels, pool["in_flight"]))
+                samples.append(("rag_llm_endpoint_pool_peak_in_flight", "gauge",
+                                "Most HTTP requests in progress on the pool at once", labels, pool["peak_in_flight"]))
+                samples.append(("rag_llm_endpoint_pool_max_connections", "gauge", "Connection limit of the pool",
+                                labels, pool["max_connections"]))
+                samples.append(("rag_llm_endpoint_pool_max_keepalive_connections", "gauge",
+                                "Keep-alive connection limit of the pool", labels, pool["max_keepalive_connections"]))
+                for phase in ("first_token", "total"):
+                    for p in (50, 95):
+                        value = stats[f"{phase}_p{p}"]
+                        if value is not None:
+                            samples.append(("rag_llm_endpoint_latency_seconds", "gauge",
+                                            "Recent latency percentiles per LLM endpoint",
+                                            dict(labels, phase=phase, quantile=p / 100), value))
+            for event in ("failovers", "hedges", "hedge_wins"):
+                samples.append((f"rag_llm_{event}_total", "counter", f"LLM router {event.replace('_', ' ')}", {},
+                                router_stats[event]))
+        
+        for level, keywords in self.keyword_indexes.items():
+            samples.append(("rag_index_chunks", "gauge", "Published chunks per level", {"level": level}, len(keywords)))
+        if self.snapshot_reader is not None:
+            samples.append(("rag_index_generation", "gauge", "Index snapshot generation loaded by this worker", {},
+                            self.snapshot_reader.generation))
+        return samples
+    
+    def _select_backend(self, use_deepseek):
+        return "deepseek" if use_deepseek and Config.DEEPSEEK_API_KEY else "ollama"
+    
+    async def _prepare(self, query, user, history, use_deepseek):
+        """检索上下文并查询回复缓存; Chroma 和 embedding 是同步的, 放到线程里执行, 不阻塞事件循环
+        
+        返回的 answer 不为空时 (缓存命中或结构化数据直接回答) 不需要调用 LLM, outcome 说明原因
+        """
+        backend = self._select_backend(use_deepseek)
+        model = "deepseek:deepseek-chat" if backend == "deepseek" else f"ollama:{Config.OLLAMA_MODEL}"
+        levels = [level for level in Config.ACCESS_LEVELS if user.has_access(level)]
+        access_level = user.get_access_level()
+        # 在检索之前记录版本号, 生成期间文件变化的话回复不会写入缓存
+        generation = self.answer_cache.generation(levels)
+        
+        query_embedding = None
+        docs = []
+        
+        # 结构化数据 (JSON/CSV/Excel) 中的实体/字段查询: 直接回答, 或只把匹配的记录放进 prompt
+        if Config.STRUCTURED_QUERY_MODE != "off":
+            try:
+                # 确保这些等级已经同步过 (之后只是字典查找)
+                await asyncio.to_thread(self.update_knowledge_base, user)
+                with timed("structured_lookup"):
+                    matches = await asyncio.to_thread(self.structured_store.lookup, query, levels)
+            except Exception as e:
+                log_event("structured_lookup_failed", level=logging.WARNING, error=str(e))
+                matches = []
+            if matches:
+                annotate(structured_entities=[match["entity"] for match in matches])
+                # 问题中还有记录里没有的字段 (例如只记录了身高时问年龄和身高) 时交给 LLM, 回复中可以说明哪些信息没有
+                if Config.STRUCTURED_QUERY_MODE == "direct" and all(match["fields"] for match in matches) \
+                        and not unanswered_terms(query, matches):
+                    return {"backend": backend, "answer": format_answer(matches), "outcome": "structured"}
+                from langchain_core.documents import Document
+                docs = [Document(page_content=format_records(matches), metadata={"source": "structured"})]
         
         try:
-            response = requests.post(Config.DEEPSEEK_API_URL, headers=headers, json=data)
-            if response.status_code == 200:
-                return response.json()["choices"][0]["message"]["content"]
-            else:
-                return f"DeepSeek API error: {response.text}"
+            # 只用关键词检索时完全不调用 embedding 模型 (也就不做语义缓存查找)
+            if Config.RETRIEVAL_MODE != "keyword":
+                query_embedding = await asyncio.to_thread(self.embeddings.embed_query, query)
+                with timed("cache_lookup"):
+                    cached = self.answer_cache.get_similar(access_level, model, history, query_embedding)
+                if cached is not None:
+                    return {"backend": backend, "answer": cached, "outcome": "semantic_cache_hit"}
+            if not docs:
+                docs = await asyncio.to_thread(self.retrieve, query, user, query_embedding)
         except Exception as e:
-            return f"API request failed: {str(e)}"
+            log_event("retrieval_failed", level=logging.ERROR, error=str(e))
+        
+        key = self.answer_cache.make_key(access_level, query, [chunk_id(doc) for doc in docs], model, history)
+        with timed("cache_lookup"):
+            cached = self.answer_cache.get(key)
+        if cached is not None:
+            return {"backend": backend, "answer": cached, "outcome": "cache_hit"}
+        
+        # 去重、(可选)重排, 把上下文和历史装进 token 预算
+        with timed("prompt_build"):
+            context, packed_history, prompt_stats = self.context_builder.build(query, docs, history)
+        annotate(retrieved_chunks=len(docs), prompt=prompt_stats)
+        return {
+            "backend": backend,
+            "answer": None,
+            "context": context,
+            "history": packed_history,
+            "cache_entry": (key, levels, generation, query_embedding)
+        }
     
-    def query(self, query, user, history, use_deepseek=False):
+    def _cache_response(self, prepared, response):
+        # 出错的回复不缓存
+        if response.startswith(ERROR_RESPONSES):
+            return
+        key, levels, generation, query_embedding = prepared["cache_entry"]
+        self.answer_cache.put(key, response, levels, generation, query_embedding)
+    
+    @asynccontextmanager
+    async def _generation_slot(self, backend, user):
+        """排队等待后端的生成名额, 记录排队时的队列长度和等待时间"""
+        limiter = self.limiters[backend]
+        level = user.get_access_level()
+        priority = 0
+        if Config.GENERATION_PRIORITY_BY_LEVEL and level in Config.ACCESS_LEVELS:
+            priority = Config.ACCESS_LEVELS.index(level)
+        queue_depth = limiter.waiting
+        wait_start = time.perf_counter()
+        async with limiter.slot(priority):
+            wait = time.perf_counter() - wait_start
+            record_stage("backend_wait", wait)
+            GENERATION_QUEUE_WAIT.observe(wait, backend=backend, level=level)
+            annotate(queue_depth=queue_depth, queue_wait=round(wait, 4))
+            yield
+    
+    async def aquery(self, query, user, history, use_deepseek=False):
         # 记录开始时间
         start_time = time.time()
+        backend = self._select_backend(use_deepseek)
         
-        try:
-            # 获取相关上下文
-            context = self.get_relevant_context(query, user)
-            
-            if use_deepseek and Config.DEEPSEEK_API_KEY:
-                print("Using DeepSeek API")
-                response = self.query_deepseek(query, context, history)
-            else:
-                print("Using local Ollama model")
-                response = self.query_ollama(query, context, history)
-            
-            # 计算耗时
-            elapsed_time = time.time() - start_time
-            formatted_time = f"{elapsed_time:.2f} seconds"
-            print(f"Response generated in {formatted_time}")
+        with start_trace("chat", user=user.id, backend=backend, streaming=False, query_chars=len(query)) as trace:
+            try:
+                prepared = await self._prepare(query, user, history, use_deepseek)
+                context = prepared.get("context")
+                history = prepared.get("history", history)
+                response = prepared["answer"]
+                outcome = prepared.get("outcome")
+                
+                if response is None:
+                    async with self._generation_slot(backend, user):
+                        with timed("generation"):
+                            if backend == "deepseek":
+                                response = await self.aquery_deepseek(query, context, history)
+                            else:
+                                response = await self.aquery_ollama(query, context, history)
+                    self._cache_response(prepared, response)
+                    outcome = "error" if response.startswith(ERROR_RESPONSES) else "generated"
+                
+                REQUESTS.inc(backend=backend, outcome=outcome)
+                trace.set(outcome=outcome, response_chars=len(response))
+                
+                # 计算耗时
+                elapsed_time = time.time() - start_time
+                formatted_time = f"{elapsed_time:.2f} seconds"
+                
+                # 返回两个值：响应内容和响应时间
+                return response, formatted_time
             
-            # 返回两个值：响应内容和响应时间
-            return response, formatted_time
+            except BackendBusyError:
+                # 交给调用方返回 503
+                REQUESTS.inc(backend=backend, outcome="busy")
+                trace.set(outcome="busy")
+                raise
+            except Exception as e:
+                # 错误处理
+                REQUESTS.inc(backend=backend, outcome="error")
+                trace.set(outcome="error", error=str(e))
+                elapsed_time = time.time() - start_time
+                formatted_time = f"{elapsed_time:.2f} seconds"
+                
+                # 返回错误信息和响应时间
+                return f"An error occurred: {str(e)}", formatted_time
+    
+    async def astream_query(self, query, user, history, use_deepseek=False):
+        """流式查询: 先逐个产出 token 事件, 最后产出包含完整回复和耗时的 done 事件"""
+        start_time = time.time()
+        first_token_time = None
+        parts = []
+        backend = self._select_backend(use_deepseek)
+        
+        with start_trace("chat", user=user.id, backend=backend, streaming=True, query_chars=len(query)) as trace:
+            try:
+                prepared = await self._prepare(query, user, history, use_deepseek)
+                context = prepared.get("context")
+                history = prepared.get("history", history)
+                outcome = prepared.get("outcome")
+                
+                if prepared["answer"] is not None:
+                    # 缓存命中或直接回答: 整个回复作为一个 token 返回
+                    first_token_time = time.time() - start_time
+                    parts.append(prepared["answer"])
+                    yield {"type": "token", "content": prepared["answer"]}
+                else:
+                    async with self._generation_slot(backend, user):
+                        if backend == "deepseek":
+                            tokens = self.astream_deepseek(query, context, history)
+                        else:
+                            tokens = self.astream_ollama(query, context, history)
+                        
+                        with timed("generation"):
+                            async for token in tokens:
+                                if first_token_time is None:
+                                    first_token_time = time.time() - start_time
+                                parts.append(token)
+                                yield {"type": "token", "content": token}
+                    response = "".join(parts)
+                    self._cache_response(prepared, response)
+                    outcome = "error" if response.startswith(ERROR_RESPONSES) else "generated"
+                REQUESTS.inc(backend=backend, outcome=outcome)
+                trace.set(outcome=outcome)
+            except BackendBusyError:
+                REQUESTS.inc(backend=backend, outcome="busy")
+                trace.set(outcome="busy")
+                raise
+            except Exception as e:
+                REQUESTS.inc(backend=backend, outcome="error")
+                trace.set(outcome="error", error=str(e))
+                error = f"An error occurred: {str(e)}"
+                parts.append(error)
+                yield {"type": "token", "content": error}
             
-        except Exception as e:
-            # 错误处理
             elapsed_time = time.time() - start_time
-            formatted_time = f"{elapsed_time:.2f} seconds"
-            print(f"Error during query: {str(e)}")
-            
-            # 返回错误信息和响应时间
-            return f"An error occurred: {str(e)}", formatted_time
\ No newline at end of file
+            if first_token_time is None:
+                first_token_time = elapsed_time
+            record_stage("time_to_first_token", first_token_time)
+            trace.set(response_chars=len("".join(parts)))
+        yield {
+            "type": "done",
+            "response": "".join(parts),
+            "time_to_first_token": f"{first_token_time:.2f} seconds",
+            "response_time": f"{elapsed_time:.2f} seconds"
+        }
+    
+    def query(self, query, user, history, use_deepseek=False):
+        """同步接口: 在共享事件循环上执行 aquery"""
+        return self.runtime.run(self.aquery(query, user, history, use_deepseek))
+    
+    def stream_query(self, query, user, history, use_deepseek=False):
+        """同步接口: 在共享事件循环上执行 astream_query, 逐个返回事件"""
+        return self.runtime.iterate(self.astream_query(query, user, history, use_deepseek))
@@ -0,0 +1,180 @@
+# structured_store.py
+import csv
+import json
+import os
+import re
+import sqlite3
+import threading
+from config import Config
+from keyword_index import STOPWORDS, tokenize
+
+# 问题中常见的、不是字段名的词 (直接回答时不要求在记录中找到)
+QUESTION_WORDS = STOPWORDS | {
+    "about", "according", "based", "data", "her", "his", "info", "information", "its", "knowledge",
+    "local", "me", "please", "record", "records", "show", "tell", "their"
+}
+
+def _normalize(name):
+    return re.sub(r"[\s_\-]+", " ", str(name)).strip().lower()
+
+def _flatten(value, prefix=""):
+    """嵌套的字典展开成 a.b 形式的字段"""
+    if isinstance(value, dict):
+        fields = {}
+        for key, item in value.items():
+            fields.update(_flatten(item, f"{prefix}.{key}" if prefix else str(key)))
+        return fields
+    return {prefix or "value": value}
+
+def _entity_name(row, fallback):
+    for key in ("name", "id", "entity", "key"):
+        if row.get(key) not in (None, ""):
+            return str(row[key])
+    return fallback
+
+def _rows_to_records(rows, file_stem):
+    """行列表 (每行一个字典) -> [(entity, field, value)], 实体名取 name/id 列, 否则取第一列"""
+    records = []
+    for i, row in enumerate(rows):
+        if not row:
+            continue
+        first_key = next(iter(row))
+        entity = _entity_name(row, str(row[first_key]) if row[first_key] not in (None, "") else f"{file_stem}[{i}]")
+        for field, value in _flatten(row).items():
+            records.append((entity, field, value))
+    return records
+
+def parse_structured_file(file_path):
+    """把 JSON / CSV / Excel 文件解析成 (entity, field, value) 记录"""
+    ext = os.path.splitext(file_path)[1].lower()
+    file_stem = os.path.splitext(os.path.basename(file_path))[0]
+    if ext == ".json":
+        with open(file_path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        if isinstance(data, list):
+            return _rows_to_records([row for row in data if isinstance(row, dict)], file_stem)
+        if isinstance(data, dict):
+            if data and all(isinstance(value, dict) for value in data.values()):
+                # {"moshu": {"height": 177}} 形式: 键是实体名
+                return [(entity, field, value)
+                        for entity, fields in data.items()
+                        for field, value in _flatten(fields).items()]
+            return [(file_stem, field, value) for field, value in _flatten(data).items()]
+        return []
+    if ext == ".csv":
+        with open(file_path, "r", encoding="utf-8", newline="") as f:
+            return _rows_to_records(list(csv.DictReader(f)), file_stem)
+    if ext in (".xlsx", ".xls"):
+        # pandas 只有解析 Excel 时才需要
+        import pandas as pd
+        frame = pd.read_excel(file_path)
+        rows = json.loads(frame.to_json(orient="records"))
+        return _rows_to_records(rows, file_stem)
+    return []
+
+def _query_grams(query, max_words=3):
+    words = re.findall(r"\w+", query.lower())
+    grams = set()
+    for size in range(1, max_words + 1):
+        for i in range(len(words) - size + 1):
+            grams.add(" ".join(words[i:i + size]))
+    return grams
+
+class StructuredStore:
+    """结构化文件的本地表 (SQLite), 按实体和字段索引, 用于直接回答查询类问题"""
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or Config.STRUCTURED_DB_PATH
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS records (
+                level TEXT NOT NULL,
+                file_path TEXT NOT NULL,
+                entity TEXT NOT NULL,
+                entity_norm TEXT NOT NULL,
+                field TEXT NOT NULL,
+                field_norm TEXT NOT NULL,
+                value TEXT NOT NULL
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_records_entity ON records (entity_norm, level)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_records_file ON records (file_path)")
+        self._conn.commit()
+
+    @staticmethod
+    def is_structured(file_path):
+        return os.path.splitext(file_path)[1].lower().lstrip(".") in Config.STRUCTURED_EXTENSIONS
+
+    def replace_file(self, level, file_path, records):
+        file_path = os.path.normpath(file_path)
+        with self._lock:
+            self._conn.execute("DELETE FROM records WHERE file_path = ?", (file_path,))
+            self._conn.executemany(
+                "INSERT INTO records (level, file_path, entity, entity_norm, field, field_norm, value) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(level, file_path, str(entity), _normalize(entity), str(field), _normalize(field), json.dumps(value))
+                 for entity, field, value in records]
+            )
+            self._conn.commit()
+
+    def has_file(self, file_path):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT 1 FROM records WHERE file_path = ? LIMIT 1", (os.path.normpath(file_path),)
+            ).fetchone()
+        return row is not None
+
+    def remove_file(self, file_path):
+        with self._lock:
+            self._conn.execute("DELETE FROM records WHERE file_path = ?", (os.path.normpath(file_path),))
+            self._conn.commit()
+
+    def lookup(self, query, levels):
+        """查找问题中提到的实体 (只在给定等级中); 返回 [{"entity", "record", "fields"}], 没有则返回 []
+
+        record 是实体的全部字段, fields 是问题中提到的字段
+        """
+        grams = _query_grams(query)
+        if not grams or not levels:
+            return []
+        gram_marks = ",".join("?" * len(grams))
+        level_marks = ",".join("?" * len(levels))
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT entity, field, field_norm, value FROM records "
+                f"WHERE entity_norm IN ({gram_marks}) AND level IN ({level_marks}) ORDER BY rowid",
+                [*grams, *levels]
+            ).fetchall()
+
+        matches = {}
+        for entity, field, field_norm, value in rows:
+            match = matches.setdefault(entity, {"entity": entity, "record": {}, "fields": {}})
+            match["record"][field] = json.loads(value)
+            # 字段名或它的最后一段 (a.b 的 b) 出现在问题里
+            if field_norm in grams or field_norm.rsplit(".", 1)[-1] in grams:
+                match["fields"][field] = json.loads(value)
+        return list(matches.values())
+
+def unanswered_terms(query, matches):
+    """问题中既不是实体名、也不是找到的字段名的词 (例如记录中没有的字段); 不为空时不能直接回答"""
+    covered = set()
+    for match in matches:
+        covered.update(re.findall(r"\w+", _normalize(match["entity"])))
+        for field in match["fields"]:
+            covered.update(re.findall(r"\w+", _normalize(field)))
+    return sorted(set(tokenize(query)) - covered - QUESTION_WORDS)
+
+def format_answer(matches):
+    """直接回答: 列出问题中提到的字段"""
+    lines = []
+    for match in matches:
+        fields = ", ".join(f"{field}: {value}" for field, value in match["fields"].items())
+        lines.append(f"{match['entity']} - {fields}")
+    return "Based on local records:\n" + "\n".join(lines)
+
+def format_records(matches):
+    """只把匹配的记录作为上下文放进 prompt"""
+    return json.dumps({match["entity"]: match["record"] for match in matches}, ensure_ascii=False)
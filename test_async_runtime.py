@@ -0,0 +1,39 @@
+# 后端并发限制的排队上限: 同时到达的一批请求中超出 并发数 + 排队数 的部分要立即拒绝 (返回 503)
+import asyncio
+from async_runtime import BackendBusyError, BackendLimiter, GenerationScheduler
+
+async def _burst(limiter, requests, interval=0.0, hold=0.2):
+    """同时 (或每隔 interval 秒) 发出 requests 个请求, 每个占用名额 hold 秒; 返回被拒绝的个数"""
+    async def request():
+        try:
+            async with limiter.slot():
+                await asyncio.sleep(hold)
+            return True
+        except BackendBusyError:
+            return False
+
+    tasks = []
+    for _ in range(requests):
+        tasks.append(asyncio.create_task(request()))
+        if interval:
+            await asyncio.sleep(interval)
+    results = await asyncio.gather(*tasks)
+    return results.count(False)
+
+def test_limiter_rejects_burst():
+    limiter = BackendLimiter("test", max_concurrency=2, max_queue=3, queue_timeout=10)
+    rejected = asyncio.run(_burst(limiter, 30))
+    assert rejected == 25, rejected
+    assert limiter.rejected == 25
+
+def test_scheduler_rejects_burst_in_batch_window():
+    # 请求每隔 1ms 到达, 都在批处理窗口内 (这时还没有请求被放行)
+    scheduler = GenerationScheduler("test", max_concurrency=2, max_queue=3, queue_timeout=10, batch_window=0.2)
+    rejected = asyncio.run(_burst(scheduler, 30, interval=0.001))
+    assert rejected == 25, rejected
+    assert scheduler.dispatched == 5
+
+if __name__ == "__main__":
+    test_limiter_rejects_burst()
+    test_scheduler_rejects_burst_in_batch_window()
+    print("async runtime tests passed")
@@ -1,8 +1,15 @@
 # user_manager.py
 import json
+import logging
 import os
+import sqlite3
+import threading
+from collections import OrderedDict
 from datetime import datetime
 from flask_login import UserMixin
+from werkzeug.security import check_password_hash, generate_password_hash
+from config import Config
+from instrumentation import log_event
 
 USER_DATA_FILE = "users.json"
 DEFAULT_USERS = {
@@ -30,7 +37,7 @@ class User(UserMixin):
     def __init__(self, user_id, data):
         self.id = user_id
         self.username = user_id
-        self.password = data["password"]
+        self.password_hash = data["password_hash"]
         self.access_level = data["access_level"]
         self.created_at = data["created_at"]
         self.deleted_at = data["deleted_at"]
@@ -43,37 +50,148 @@ class User(UserMixin):
         return levels.index(self.access_level) <= levels.index(required_level)
 
 class UserManager:
-    def __init__(self):
-        self.users = self._load_users()
-    
-    def _load_users(self):
-        # 确保文件存在并包含默认用户
-        if not os.path.exists(USER_DATA_FILE):
-            self._create_default_users()
-        
-        with open(USER_DATA_FILE, "r") as f:
-            return json.load(f)
-    
+    """用户表 (SQLite, 按用户名索引), 密码保存加盐 hash
+
+    查到的 User 对象缓存在内存中 (LRU); 其他进程修改用户表时 (PRAGMA data_version 变化) 整个缓存失效,
+    所以多个 worker 进程共用一个数据库也不会读到过期的用户或密码.
+    """
+
+    def __init__(self, db_path=None, cache_size=None):
+        self.db_path = db_path or Config.USER_DB_PATH
+        self.cache_size = cache_size or Config.USER_CACHE_SIZE
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        # 用户不存在时也做一次 hash 比较, 登录耗时不暴露用户名是否存在
+        self._dummy_hash = generate_password_hash("")
+
+        os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                user_id TEXT PRIMARY KEY,
+                password_hash TEXT NOT NULL,
+                access_level TEXT NOT NULL,
+                created_at TEXT NOT NULL,
+                deleted_at TEXT
+            )
+        """)
+        self._conn.commit()
+        self._create_default_users()
+        self._data_version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+
     def _create_default_users(self):
-        with open(USER_DATA_FILE, "w") as f:
-            json.dump(DEFAULT_USERS, f, indent=2)
-    
+        """用户表为空时导入旧的 users.json (明文密码在导入时 hash), 没有的话创建默认用户"""
+        with self._lock:
+            # BEGIN IMMEDIATE: 多个进程同时启动时只有一个导入
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self._conn.execute("SELECT 1 FROM users LIMIT 1").fetchone() is None:
+                    source = USER_DATA_FILE if os.path.exists(USER_DATA_FILE) else None
+                    users = DEFAULT_USERS
+                    if source:
+                        with open(source, "r") as f:
+                            users = json.load(f)
+                    self._conn.executemany(
+                        "INSERT INTO users (user_id, password_hash, access_level, created_at, deleted_at) "
+                        "VALUES (?, ?, ?, ?, ?)",
+                        [(user_id, generate_password_hash(data["password"]), data["access_level"],
+                          data.get("created_at") or datetime.now().isoformat(), data.get("deleted_at"))
+                         for user_id, data in users.items()]
+                    )
+                    log_event("users_imported", source=source or "defaults", users=len(users))
+                    if source:
+                        log_event("users_json_obsolete", level=logging.WARNING,
+                                  message=f"{source} still contains plain-text passwords and can be deleted")
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+
+    def _check_version(self):
+        """其他进程提交了修改时清空缓存, 调用方持有锁"""
+        version = self._conn.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._data_version:
+            self._data_version = version
+            self._cache.clear()
+
+    def _invalidate(self, user_id):
+        with self._lock:
+            self._cache.pop(user_id, None)
+
     def get_user(self, user_id):
-        # 确保用户数据已加载
-        if not hasattr(self, 'users'):
-            self.users = self._load_users()
-            
-        user_data = self.users.get(user_id)
-        if user_data and user_data.get("deleted_at") is None:
-            return User(user_id, user_data)
-        return None
-    
+        with self._lock:
+            self._check_version()
+            user = self._cache.get(user_id)
+            if user is not None:
+                self._cache.move_to_end(user_id)
+                self.hits += 1
+                return user
+
+            self.misses += 1
+            row = self._conn.execute(
+                "SELECT password_hash, access_level, created_at, deleted_at FROM users WHERE user_id = ?",
+                (user_id,)
+            ).fetchone()
+            if row is None or row[3] is not None:
+                return None
+            user = User(user_id, {
+                "password_hash": row[0],
+                "access_level": row[1],
+                "created_at": row[2],
+                "deleted_at": row[3]
+            })
+            self._cache[user_id] = user
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return user
+
     def verify_user(self, username, password):
         user = self.get_user(username)
-        if user and user.password == password:
+        if user is None:
+            check_password_hash(self._dummy_hash, password)
+            return None
+        if check_password_hash(user.password_hash, password):
             return user
         return None
-    
-    def save_users(self):
-        with open(USER_DATA_FILE, "w") as f:
-            json.dump(self.users, f, indent=2)
\ No newline at end of file
+
+    def create_user(self, user_id, password, access_level):
+        if access_level not in Config.ACCESS_LEVELS:
+            raise ValueError(f"Unknown access level: {access_level}")
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO users (user_id, password_hash, access_level, created_at, deleted_at) VALUES (?, ?, ?, ?, NULL)",
+                (user_id, generate_password_hash(password), access_level, datetime.now().isoformat())
+            )
+            self._conn.commit()
+        self._invalidate(user_id)
+
+    def set_password(self, user_id, password):
+        with self._lock:
+            self._conn.execute("UPDATE users SET password_hash = ? WHERE user_id = ?",
+                               (generate_password_hash(password), user_id))
+            self._conn.commit()
+        self._invalidate(user_id)
+
+    def set_access_level(self, user_id, access_level):
+        if access_level not in Config.ACCESS_LEVELS:
+            raise ValueError(f"Unknown access level: {access_level}")
+        with self._lock:
+            self._conn.execute("UPDATE users SET access_level = ? WHERE user_id = ?", (access_level, user_id))
+            self._conn.commit()
+        self._invalidate(user_id)
+
+    def delete_user(self, user_id):
+        """软删除: 保留记录, 之后查不到这个用户"""
+        with self._lock:
+            self._conn.execute("UPDATE users SET deleted_at = ? WHERE user_id = ? AND deleted_at IS NULL",
+                               (datetime.now().isoformat(), user_id))
+            self._conn.commit()
+        self._invalidate(user_id)
+
+    def stats(self):
+        with self._lock:
+            users = self._conn.execute("SELECT COUNT(*) FROM users WHERE deleted_at IS NULL").fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "entries": len(self._cache), "users": users}
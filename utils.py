@@ -1,17 +1,36 @@
 # utils.py
+import logging
 import os
+import threading
+import time
 from datetime import datetime
 from config import Config
+from instrumentation import log_event
 
-def clean_temp_uploads():
-    """清理临时上传目录"""
+def clean_temp_uploads(max_age=None):
+    """清理临时上传目录中超过 max_age 秒没有修改的文件 (正在上传的文件不会被删除)"""
+    max_age = Config.UPLOAD_TEMP_MAX_AGE if max_age is None else max_age
+    now = time.time()
     for filename in os.listdir(Config.UPLOAD_DIR):
         file_path = os.path.join(Config.UPLOAD_DIR, filename)
         try:
-            if os.path.isfile(file_path):
+            if os.path.isfile(file_path) and now - os.path.getmtime(file_path) > max_age:
                 os.unlink(file_path)
         except Exception as e:
-            print(f"删除临时文件失败 {file_path}: {e}")
+            log_event("temp_cleanup_failed", level=logging.WARNING, file=file_path, error=str(e))
+
+def start_temp_sweeper(interval=None):
+    """在后台线程中定期清理临时上传目录"""
+    interval = interval or Config.UPLOAD_SWEEP_INTERVAL
+    
+    def sweep():
+        while True:
+            clean_temp_uploads()
+            time.sleep(interval)
+    
+    thread = threading.Thread(target=sweep, name="temp-sweeper", daemon=True)
+    thread.start()
+    return thread
 
 def get_timestamp():
     """获取当前时间戳"""